@@ -0,0 +1,61 @@
+import queue
+import threading
+
+PIPELINE_DEPTH = 4
+
+
+class AcquisitionPipeline:
+    """
+    Producer/consumer stage for per-frame work that does not need the stage to
+    stay put (export, file write, ...). The scan loop submits items and moves on;
+    `handler(item)` runs on worker threads. The input queue is bounded, so
+    submit() blocks when the workers fall behind.
+    """
+    _STOP = object()
+
+    def __init__(self, handler, workers=1, maxsize=PIPELINE_DEPTH):
+        self.handler = handler
+        self.pending = queue.Queue(maxsize)
+        self.done = queue.Queue()
+        self.errors = []
+        self.threads = [threading.Thread(target=self._run, name=f"pipeline-{i}", daemon=True) for i in range(workers)]
+        for t in self.threads:
+            t.start()
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is self._STOP:
+                self.pending.task_done()
+                break
+            try:
+                self.done.put(self.handler(item))
+            except Exception as e:
+                self.errors.append((item, e))
+                print(f"Acquisition pipeline error for {item}: {e}")
+            finally:
+                self.pending.task_done()
+
+    def submit(self, item):
+        self.pending.put(item)
+
+    def drain(self):
+        # Wait until everything submitted so far has been handled
+        self.pending.join()
+
+    def completed(self):
+        # Results finished since the last call, oldest first
+        results = []
+        while True:
+            try:
+                results.append(self.done.get_nowait())
+            except queue.Empty:
+                return results
+
+    def close(self):
+        for _ in self.threads:
+            self.pending.put(self._STOP)
+        for t in self.threads:
+            t.join()
+        return self.completed()
+
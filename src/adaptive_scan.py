@@ -0,0 +1,90 @@
+import csv
+import threading
+import numpy as np
+
+from beam_metrics import SCORE_METRICS
+
+ADAPTIVE_MAX_LEVELS = 20
+ADAPTIVE_LOG = 'adaptive.csv'
+
+
+class AdaptiveScan:
+    """
+    Coarse-to-fine search: level 0 is the usual grid from scan_params; every further
+    level is a grid of the same size (at least 3 points per axis) spanning +/- half the
+    previous step around the best point so far, so each level shrinks the step by at
+    least 2x, until every scanned axis' step is below `tolerance` pulses. `converged`
+    tells whether that was reached or the search stopped at `max_levels`.
+    Points are rounded to whole pulses and never visited twice.
+    """
+    def __init__(self, axes, scan_params, metric='peak', tolerance=1.0, max_levels=ADAPTIVE_MAX_LEVELS):
+        self.axes = list(axes)
+        self.metric = metric
+        self.maximize = SCORE_METRICS[metric][1] == 'max'
+        self.tolerance = float(tolerance)
+        self.max_levels = max_levels
+        self.grids = [np.round(np.asarray(scan_params[ax], dtype=float)) for ax in self.axes]
+        self.scanned = [i for i, g in enumerate(self.grids) if len(g) > 1]
+        self.bounds = [(g.min(), g.max()) for g in self.grids]
+        self.counts = [max(len(g), 3) for g in self.grids]
+        self.steps = [abs(g[1] - g[0]) if len(g) > 1 else 0.0 for g in self.grids]
+        self.level = 0
+        self.scores = {}
+        self.lock = threading.Lock()
+
+    def record(self, pos, score):
+        with self.lock:
+            self.scores[tuple(np.round(pos))] = score
+
+    @property
+    def best(self):
+        with self.lock:
+            if not self.scores:
+                return None, None
+            pick = max if self.maximize else min
+            pos = pick(self.scores, key=self.scores.get)
+            return np.array(pos), self.scores[pos]
+
+    @property
+    def converged(self):
+        return all(self.steps[i] < self.tolerance for i in self.scanned)
+
+    def _done(self):
+        return self.level >= self.max_levels or self.converged
+
+    def next_level(self):
+        # Grid for the next level (axis -> values), or None when finished
+        if self.level == 0:
+            grids = self.grids
+        else:
+            if self._done():
+                return None
+            best, _ = self.best
+            if best is None:
+                return None
+            grids = []
+            for i, g in enumerate(self.grids):
+                if i not in self.scanned:
+                    grids.append(g)
+                    continue
+                lo = max(self.bounds[i][0], best[i] - self.steps[i] / 2)
+                hi = min(self.bounds[i][1], best[i] + self.steps[i] / 2)
+                grid = np.unique(np.round(np.linspace(lo, hi, self.counts[i])))
+                self.steps[i] = (hi - lo) / (self.counts[i] - 1)
+                grids.append(grid)
+        self.level += 1
+        return {ax: g for ax, g in zip(self.axes, grids)}
+
+    def unvisited(self, positions):
+        with self.lock:
+            keep = [tuple(np.round(p)) not in self.scores for p in positions]
+        return positions[np.array(keep, dtype=bool)] if len(positions) else positions
+
+    def write_log(self, path):
+        with self.lock:
+            rows = sorted(self.scores.items())
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow([ax for ax in self.axes] + [self.metric])
+            for pos, score in rows:
+                writer.writerow([int(v) for v in pos] + [score])
@@ -0,0 +1,215 @@
+import csv
+import os
+import numpy as np
+
+from beam_metrics import BeamAnalyzer, remove_background
+from preview import to_intensity
+
+# Sharpness scores, all larger = better focus: normalized gradient energy, normalized
+# intensity variance, or the negative mean D4σ beam width
+FOCUS_METRICS = ('gradient', 'variance', 'width')
+FOCUS_AXIS = 'Z'
+FOCUS_TOLERANCE = 5         # pulses; the search stops once best focus is bracketed this tightly
+FOCUS_MAX_CAPTURES = 12
+FOCUS_TRACK_FRACTION = 0.25  # tracked searches cover this fraction of the range around the last focus
+FOCUS_LOG = 'autofocus.csv'
+_GOLDEN = (3 - np.sqrt(5)) / 2
+
+
+class FocusMetric:
+    """
+    Vectorized sharpness score of one frame. The intensity and gradient buffers are
+    allocated once per frame shape. As in BeamAnalyzer, the background is removed
+    with remove_background() first, so read noise (whose
+    gradient energy does not depend on focus) cannot win over a blurred beam.
+    'gradient' and 'variance' are normalized by the remaining power, so laser power
+    drift between captures does not move the optimum.
+    """
+    def __init__(self, metric='gradient'):
+        if metric not in FOCUS_METRICS:
+            raise ValueError(f"Unknown focus metric: {metric}")
+        self.metric = metric
+        self.analyzer = BeamAnalyzer() if metric == 'width' else None
+        self.shape = None
+
+    def _prepare(self, shape):
+        if shape != self.shape:
+            self.shape = shape
+            h, w = shape
+            self._img = np.empty(shape, dtype=np.float64)
+            self._mask = np.empty(shape, dtype=bool)
+            self._gx = np.empty((h, w - 1), dtype=np.float64)
+            self._gy = np.empty((h - 1, w), dtype=np.float64)
+
+    def score(self, frame):
+        if self.analyzer is not None:
+            m = self.analyzer.analyze(frame)
+            width = (m['d4s_x'] + m['d4s_y']) / 2
+            return -width if np.isfinite(width) else float('-inf')
+        frame = to_intensity(frame)
+        self._prepare(frame.shape)
+        img = remove_background(frame, self._img, self._mask)
+        total = float(img.sum())
+        if total <= 0:
+            return 0.0
+        if self.metric == 'variance':
+            mean = total / img.size
+            return float(img.var()) / mean
+        gx, gy = self._gx, self._gy
+        np.subtract(img[:, 1:], img[:, :-1], out=gx)
+        np.subtract(img[1:], img[:-1], out=gy)
+        gx *= gx
+        gy *= gy
+        return (float(gx.sum()) + float(gy.sum())) * img.size / total ** 2
+
+
+def bracket_search(measure, lo, hi, tolerance=FOCUS_TOLERANCE, max_evals=FOCUS_MAX_CAPTURES):
+    """
+    Maximum of measure(pos) on [lo, hi] with Brent's method: parabolic steps through
+    the three best points while they behave, golden-section steps otherwise. Positions
+    are whole pulses and each is measured once. Stops when the best point is bracketed
+    within `tolerance` or after max_evals measurements. Returns (best pos, score).
+    """
+    cache = {}
+
+    def f(x):
+        x = int(round(x))
+        if x not in cache:
+            cache[x] = -measure(x)
+        return cache[x]
+
+    a, b = float(min(lo, hi)), float(max(lo, hi))
+    tol = max(tolerance / 2, 1.0)
+    x = w = v = a + _GOLDEN * (b - a)
+    fx = fw = fv = f(x)
+    d = e = 0.0
+    while len(cache) < max_evals:
+        m = (a + b) / 2
+        if abs(x - m) <= 2 * tol - (b - a) / 2:
+            break
+        golden = True
+        if abs(e) > tol:
+            # Parabola through x, w, v
+            r = (x - w) * (fx - fv)
+            q = (x - v) * (fx - fw)
+            p = (x - v) * q - (x - w) * r
+            q = 2 * (q - r)
+            if q > 0:
+                p = -p
+            q = abs(q)
+            e_prev, e = e, d
+            if abs(p) < abs(q * e_prev / 2) and q * (a - x) < p < q * (b - x):
+                d = p / q
+                if (x + d) - a < 2 * tol or b - (x + d) < 2 * tol:
+                    d = tol if x < m else -tol
+                golden = False
+        if golden:
+            e = (a - x) if x >= m else (b - x)
+            d = _GOLDEN * e
+        u = x + (d if abs(d) >= tol else np.copysign(tol, d))
+        fu = f(u)
+        if fu <= fx:
+            if u >= x:
+                a = x
+            else:
+                b = x
+            v, w, x = w, x, u
+            fv, fw, fx = fw, fx, fu
+        else:
+            if u < x:
+                a = u
+            else:
+                b = u
+            if fu <= fw or w == x:
+                v, w, fv, fw = w, u, fw, fu
+            elif fu <= fv or v == x or v == w:
+                v, fv = u, fu
+    best = min(cache, key=cache.get)
+    return best, -cache[best]
+
+
+class Autofocus:
+    """
+    Best-focus search along one stage axis (default Z) over [lo, hi], scored by
+    FocusMetric and driven by bracket_search, so it converges in a handful of
+    captures instead of a dense sweep. run() takes move(pos), which moves the axis and
+    waits, and grab(pos), which returns one frame taken there; both come from the
+    caller (ScanWorker, which moves through StageMotion so a failed move stops the
+    search). A standalone search is a scan recipe (scan_runner) with no scanned axis
+    and only an autofocus section; the focus found is in autofocus.csv. track: within a scan, each search covers only
+    FOCUS_TRACK_FRACTION of the range around the focus found at the previous point;
+    if the best focus ends up on the edge of that window the full range is searched.
+    The search never leaves [lo, hi].
+    save_frames: ScanWorker also writes the search frames (<point>_focus.bmp).
+    """
+    def __init__(self, lo, hi, axis=FOCUS_AXIS, metric='gradient', tolerance=FOCUS_TOLERANCE,
+                 max_captures=FOCUS_MAX_CAPTURES, track=True, save_frames=False):
+        if hi == lo:
+            raise ValueError("Autofocus range is empty")
+        if int(max_captures) < 3:
+            raise ValueError("Autofocus needs at least 3 captures")
+        self.lo, self.hi = sorted((float(lo), float(hi)))
+        self.axis = axis
+        self.metric = metric
+        self.scorer = FocusMetric(metric)
+        self.tolerance = float(tolerance)
+        self.max_captures = int(max_captures)
+        self.track = track
+        self.save_frames = save_frames
+
+    @property
+    def center(self):
+        return (self.lo + self.hi) / 2
+
+    def window(self, around=None):
+        if around is None:
+            return self.lo, self.hi
+        width = (self.hi - self.lo) * FOCUS_TRACK_FRACTION
+        lo = min(max(around - width / 2, self.lo), self.hi - width)
+        return lo, lo + width
+
+    def run(self, move, grab, around=None):
+        # (best position, score, [(position, score) in capture order])
+        history = []
+
+        def measure(pos):
+            move(pos)
+            score = self.scorer.score(grab(pos))
+            history.append((pos, score))
+            return score
+
+        lo, hi = self.window(around)
+        best, score = bracket_search(measure, lo, hi, self.tolerance, self.max_captures)
+        edge = max(self.tolerance, 2.0)
+        if (best - lo <= edge and lo > self.lo) or (hi - best <= edge and hi < self.hi):
+            # The focus moved out of the tracked window
+            wide, wide_score = bracket_search(measure, self.lo, self.hi, self.tolerance, self.max_captures)
+            if wide_score > score:
+                best, score = wide, wide_score
+        return best, score, history
+
+    def to_dict(self):
+        return {'axis': self.axis, 'range': [self.lo, self.hi], 'metric': self.metric, 'tolerance': self.tolerance,
+                'max_captures': self.max_captures, 'track': self.track, 'save_frames': self.save_frames}
+
+    @classmethod
+    def from_dict(cls, d):
+        lo, hi = d['range']
+        return cls(lo, hi, d.get('axis', FOCUS_AXIS), d.get('metric', 'gradient'), d.get('tolerance', FOCUS_TOLERANCE),
+                   d.get('max_captures', FOCUS_MAX_CAPTURES), d.get('track', True), d.get('save_frames', False))
+
+
+class FocusLog:
+    # log_dir/autofocus.csv: focus found at every scan point, flushed per point
+    def __init__(self, log_dir, axes):
+        self.file = open(os.path.join(log_dir, FOCUS_LOG), 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if self.file.tell() == 0:
+            self.writer.writerow(['index'] + list(axes) + ['score', 'captures'])
+
+    def append(self, index, pos, score, captures):
+        self.writer.writerow([index] + [int(round(v)) for v in pos] + [f"{score:.6g}", captures])
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
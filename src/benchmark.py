@@ -0,0 +1,226 @@
+"""
+Hardware-free scan benchmarks: reference recipes run through the real scan engine
+(ScanWorker, StageMotion, DS102Controller, camera backends) against a simulated
+DS102 (in-process loopback or a pty) and a mock RayCi XML-RPC server.
+
+    python benchmark.py                       # all recipes, loopback transport
+    python benchmark.py -r xy_rayci_bmp --transport pty
+    python benchmark.py --json new.json --baseline old.json
+
+Reports points/s, per-phase mean/p95 latency and peak memory; with --baseline the
+exit code is 1 when a recipe's points/s dropped by more than --tolerance.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+from ds102 import DS102Controller
+from ds102_sim import SIM_JITTER, SIM_LATENCY, SIM_SPEED, PtyDS102, SimulatedDS102, SimulatedSerial
+from cameras import RayCiCamera, SimulatedCamera
+from frame_average import make_averager
+from motion import MoveModel, StageMotion
+from rayci_mock import MockRayCi
+from scan_path import CostModel, plan_grid_scan
+from fly_scan import plan_fly_scan
+from autofocus import Autofocus
+from frame_roi import FrameROI
+from scan_trace import PHASES
+from scan_worker import ScanWorker
+
+BENCH_FRAME_SHAPE = (504, 632)
+BENCH_TOLERANCE = 0.2
+
+# name -> axis grids (start, stop, count), camera, storage, exposures per point
+# [, burst mode][, fly-scan axis and its travel limits][, frame shape][, autofocus Z range][, ROI settings]
+BENCH_RECIPES = {
+    'xy_rayci_bmp': dict(grid={'X': (0, 2000, 8), 'Y': (0, 2000, 8)}, camera='rayci', storage='bmp', exposures=1),
+    'xyz_simulated_hdf5': dict(grid={'X': (0, 1000, 5), 'Y': (0, 1000, 5), 'Z': (0, 500, 4)},
+                               camera='simulated', storage='hdf5', exposures=1),
+    'xyz_track_roi_hdf5': dict(grid={'X': (0, 1000, 5), 'Y': (0, 1000, 5), 'Z': (0, 500, 4)},
+                               camera='simulated', storage='hdf5', exposures=1,
+                               roi=dict(mode='track', size=(192, 160), binning=2)),
+    'xy_burst_both': dict(grid={'X': (0, 1500, 6), 'Y': (0, 1500, 6)}, camera='simulated', storage='both', exposures=4),
+    'xy_clipped_average_both': dict(grid={'X': (0, 1500, 6), 'Y': (0, 1500, 6)}, camera='simulated', storage='both',
+                                    exposures=8, burst='clipped'),
+    # Dense line with small frames, so motion rather than frame I/O sets the pace
+    'x_line_step': dict(grid={'X': (0, 4000, 401)}, camera='simulated', storage='bmp', exposures=1, shape=(126, 158)),
+    'x_line_fly': dict(grid={'X': (0, 4000, 401)}, camera='simulated', storage='bmp', exposures=1, shape=(126, 158),
+                       fly='X', fly_limits=(-1000, 5000)),
+    # Best focus on a tilted focal plane: dense Z sweep at every X/Y point vs. a per-point autofocus
+    'xyz_focus_sweep': dict(grid={'X': (0, 1500, 4), 'Y': (0, 1500, 4), 'Z': (0, 2000, 21)}, camera='simulated',
+                            storage='bmp', exposures=1, shape=(126, 158), focus_plane=True),
+    'xy_autofocus': dict(grid={'X': (0, 1500, 4), 'Y': (0, 1500, 4), 'Z': (1000, 1000, 1)}, camera='simulated',
+                         storage='bmp', exposures=1, shape=(126, 158), focus_plane=True, autofocus=(0, 2000)),
+    'xyzuvw_motion_only': dict(grid={'X': (0, 400, 3), 'Y': (0, 400, 3), 'Z': (0, 200, 2),
+                                     'U': (0, 200, 2), 'V': (0, 200, 2), 'W': (0, 200, 2)},
+                               camera=None, storage='bmp', exposures=1),
+}
+
+
+def beam_scene(sim, shape=BENCH_FRAME_SHAPE, focus_plane=False):
+    # Beam follows the simulated X/Y stage, so frames differ from point to point. With
+    # focus_plane it is sharpest on a plane tilted along X and widens with the Z offset.
+    def scene():
+        pos = sim.positions()
+        sigma, blur = (30.0, 20.0), 1.0
+        if focus_plane:
+            defocus = (pos.get('Z', 0) - 800 - 0.2 * pos.get('X', 0)) / 300
+            sigma, blur = (6.0, 4.0), np.sqrt(1 + defocus ** 2)
+        return (shape[1] / 2 + (pos.get('X', 0) - 1000) * 0.05, shape[0] / 2 + (pos.get('Y', 0) - 1000) * 0.05,
+                sigma[0] * blur, sigma[1] * blur, 200.0 / blur ** 2)
+    return scene
+
+
+def run_recipe(name, recipe, workdir, transport='loopback', speed=SIM_SPEED, latency=SIM_LATENCY,
+               jitter=SIM_JITTER, verbose=False):
+    axes = list(recipe['grid'])
+    scan_params = {ax: np.linspace(*recipe['grid'][ax]) for ax in axes}
+    log_dir = os.path.join(workdir, name)
+    os.makedirs(log_dir, exist_ok=True)
+    sim = SimulatedDS102(axes, speed=speed, latency=latency, jitter=jitter, seed=0)
+    home = {ax: 0.0 for ax in axes}
+
+    with contextlib.ExitStack() as stack:
+        if transport == 'pty':
+            pty = stack.enter_context(PtyDS102(sim))
+            ctrl = DS102Controller(pty.port)
+        else:
+            ctrl = DS102Controller('SIM', ser=SimulatedSerial(sim))
+        stack.callback(ctrl.close)
+        camera = None
+        if recipe['camera'] == 'rayci':
+            mock = stack.enter_context(MockRayCi(camera=SimulatedCamera(BENCH_FRAME_SHAPE, scene=beam_scene(sim), seed=0)))
+            camera = RayCiCamera(mock.proxy(), mock.proxy(), os.path.join(workdir, 'rayci_frame.bmp'))
+        elif recipe['camera'] == 'simulated':
+            shape = recipe.get('shape', BENCH_FRAME_SHAPE)
+            camera = SimulatedCamera(shape, scene=beam_scene(sim, shape, recipe.get('focus_plane', False)), seed=0)
+
+        cost_model = CostModel(axes, concurrent=True)
+        start = [home[ax] for ax in axes]
+        fly = None
+        if recipe.get('fly'):
+            plan = fly = plan_fly_scan(axes, scan_params, recipe['fly'], cost_model, start=start,
+                                       limits=recipe.get('fly_limits'))
+        else:
+            plan = plan_grid_scan(axes, scan_params, cost_model, start=start)
+        stages = [(StageMotion(ctrl, home, MoveModel(speed)), {ax: i for i, ax in enumerate(axes)}, home)]
+        autofocus = Autofocus(*recipe['autofocus']) if recipe.get('autofocus') else None
+        worker = ScanWorker(axes, None if fly else plan.positions, log_dir, stages, camera, recipe['exposures'],
+                            storage=recipe['storage'], scan_params=scan_params,
+                            averager=make_averager(recipe.get('burst', 'frames')), fly=fly, autofocus=autofocus,
+                            roi=FrameROI.from_dict(recipe['roi']) if recipe.get('roi') else None)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+            worker.run()
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    events = []
+    while not worker.events.empty():
+        events.append(worker.events.get())
+    errors = [e[1] for e in events if e[0] == 'error']
+    done = next((e[1] for e in events if e[0] == 'done'), 0)
+    stats = worker.trace.stats()
+    return {
+        'recipe': name, 'transport': transport, 'points': done, 'seconds': elapsed,
+        'points_per_s': done / elapsed if elapsed else 0.0,
+        'predicted_motion_s': plan.predicted_time,
+        'serial_commands': sim.commands,
+        'peak_mb': peak / 2 ** 20,
+        'phases': {p: {'mean_ms': s['mean'] * 1e3, 'p95_ms': s['p95'] * 1e3, 'count': s['count']}
+                   for p, s in stats.items()},
+        'errors': errors,
+    }
+
+
+def max_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def format_result(r):
+    lines = [f"{r['recipe']} [{r['transport']}]: {r['points']} points in {r['seconds']:.2f} s = "
+             f"{r['points_per_s']:.1f} points/s, {r['serial_commands']} serial commands, "
+             f"peak {r['peak_mb']:.1f} MB traced"]
+    for phase in PHASES:
+        s = r['phases'].get(phase)
+        if s:
+            lines.append(f"    {phase:<12} mean {s['mean_ms']:8.2f} ms   p95 {s['p95_ms']:8.2f} ms   n={s['count']}")
+    for e in r['errors']:
+        lines.append(f"    ERROR: {e}")
+    return '\n'.join(lines)
+
+
+def compare(results, baseline, tolerance=BENCH_TOLERANCE):
+    # Recipes whose throughput fell more than `tolerance` below the baseline
+    previous = {r['recipe']: r for r in baseline.get('results', [])}
+    regressions = []
+    for r in results:
+        old = previous.get(r['recipe'])
+        if old and r['points_per_s'] < old['points_per_s'] * (1 - tolerance):
+            regressions.append(f"{r['recipe']}: {r['points_per_s']:.1f} points/s vs {old['points_per_s']:.1f} baseline")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Hardware-free scan benchmarks")
+    parser.add_argument('-r', '--recipe', action='append', choices=sorted(BENCH_RECIPES),
+                        help="recipe to run (repeatable, default: all)")
+    parser.add_argument('--transport', choices=('loopback', 'pty'), default='loopback')
+    parser.add_argument('--speed', type=float, default=SIM_SPEED, help="simulated axis speed, pulses/s")
+    parser.add_argument('--latency', type=float, default=SIM_LATENCY, help="serial reply latency, s")
+    parser.add_argument('--jitter', type=float, default=SIM_JITTER, help="serial reply jitter, s")
+    parser.add_argument('--json', help="write results to this JSON file")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=BENCH_TOLERANCE,
+                        help="allowed fractional drop in points/s before a recipe counts as regressed")
+    parser.add_argument('--keep', action='store_true', help="keep the scan output directories")
+    parser.add_argument('-v', '--verbose', action='store_true', help="show the scan engine's own output")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='scan_bench_')
+    results = []
+    try:
+        for name in args.recipe or BENCH_RECIPES:
+            result = run_recipe(name, BENCH_RECIPES[name], workdir, args.transport,
+                                args.speed, args.latency, args.jitter, args.verbose)
+            results.append(result)
+            print(format_result(result))
+    finally:
+        if args.keep:
+            print(f"Scan output kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    rss = max_rss_mb()
+    if rss is not None:
+        print(f"Max RSS {rss:.0f} MB")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'results': results, 'max_rss_mb': rss, 'time': time.strftime("%Y-%m-%dT%H:%M:%S")}, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            return 1
+    return 1 if any(r['errors'] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
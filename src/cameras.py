@@ -0,0 +1,209 @@
+import os
+import tempfile
+import threading
+import time
+import xmlrpc.client
+import numpy as np
+
+from preview import load_frame
+from scan_options import CAMERA_BACKENDS
+
+RAYCI_URL = "http://localhost:8080/"
+
+# Pixelink default for the scan GUIs; the frame geometry is probed from the stream
+PIXELINK_CAMERA = "PixelLINK USB3 Camera Release 4"
+
+
+def get_rayci_proxy():
+    return xmlrpc.client.ServerProxy(RAYCI_URL)
+
+
+class Exposure:
+    # One latched acquisition of `count` frames; frames is None until the backend delivers them
+    def __init__(self, count=1, frames=None, **metadata):
+        self.count = count
+        self.frames = frames
+        self.path = None
+        self.metadata = {'timestamp': time.time(), 'exposures': count, **metadata}
+
+
+class CameraBackend:
+    """
+    Common camera interface for the scan engine.
+
+    latch(count) takes `count` exposures while the stage is at rest and may return
+    before the pixel data is available; read(exposure) then delivers the frames
+    ((h, w) for a single exposure, (count, h, w) otherwise) and may run on a worker
+    thread while the stage moves; a failed capture raises. save_native() lets backends that can write a BMP
+    themselves skip the array round trip. Every latched exposure ends with release().
+    """
+    name = 'camera'
+
+    def latch(self, count=1):
+        raise NotImplementedError
+
+    def read(self, exposure):
+        return exposure.frames
+
+    def save_native(self, exposure, filename):
+        return False
+
+    def release(self, exposure):
+        pass
+
+    def acquire(self):
+        return self.acquire_many(1)
+
+    def acquire_many(self, k):
+        exposure = self.latch(k)
+        if exposure is None:
+            raise RuntimeError(f"{self.name} capture failed")
+        try:
+            return self.read(exposure), exposure.metadata
+        finally:
+            self.release(exposure)
+
+    def close(self):
+        pass
+
+
+class RayCiCamera(CameraBackend):
+    """
+    RayCi over XML-RPC. newSingle latches the measurement; the frame is only available
+    through exportView of the current view, so the next latch waits until the previous
+    exposure was exported. The export side uses its own proxy (ServerProxy is not
+    thread-safe).
+    """
+    name = 'rayci'
+
+    def __init__(self, rayci=None, export_rayci=None, temp_path=None):
+        self.rayci = rayci or get_rayci_proxy()
+        self.export_rayci = export_rayci or get_rayci_proxy()
+        self.temp_path = temp_path or os.path.join(tempfile.gettempdir(), f"rayci_frame_{os.getpid()}.bmp")
+        self.view_free = threading.Event()
+        self.view_free.set()
+
+    def _export(self, rayci, filename):
+        rayci.RayCi.LiveMode.TwoD.View.exportView(0, filename)
+
+    def latch(self, count=1):
+        self.view_free.wait()
+        self.view_free.clear()
+        try:
+            self.rayci.RayCi.LiveMode.Measurement.newSingle()
+            if count == 1:
+                # The view stays busy until this exposure is exported
+                return Exposure(1, backend=self.name)
+            # Bursts have to be exported one by one before the view is overwritten
+            frames = [load_frame(self._export_temp(self.rayci))]
+            for _ in range(count - 1):
+                self.rayci.RayCi.LiveMode.Measurement.newSingle()
+                frames.append(load_frame(self._export_temp(self.rayci)))
+            self.view_free.set()
+            return Exposure(count, np.stack(frames), backend=self.name)
+        except Exception as e:
+            self.view_free.set()
+            raise RuntimeError(f"RayCi image capture failed: {e}") from e
+
+    def _export_temp(self, rayci):
+        self._export(rayci, self.temp_path)
+        return self.temp_path
+
+    def save_native(self, exposure, filename):
+        if exposure.frames is not None or exposure.path is not None:
+            return False
+        try:
+            self._export(self.export_rayci, filename)
+            print(f"Saved image to {filename}")
+        finally:
+            self.view_free.set()
+        exposure.path = filename
+        return True
+
+    def read(self, exposure):
+        if exposure.frames is None:
+            if exposure.path is None:
+                try:
+                    exposure.path = self._export_temp(self.export_rayci)
+                    exposure.frames = load_frame(exposure.path)
+                finally:
+                    self.view_free.set()
+            else:
+                exposure.frames = load_frame(exposure.path)
+        return exposure.frames
+
+    def release(self, exposure):
+        self.view_free.set()
+
+
+class PixelinkBackend(CameraBackend):
+    """
+    Streams from one persistent ffmpegPxL session (see PixelinkStream). The camera
+    free-runs, so a reader thread drains the pipe and latch() waits for frames that
+    started arriving after it was called, i.e. after the stage settled, instead of
+    taking one that was buffered during the move.
+    """
+    name = 'pixelink'
+
+    def __init__(self, stream=None):
+        if stream is None:
+            from pixelink_gui_capture import PixelinkStream
+            stream = PixelinkStream(PIXELINK_CAMERA)
+        self.stream = stream.follow()
+
+    def latch(self, count=1):
+        t = time.perf_counter()
+        if count == 1:
+            return Exposure(1, self.stream.grab_after(t), backend=self.name)
+        return Exposure(count, self.stream.grab_after(t, count), backend=self.name)
+
+    def close(self):
+        self.stream.stop()
+
+
+class SimulatedCamera(CameraBackend):
+    """
+    Synthetic Gaussian beam with Gaussian read noise for running scans without hardware.
+    `scene` may be a callable returning (cx, cy, sigma_x, sigma_y, peak) to couple the
+    beam to e.g. a simulated stage position.
+    """
+    name = 'simulated'
+
+    def __init__(self, shape=(504, 632), center=None, sigma=(30.0, 20.0), peak=200.0,
+                 background=5.0, noise=2.0, exposure_time=0.0, scene=None, seed=None):
+        self.shape = shape
+        self.center = center or (shape[1] / 2, shape[0] / 2)
+        self.sigma = sigma
+        self.peak = peak
+        self.background = background
+        self.noise = noise
+        self.exposure_time = exposure_time
+        self.scene = scene
+        self.rng = np.random.default_rng(seed)
+        self._x = np.arange(shape[1], dtype=np.float32)[None, :]
+        self._y = np.arange(shape[0], dtype=np.float32)[:, None]
+
+    def frame(self):
+        cx, cy, sx, sy, peak = self.scene() if self.scene else (*self.center, *self.sigma, self.peak)
+        img = np.exp(-0.5 * ((self._x - cx) / sx) ** 2) * np.exp(-0.5 * ((self._y - cy) / sy) ** 2)
+        img = img * peak + self.background
+        if self.noise:
+            img += self.rng.normal(0.0, self.noise, self.shape).astype(np.float32)
+        return np.clip(img, 0, 255).astype(np.uint8)
+
+    def latch(self, count=1):
+        if self.exposure_time:
+            time.sleep(self.exposure_time * count)
+        if count == 1:
+            return Exposure(1, self.frame(), backend=self.name)
+        return Exposure(count, np.stack([self.frame() for _ in range(count)]), backend=self.name)
+
+
+def make_camera(name):
+    if name == 'rayci':
+        return RayCiCamera()
+    if name == 'pixelink':
+        return PixelinkBackend()
+    if name == 'simulated':
+        return SimulatedCamera()
+    raise ValueError(f"Unknown camera backend: {name}")
@@ -0,0 +1,99 @@
+import atexit
+import threading
+
+BAUDRATE = 38400
+SERIAL_TIMEOUT = 0.5
+REPLY_TERMINATOR = b'\n'
+
+
+class DS102Controller:
+    """
+    One long-lived connection to a DS102 controller. The port is opened once and
+    every command/reply exchange holds the lock, so origin reads, scans and jog
+    moves can share the same controller.
+    """
+    def __init__(self, port, baudrate=BAUDRATE, timeout=SERIAL_TIMEOUT, ser=None):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.lock = threading.RLock()
+        self._ser = ser
+
+    def open(self):
+        with self.lock:
+            if self._ser is None:
+                import serial
+                self._ser = serial.Serial(self.port, baudrate=self.baudrate, timeout=self.timeout)
+            return self._ser
+
+    def close(self):
+        with self.lock:
+            if self._ser is not None:
+                try:
+                    self._ser.close()
+                finally:
+                    self._ser = None
+
+    def write(self, cmd):
+        with self.lock:
+            self.open().write(f'{cmd}\r'.encode('ascii'))
+
+    def query(self, cmd):
+        with self.lock:
+            ser = self.open()
+            # Drop stale replies (e.g. from an interrupted exchange) instead of sleeping
+            if ser.in_waiting:
+                ser.reset_input_buffer()
+            ser.write(f'{cmd}\r'.encode('ascii'))
+            resp = ser.read_until(REPLY_TERMINATOR)
+            if not resp.endswith(REPLY_TERMINATOR):
+                raise TimeoutError(f"No reply to {cmd!r} from {self.port}")
+            return resp.decode('ascii').strip()
+
+    def goabs(self, axis, pulse):
+        self.write(f'AXI{axis}:GOABS {int(pulse)}')
+
+    def motion(self, axis):
+        return self.query(f'AXI{axis}:MOTION?')
+
+    def get_position(self, axis):
+        return self.query(f'AXI{axis}:POS?')
+
+    def get_positions(self, axes):
+        # Same format the GUIs use for origins: integer pulse string or 'NA'
+        try:
+            self.open()
+        except Exception:
+            # Unplugged or busy port: no point trying every axis
+            return {axis: 'NA' for axis in axes}
+        positions = {}
+        for axis in axes:
+            try:
+                resp = self.get_position(axis)
+                try:
+                    positions[axis] = str(int(float(resp)))
+                except ValueError:
+                    positions[axis] = resp or 'NA'
+            except Exception:
+                positions[axis] = 'NA'
+        return positions
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def get_controller(port):
+    with _controllers_lock:
+        if port not in _controllers:
+            _controllers[port] = DS102Controller(port)
+        return _controllers[port]
+
+
+def close_all():
+    with _controllers_lock:
+        for ctrl in _controllers.values():
+            ctrl.close()
+
+
+atexit.register(close_all)
@@ -0,0 +1,186 @@
+import os
+import random
+import re
+import threading
+import time
+
+SIM_SPEED = 2000.0      # pulses per second
+SIM_LATENCY = 0.002     # seconds from command to reply
+SIM_JITTER = 0.0005     # +/- uniform jitter on the reply latency
+SIM_OVERHEAD = 0.02     # acceleration / settling per move, seconds
+
+_COMMAND = re.compile(r'AXI(\w+):(GOABS\s+(-?\d+)|MOTION\?|POS\?)')
+
+
+class SimulatedDS102:
+    """
+    DS102 controller model speaking the subset of the serial protocol the scan code
+    uses: AXI{n}:GOABS {pulse} (no reply), AXI{n}:MOTION? (1 while moving, else 0)
+    and AXI{n}:POS? (current position, interpolated along the move). Every axis moves
+    independently at `speed` pulses/s after a fixed `overhead`.
+    """
+    def __init__(self, axes=('X', 'Y', 'Z', 'U', 'V', 'W'), speed=SIM_SPEED, latency=SIM_LATENCY,
+                 jitter=SIM_JITTER, overhead=SIM_OVERHEAD, positions=None, seed=None):
+        self.speed = float(speed)
+        self.latency = float(latency)
+        self.jitter = float(jitter)
+        self.overhead = float(overhead)
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        # axis -> (start position, target, start time, end time)
+        self.moves = {ax: (0, 0, 0.0, 0.0) for ax in axes}
+        for ax, pos in (positions or {}).items():
+            self.moves[ax] = (int(pos), int(pos), 0.0, 0.0)
+        self.commands = 0
+
+    def position(self, axis, now=None):
+        start, target, t0, t1 = self.moves[axis]
+        now = time.monotonic() if now is None else now
+        if now >= t1:
+            return target
+        frac = max(now - t0 - self.overhead, 0.0) / max(t1 - t0 - self.overhead, 1e-9)
+        return int(round(start + (target - start) * frac))
+
+    def positions(self):
+        with self.lock:
+            return {ax: self.position(ax) for ax in self.moves}
+
+    def reply_delay(self):
+        return max(self.latency + self.rng.uniform(-self.jitter, self.jitter), 0.0)
+
+    def handle(self, line, now=None):
+        # Reply (without terminator) for one command line, or None; `now` is when it reaches the controller
+        m = _COMMAND.fullmatch(line.strip())
+        if not m:
+            return None
+        axis, cmd = m.group(1), m.group(2)
+        with self.lock:
+            self.commands += 1
+            if axis not in self.moves:
+                return 'NA' if cmd.endswith('?') else None
+            now = time.monotonic() if now is None else now
+            if cmd.startswith('GOABS'):
+                start = self.position(axis, now)
+                target = int(m.group(3))
+                duration = self.overhead + abs(target - start) / self.speed if target != start else 0.0
+                self.moves[axis] = (start, target, now, now + duration)
+                return None
+            if cmd == 'MOTION?':
+                return '1' if now < self.moves[axis][3] else '0'
+            return str(self.position(axis, now))
+
+
+class SimulatedSerial:
+    """
+    In-process loopback with the part of the pyserial API DS102Controller uses
+    (write, read_until, in_waiting, reset_input_buffer, close). Commands reach the
+    controller half way through the simulated latency and replies become readable
+    at its end; read_until gives up after `timeout`.
+    """
+    def __init__(self, sim, timeout=0.5):
+        self.sim = sim
+        self.timeout = timeout
+        self.pending = []       # (ready time, bytes)
+        self.buffer = b''
+
+    def write(self, data):
+        for line in data.decode('ascii').split('\r'):
+            if not line:
+                continue
+            now = time.monotonic()
+            delay = self.sim.reply_delay()
+            reply = self.sim.handle(line, now + delay / 2)
+            if reply is not None:
+                self.pending.append((now + delay, f'{reply}\r\n'.encode('ascii')))
+        return len(data)
+
+    def _collect(self, wait_until=None):
+        # Move arrived replies into the buffer; with wait_until, sleep for the next one
+        now = time.monotonic()
+        if wait_until is not None and self.pending and now < self.pending[0][0] <= wait_until:
+            time.sleep(self.pending[0][0] - now)
+            now = time.monotonic()
+        while self.pending and self.pending[0][0] <= now:
+            self.buffer += self.pending.pop(0)[1]
+
+    @property
+    def in_waiting(self):
+        self._collect()
+        return len(self.buffer)
+
+    def reset_input_buffer(self):
+        self._collect()
+        self.buffer = b''
+
+    def read_until(self, expected=b'\n'):
+        deadline = time.monotonic() + self.timeout
+        self._collect()
+        while expected not in self.buffer:
+            if not self.pending or self.pending[0][0] > deadline:
+                # Nothing (more) arrives in time; behave like a serial timeout
+                time.sleep(max(deadline - time.monotonic(), 0.0))
+                break
+            self._collect(deadline)
+        if expected in self.buffer:
+            i = self.buffer.index(expected) + len(expected)
+            data, self.buffer = self.buffer[:i], self.buffer[i:]
+            return data
+        data, self.buffer = self.buffer, b''
+        return data
+
+    def close(self):
+        pass
+
+
+class PtyDS102:
+    """
+    Serves a SimulatedDS102 on a pseudo-terminal (Linux/macOS), so the real
+    pyserial code path can be exercised: DS102Controller(PtyDS102(sim).start().port).
+    """
+    def __init__(self, sim):
+        self.sim = sim
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.thread = None
+
+    def start(self):
+        import tty
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.thread = threading.Thread(target=self._serve, name='ds102-sim', daemon=True)
+        self.thread.start()
+        return self
+
+    def _serve(self):
+        buf = b''
+        while True:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            while b'\r' in buf:
+                line, buf = buf.split(b'\r', 1)
+                reply = self.sim.handle(line.decode('ascii', 'replace'))
+                if reply is not None:
+                    time.sleep(self.sim.reply_delay())
+                    os.write(self.master, f'{reply}\r\n'.encode('ascii'))
+
+    def stop(self):
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.master = self.slave = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
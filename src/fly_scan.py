@@ -0,0 +1,236 @@
+import time
+import numpy as np
+
+from motion import POLL_MIN, is_moving
+from scan_path import CostModel, format_duration, plan_grid_scan
+from scan_options import FLY_TRIGGERS
+
+FLY_RUN_UP_TIME = 0.05      # seconds of fast-axis travel before the first / after the last trigger
+FLY_TRIGGER_LEAD = 0.002    # a crossing predicted closer than this is latched at once, not slept for
+FLY_READ_INTERVAL = 0.02    # the fast axis is read at least this often during a sweep
+FLY_TOLERANCE = 0.5         # a trigger passed by more than this fraction of a step is left for the next pass
+FLY_STALL_FACTOR = 3.0      # sweep may take this many times the model's estimate before it counts as stalled
+FLY_STALL_MARGIN = 2.0
+
+
+class FlyScanPlan:
+    """
+    Fly scan over a grid: the fast axis sweeps each line without stopping while the
+    slow axes step between lines in the cheapest grid order. Each pass over a line
+    starts from the end the fast axis is already at, so consecutive lines run in
+    alternate directions and the only turnaround is the run-up margin on either end
+    (time for the axis to reach speed). Triggers the camera could not keep up with
+    are picked up by further passes in alternating directions, or stop-and-go when
+    that is cheaper for the few that are left.
+    limits: (lo, hi) travel range of the fast axis in pulses; run-up and run-out are
+    clamped to it. Without limits they stay within the scanned range itself, so a fly
+    scan never drives the axis past what the user asked for (frames near the ends
+    are then latched while the axis accelerates, still tagged from its readback).
+    lines() yields (base point, trigger positions, plan indices); the base point
+    carries the slow axes, its fast column is set per frame.
+    """
+    def __init__(self, axes, scan_params, fast_axis, cost_model=None, start=None, run_up=None,
+                 trigger='position', limits=None):
+        if trigger not in FLY_TRIGGERS:
+            raise ValueError(f"Unknown fly-scan trigger: {trigger}")
+        self.axes = list(axes)
+        self.fast_axis = fast_axis
+        self.fast_col = self.axes.index(fast_axis)
+        self.fast_grid = np.asarray(scan_params[fast_axis], dtype=float)
+        if len(self.fast_grid) < 2:
+            raise ValueError(f"Fly-scan axis {fast_axis} must be scanned")
+        self.cost_model = cost_model or CostModel(self.axes)
+        self.trigger = trigger
+        self.fast_cost = self.cost_model.axis_costs[self.fast_col]
+        self.run_up = self.fast_cost.speed * FLY_RUN_UP_TIME if run_up is None else float(run_up)
+        lo, hi = self.fast_grid.min(), self.fast_grid.max()
+        self.limits = (float(lo), float(hi)) if limits is None else tuple(sorted(float(v) for v in limits))
+        if lo < self.limits[0] or hi > self.limits[1]:
+            raise ValueError(f"Fly-scan range of {fast_axis} ({lo:g}..{hi:g}) is outside its travel limits "
+                             f"({self.limits[0]:g}..{self.limits[1]:g})")
+        self.tolerance = FLY_TOLERANCE * self.step()
+        # The slow axes keep their own best order; the fast column is pinned to its first value
+        slow_params = dict(scan_params)
+        slow_params[fast_axis] = self.fast_grid[:1]
+        self.slow = plan_grid_scan(self.axes, slow_params, self.cost_model, start=start)
+        self.start = start
+        self.predicted_time = self.slow.predicted_time + len(self.slow) * self.sweep_time()
+
+    def __len__(self):
+        return len(self.slow) * len(self.fast_grid)
+
+    def step(self):
+        return abs(self.fast_grid[-1] - self.fast_grid[0]) / (len(self.fast_grid) - 1)
+
+    def lines(self):
+        n = len(self.fast_grid)
+        for k, base in enumerate(self.slow.positions):
+            yield np.array(base, dtype=float), self.fast_grid, k * n + np.arange(n)
+
+    def margins(self, lo, hi):
+        # Run-up / run-out ends around the trigger span [lo, hi], clamped to the travel limits
+        return max(lo - self.run_up, self.limits[0]), min(hi + self.run_up, self.limits[1])
+
+    def pass_ends(self, triggers, at=None):
+        # (run-up start, run-out stop, trigger order) for one pass, starting at the end nearer `at`
+        order = np.argsort(triggers, kind='stable')
+        lo, hi = self.margins(triggers[order[0]], triggers[order[-1]])
+        if at is not None and abs(at - hi) < abs(at - lo):
+            return hi, lo, order[::-1]
+        return lo, hi, order
+
+    def sweep_time(self, triggers=None):
+        # One pass over a line (or the span of `triggers`) at controller speed, run-up and run-out included
+        triggers = self.fast_grid if triggers is None else triggers
+        lo, hi = self.margins(np.min(triggers), np.max(triggers))
+        return float(self.fast_cost.move_times([hi - lo])[0])
+
+    def step_time(self, triggers, at):
+        # Stop-and-go time for the triggers in the given order, starting at `at`
+        path = np.concatenate([[triggers[0] if at is None else at], triggers])
+        return float(self.fast_cost.move_times(np.diff(path)).sum())
+
+    def frame_interval(self):
+        # Time between triggers at controller speed; a slower camera needs extra passes
+        return self.step() / self.fast_cost.speed
+
+    def summary(self):
+        return (f"{len(self)} frames in {len(self.slow)} lines along {self.fast_axis} ({self.trigger} triggers, "
+                f"{self.frame_interval() * 1e3:.0f} ms apart), est. motion {format_duration(self.predicted_time)}")
+
+
+def plan_fly_scan(axes, scan_params, fast_axis=None, cost_model=None, start=None, run_up=None, trigger='position',
+                  limits=None):
+    # Default fast axis: the scanned axis with the most points
+    if fast_axis is None:
+        fast_axis = max(axes, key=lambda ax: len(scan_params[ax]))
+    return FlyScanPlan(axes, scan_params, fast_axis, cost_model, start, run_up, trigger, limits)
+
+
+class PositionTrack:
+    """
+    Timestamped POS? readings of the fast axis during one sweep. Each reading is
+    stamped with the middle of its query, so positions in between can be
+    interpolated for any time, e.g. the middle of a camera latch.
+    """
+    def __init__(self, ctrl, axis):
+        self.ctrl = ctrl
+        self.axis = axis
+        self.times = []
+        self.values = []
+
+    def read(self):
+        t = time.perf_counter()
+        resp = self.ctrl.get_position(self.axis)
+        t = (t + time.perf_counter()) / 2
+        pos = float(resp)
+        self.times.append(t)
+        self.values.append(pos)
+        return t, pos
+
+    def velocity(self):
+        # pulses/s from the last two readings
+        if len(self.times) < 2 or self.times[-1] <= self.times[-2]:
+            return 0.0
+        return (self.values[-1] - self.values[-2]) / (self.times[-1] - self.times[-2])
+
+    def at(self, t):
+        return float(np.interp(t, self.times, self.values))
+
+
+def sweep(ctrl, axis, stop, triggers, capture, deliver, model_time, tolerance=0.0, trigger='position', model=None):
+    """
+    Start the fast axis towards `stop` and call capture(j) as it crosses triggers[j].
+    'position' triggers extrapolate the crossing from the axis readings (read at
+    least every FLY_READ_INTERVAL); 'time' triggers fire at the crossing times the
+    move model predicts. Crossings less than FLY_TRIGGER_LEAD away are latched at
+    once. capture(j) returns (t0, t1, frame) for its latch, or None to stop early.
+    Frames are tagged with the position interpolated at the middle of their latch
+    once a later reading brackets it, and handed to deliver(j, position, frame) in
+    order. Triggers the axis passed by more than
+    `tolerance` while the camera was busy are skipped. Returns the indices of the
+    triggers taken.
+    """
+    track = PositionTrack(ctrl, axis)
+    _, start = track.read()
+    direction = 1.0 if stop >= start else -1.0
+    ctrl.goabs(axis, int(round(stop)))
+    t_go = time.perf_counter()
+    deadline = t_go + FLY_STALL_FACTOR * model_time + FLY_STALL_MARGIN
+    speed, overhead = model.axis_params(axis) if model is not None else (None, 0.0)
+    timed = trigger == 'time' and speed
+    taken = []
+    pending = []            # (trigger index, latch middle, frame) waiting for a bracketing reading
+    # Aim the middle of the latch, not its start, at the trigger
+    half_latch = 0.0
+
+    def read():
+        t, pos = track.read()
+        while pending and pending[0][1] <= t:
+            j, t_mid, frame = pending.pop(0)
+            deliver(j, track.at(t_mid), frame)
+        return t, pos
+
+    j = 0
+    reread = False
+    try:
+        while j < len(triggers):
+            now = time.perf_counter()
+            if now > deadline:
+                raise TimeoutError(f"Fly-scan axis {axis} stalled before trigger {j + 1} of {len(triggers)}")
+            stale = reread or now - track.times[-1] > FLY_READ_INTERVAL
+            reread = False
+            if timed:
+                due = t_go + overhead + abs(triggers[j] - start) / speed - half_latch
+                if now > due + tolerance / speed:
+                    j += 1
+                    continue
+                if stale:
+                    read()
+                    continue
+                if due - now > FLY_TRIGGER_LEAD:
+                    time.sleep(due - now)
+            else:
+                v = direction * track.velocity()
+                if stale or v <= 0:
+                    read()
+                    v = direction * track.velocity()
+                t_read, pos = track.times[-1], track.values[-1]
+                # Where the axis is now, not when it was read
+                ahead = direction * pos + max(v, 0.0) * (time.perf_counter() - t_read)
+                while j < len(triggers) and direction * triggers[j] - ahead < -tolerance:
+                    # Passed while the camera was busy; left for the next pass
+                    j += 1
+                if j == len(triggers):
+                    break
+                remaining = direction * triggers[j] - ahead
+                if remaining > 0:
+                    if v <= 0:
+                        # Not moving yet (start overhead) or stopped short of the trigger
+                        if len(track.times) > 2 and track.values[-1] == track.values[-2] and not is_moving(ctrl, axis):
+                            raise TimeoutError(f"Fly-scan axis {axis} stopped at {pos:.0f} before trigger {j + 1}")
+                        time.sleep(POLL_MIN)
+                        continue
+                    dt = remaining / v - half_latch
+                    if dt > FLY_READ_INTERVAL:
+                        # Far from the crossing: sleep half way, then read again
+                        time.sleep(dt / 2)
+                        reread = True
+                        continue
+                    if dt > FLY_TRIGGER_LEAD:
+                        # Shorter waits would overshoot by about as much as they wait
+                        time.sleep(dt)
+            latched = capture(j)
+            if latched is None:
+                break
+            t0, t1, frame = latched
+            half_latch = (t1 - t0) / 2
+            pending.append((j, (t0 + t1) / 2, frame))
+            taken.append(j)
+            j += 1
+        read()
+    finally:
+        # Frames latched before an error still get delivered (and released), tagged from the readings so far
+        for j, t_mid, frame in pending:
+            deliver(j, track.at(t_mid), frame)
+    return taken
@@ -0,0 +1,147 @@
+import json
+import os
+import threading
+import numpy as np
+
+from beam_metrics import BeamAnalyzer
+
+# 'full' keeps the sensor view (binning still applies), 'manual' a fixed window,
+# 'track' a window of fixed size centred on the beam of the previous frame
+ROI_MODES = ('full', 'manual', 'track')
+ROI_FILE = 'roi.json'
+
+
+def beam_center(frame, analyzer):
+    # (x, y) beam centroid from BeamAnalyzer, in frame pixels; None without a beam
+    m = analyzer.analyze(frame)
+    if m['total_power'] <= 0:
+        return None
+    return m['centroid_x'], m['centroid_y']
+
+
+class FrameROI:
+    """
+    Crops and bins frames before they are stored, previewed or analysed. size and
+    offset are (width, height) and (x, y) in sensor pixels; binning averages
+    binning x binning blocks (integer frames stay integer). The window keeps its size
+    and is shifted, not shrunk, at the sensor edges, so every frame of a scan has
+    the same shape (as the HDF5 store needs). In 'track' mode the first frame is
+    searched for the beam on the full sensor (the window starts at offset if there
+    is none) and the window then follows the centroid of each processed frame; when
+    the beam is lost it stays where it was.
+    apply() returns the cut frames with the window (x0, y0, x1, y1) they came from.
+    """
+    def __init__(self, mode='full', size=None, offset=(0, 0), binning=1):
+        if mode not in ROI_MODES:
+            raise ValueError(f"Unknown ROI mode: {mode}")
+        if mode != 'full' and (not size or min(size) < 1):
+            raise ValueError(f"ROI mode '{mode}' needs a width and height")
+        if int(binning) != binning or binning < 1:
+            raise ValueError("Binning must be an integer >= 1")
+        self.mode = mode
+        self.size = tuple(int(v) for v in size) if size else None
+        self.offset = tuple(int(v) for v in offset or (0, 0))
+        self.binning = int(binning)
+        self.sensor_shape = None
+        self.center = None
+        self.analyzer = BeamAnalyzer() if mode == 'track' else None
+        self.lock = threading.Lock()
+
+    @property
+    def active(self):
+        return self.mode != 'full' or self.binning > 1
+
+    def window(self, sensor_shape):
+        h, w = sensor_shape
+        if self.mode == 'full':
+            x0, y0, rw, rh = 0, 0, w, h
+        else:
+            rw, rh = min(self.size[0], w), min(self.size[1], h)
+            if self.mode == 'track' and self.center is not None:
+                x0, y0 = int(round(self.center[0] - rw / 2)), int(round(self.center[1] - rh / 2))
+            else:
+                x0, y0 = self.offset
+            x0, y0 = min(max(x0, 0), w - rw), min(max(y0, 0), h - rh)
+        # Whole bins only
+        b = self.binning
+        return x0, y0, x0 + rw - rw % b, y0 + rh - rh % b
+
+    def cut(self, frames, window, lead=0):
+        # Crop (and bin) the spatial axes that follow `lead` leading axes (1 for a burst)
+        x0, y0, x1, y1 = window
+        cut = frames[(slice(None),) * lead + (slice(y0, y1), slice(x0, x1))]
+        b = self.binning
+        if b == 1:
+            return cut
+        h, w = (y1 - y0) // b, (x1 - x0) // b
+        binned = cut.reshape(cut.shape[:lead] + (h, b, w, b) + cut.shape[lead + 2:]).mean(axis=(lead + 1, lead + 3))
+        return np.rint(binned).astype(cut.dtype) if cut.dtype.kind in 'ui' else binned.astype(cut.dtype)
+
+    def apply(self, frames, count=1, stats=None):
+        frames = np.asarray(frames)
+        lead = 1 if count > 1 else 0
+        with self.lock:
+            self.sensor_shape = frames.shape[lead:lead + 2]
+            if self.mode == 'track' and self.center is None:
+                self.center = beam_center(frames[0] if lead else frames, self.analyzer) or (
+                    self.offset[0] + self.size[0] / 2, self.offset[1] + self.size[1] / 2)
+            window = self.window(self.sensor_shape)
+        out = self.cut(frames, window, lead)
+        if stats:
+            stats = {name: self.cut(data, window) for name, data in stats.items()}
+        if self.mode == 'track':
+            self.follow(out[0] if lead else out, window)
+        return out, stats, window
+
+    def follow(self, frame, window):
+        with self.lock:
+            center = beam_center(frame, self.analyzer)
+            if center is not None:
+                self.center = self.to_sensor_xy(center, window)
+
+    def to_sensor_xy(self, xy, window):
+        # Binned ROI pixel coordinates -> sensor pixel coordinates
+        b = self.binning
+        return window[0] + (xy[0] + 0.5) * b - 0.5, window[1] + (xy[1] + 0.5) * b - 0.5
+
+    def to_sensor(self, metrics, window):
+        # Beam metrics of a cut frame in sensor pixels, comparable across windows
+        metrics = dict(metrics)
+        metrics['centroid_x'], metrics['centroid_y'] = self.to_sensor_xy((metrics['centroid_x'], metrics['centroid_y']), window)
+        metrics['d4s_x'] *= self.binning
+        metrics['d4s_y'] *= self.binning
+        # Bins hold the mean of their pixels; powers are sums over sensor pixels
+        metrics['total_power'] *= self.binning ** 2
+        metrics['roi_power'] *= self.binning ** 2
+        return metrics
+
+    def to_dict(self):
+        return {'mode': self.mode, 'size': list(self.size) if self.size else None, 'offset': list(self.offset),
+                'binning': self.binning}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d.get('mode', 'full'), d.get('size'), d.get('offset', (0, 0)), d.get('binning', 1))
+
+    def geometry(self):
+        # Settings plus the full sensor shape (height, width); the per-frame windows go to the journal / HDF5 store
+        return {**self.to_dict(), 'sensor_shape': [int(v) for v in self.sensor_shape or ()]}
+
+    def write_geometry(self, log_dir):
+        with open(os.path.join(log_dir, ROI_FILE), 'w') as f:
+            json.dump(self.geometry(), f, indent=1)
+
+
+def parse_roi(mode, text='', binning=1):
+    """
+    FrameROI from GUI fields: text is 'x, y, width, height' for 'manual' and
+    'width, height' (or 'x, y, width, height', see FrameROI) for 'track'.
+    """
+    values = [int(float(v)) for v in text.replace(',', ' ').split()] if text.strip() else []
+    if mode == 'full':
+        return FrameROI('full', binning=binning)
+    if mode == 'track' and len(values) == 2:
+        return FrameROI('track', values, binning=binning)
+    if len(values) != 4:
+        raise ValueError(f"ROI '{mode}' expects x, y, width, height")
+    return FrameROI(mode, values[2:], values[:2], binning)
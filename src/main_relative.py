@@ -1,74 +1,16 @@
 import tkinter as tk
 from tkinter import ttk, messagebox
-import serial
-import time
-import numpy as np
-import os
-import datetime
-import xmlrpc.client
-from PIL import Image, ImageTk
+from motion import wait_for_axes
+from ds102 import get_controller
+from cameras import CAMERA_BACKENDS
+from scan_store import STORAGE_MODES
+from autofocus import FOCUS_AXIS, FOCUS_METRICS
+from frame_roi import ROI_MODES
+from beam_metrics import SCORE_METRICS
+from frame_average import BURST_MODES
+from scan_control import ScanControlMixin
 
 SERIAL_PORT = 'COM3'
-BAUDRATE = 38400
-
-def get_all_positions():
-    axis_names = ['X', 'Y', 'Z', 'U', 'V', 'W']
-    positions = {}
-    try:
-        ser = serial.Serial(SERIAL_PORT, baudrate=BAUDRATE, timeout=0.5)
-        for axis in axis_names:
-            try:
-                ser.reset_input_buffer()
-                ser.reset_output_buffer()
-                cmd = f'AXI{axis}:POS?\r'
-                ser.write(cmd.encode('ascii'))
-                time.sleep(0.1)
-                resp = ser.readline().decode('ascii').strip()
-                if resp:
-                    try:
-                        positions[axis] = str(int(float(resp)))
-                    except ValueError:
-                        positions[axis] = resp
-                else:
-                    positions[axis] = 'NA'
-            except Exception:
-                positions[axis] = 'NA'
-        ser.close()
-    except Exception:
-        for axis in axis_names:
-            positions[axis] = 'NA'
-    return positions
-
-def move_axis_to(ser, axis, pos):
-    try:
-        cmd = f'AXI{axis}:GOABS {int(round(float(pos)))}\r'
-        ser.write(cmd.encode('ascii'))
-        # Wait for axis to finish moving
-        while True:
-            ser.write(f'AXI{axis}:MOTION?\r'.encode('ascii'))
-            resp = ser.readline().decode('ascii').strip()
-            if resp == '0':
-                break
-            time.sleep(0.05)
-    except Exception as e:
-        print(f"Error moving axis {axis}: {e}")
-
-def get_rayci_proxy():
-    try:
-        server_url = "http://localhost:8080/"
-        rayci = xmlrpc.client.ServerProxy(server_url)
-        return rayci
-    except Exception as e:
-        messagebox.showerror("RayCi Error", str(e))
-        return None
-
-def capture_bmp(rayci, filename):
-    try:
-        result = rayci.RayCi.LiveMode.Measurement.newSingle()
-        export_result = rayci.RayCi.LiveMode.TwoD.View.exportView(0, filename)
-        print(f"Saved image to {filename}")
-    except Exception as e:
-        print(f"RayCi image capture failed: {e}")
 
 class UnitSetDialog(tk.Toplevel):
     def __init__(self, master):
@@ -114,34 +56,33 @@ class UnitSetDialog(tk.Toplevel):
             self.info_label.config(text="")
 
     def run_move(self):
+        if self.master.scan_worker is not None:
+            messagebox.showwarning("Unit Set", "A scan is running; wait for it to finish before moving axes by hand.")
+            return
         axis = self.axis_var.get()
         val = self.move_val.get()
         try:
-            ser = serial.Serial(SERIAL_PORT, baudrate=BAUDRATE, timeout=0.5)
-            cmd = f'AXI{axis}:GOABS {int(round(val))}\r'
-            ser.write(cmd.encode('ascii'))
-            while True:
-                ser.write(f'AXI{axis}:MOTION?\r'.encode('ascii'))
-                resp = ser.readline().decode('ascii').strip()
-                if resp == '0':
-                    break
-                time.sleep(0.05)
-            ser.close()
+            ctrl = get_controller(SERIAL_PORT)
+            ctrl.goabs(axis, int(round(val)))
+            wait_for_axes(ctrl, [axis])
+            self.master.refresh_origins()
             messagebox.showinfo("Unit Set", f"Moved {axis} to {val} {self.unit_var.get()}")
         except Exception as e:
             messagebox.showerror("Unit Set Error", str(e))
 
-class ScanGUI(tk.Tk):
+class ScanGUI(ScanControlMixin, tk.Tk):
     def __init__(self):
         super().__init__()
         self.title("DS102 Multi-Axis Scan & RayCi Image Capture")
         self.geometry("1300x600")
         self.axis_names = ['X', 'Y', 'Z', 'U', 'V', 'W']
-        self.entries = {}
-        self.check_vars = {}
+        self.entries = {'DUT': {}}
+        self.check_vars = {'DUT': {}}
+        self.init_scan_control()
 
-        # Query all origins ONCE at startup using robust code
-        self.origin_vals = get_all_positions()
+        # Last known origins show at once (grey); the controller is read in the
+        # background and the entries turn black once the live values arrive
+        self.origin_vals, _ = self.origin_fetcher.cached(SERIAL_PORT, self.axis_names)
 
         # GUI Header
         header = ["Axis", "Enable", "Origin", "Start (μm)", "Stop (μm)", "Step (count)"]
@@ -151,27 +92,85 @@ class ScanGUI(tk.Tk):
         self.bg = self.cget('bg')
         for i, axis in enumerate(self.axis_names):
             tk.Label(self, text=axis).grid(row=i+1, column=0)
-            self.check_vars[axis] = tk.BooleanVar(value=False)
-            cb = tk.Checkbutton(self, variable=self.check_vars[axis])
+            self.check_vars['DUT'][axis] = tk.BooleanVar(value=False)
+            cb = tk.Checkbutton(self, variable=self.check_vars['DUT'][axis])
             cb.grid(row=i+1, column=1)
-            self.entries[axis] = {}
+            self.entries['DUT'][axis] = {}
 
             val = self.origin_vals[axis]
-            ent = tk.Entry(self, width=9, fg="black", readonlybackground=self.bg)
+            ent = tk.Entry(self, width=9, fg="gray", readonlybackground=self.bg)
             ent.grid(row=i+1, column=2)
             ent.insert(0, str(val))
             ent.config(state="readonly")
-            self.entries[axis]['origin'] = ent
+            self.entries['DUT'][axis]['origin'] = ent
 
             for j, name in enumerate(['start', 'stop', 'step']):
                 ent2 = tk.Entry(self, width=9)
                 ent2.grid(row=i+1, column=3+j)
-                self.entries[axis][name] = ent2
+                self.entries['DUT'][axis][name] = ent2
 
         self.unitset_btn = tk.Button(self, text="Unit Set", command=self.open_unitset)
         self.unitset_btn.grid(row=len(self.axis_names)+2, column=0, columnspan=2, pady=8)
         self.start_btn = tk.Button(self, text="Start Scan", command=self.start_scan)
-        self.start_btn.grid(row=len(self.axis_names)+2, column=2, columnspan=4, pady=8)
+        self.start_btn.grid(row=len(self.axis_names)+2, column=2, columnspan=2, pady=8)
+        self.pause_btn = tk.Button(self, text="Pause", command=self.toggle_pause, state="disabled")
+        self.pause_btn.grid(row=len(self.axis_names)+2, column=4, pady=8)
+        self.abort_btn = tk.Button(self, text="Abort", command=self.abort_scan, state="disabled")
+        self.abort_btn.grid(row=len(self.axis_names)+2, column=5, pady=8)
+        self.preview_overlay_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(self, text="Preview overlay", variable=self.preview_overlay_var).grid(
+            row=len(self.axis_names)+4, column=0, columnspan=3, sticky="w")
+        tk.Label(self, text="Storage:").grid(row=len(self.axis_names)+4, column=3, sticky="e")
+        self.storage_var = tk.StringVar(value="bmp")
+        ttk.Combobox(self, textvariable=self.storage_var, values=STORAGE_MODES, state="readonly", width=8).grid(
+            row=len(self.axis_names)+4, column=4, columnspan=2, sticky="w")
+        tk.Label(self, text="Camera:").grid(row=len(self.axis_names)+5, column=0, sticky="e")
+        self.camera_var = tk.StringVar(value="rayci")
+        ttk.Combobox(self, textvariable=self.camera_var, values=CAMERA_BACKENDS, state="readonly", width=9).grid(
+            row=len(self.axis_names)+5, column=1, columnspan=2, sticky="w")
+        tk.Label(self, text="Exposures:").grid(row=len(self.axis_names)+5, column=3, sticky="e")
+        self.exposures_var = tk.IntVar(value=1)
+        tk.Spinbox(self, from_=1, to=100, textvariable=self.exposures_var, width=4).grid(
+            row=len(self.axis_names)+5, column=4, sticky="w")
+        tk.Label(self, text="Burst:").grid(row=len(self.axis_names)+8, column=0, sticky="e")
+        self.burst_var = tk.StringVar(value="frames")
+        ttk.Combobox(self, textvariable=self.burst_var, values=BURST_MODES, state="readonly", width=9).grid(
+            row=len(self.axis_names)+8, column=1, columnspan=2, sticky="w")
+        tk.Label(self, text="Mode:").grid(row=len(self.axis_names)+6, column=0, sticky="e")
+        self.scan_mode_var = tk.StringVar(value="grid")
+        ttk.Combobox(self, textvariable=self.scan_mode_var, values=("grid", "adaptive", "fly"), state="readonly", width=9).grid(
+            row=len(self.axis_names)+6, column=1, columnspan=2, sticky="w")
+        tk.Label(self, text="Metric:").grid(row=len(self.axis_names)+6, column=3, sticky="e")
+        self.metric_var = tk.StringVar(value="peak")
+        ttk.Combobox(self, textvariable=self.metric_var, values=list(SCORE_METRICS), state="readonly", width=9).grid(
+            row=len(self.axis_names)+6, column=4, columnspan=2, sticky="w")
+        tk.Label(self, text="Tol (pulse):").grid(row=len(self.axis_names)+7, column=0, sticky="e")
+        self.tolerance_var = tk.StringVar(value="1")
+        tk.Entry(self, textvariable=self.tolerance_var, width=6).grid(row=len(self.axis_names)+7, column=1, sticky="w")
+        self.resume_scan_btn = tk.Button(self, text="Resume Scan", command=self.resume_scan)
+        self.resume_scan_btn.grid(row=len(self.axis_names)+7, column=3, columnspan=2, pady=8)
+        self.refresh_origins_btn = tk.Button(self, text="Refresh Origins", command=self.refresh_origins)
+        self.refresh_origins_btn.grid(row=len(self.axis_names)+8, column=3, columnspan=2, pady=8)
+        self.origin_label = tk.Label(self, text="", font=('Arial', 9), anchor='w')
+        self.origin_label.grid(row=len(self.axis_names)+9, column=0, columnspan=6, sticky="w")
+        # Z start/stop become the per-point focus search range instead of a swept axis
+        self.autofocus_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(self, text=f"Autofocus {FOCUS_AXIS}", variable=self.autofocus_var).grid(
+            row=len(self.axis_names)+10, column=0, columnspan=2, sticky="w")
+        tk.Label(self, text="Focus:").grid(row=len(self.axis_names)+10, column=3, sticky="e")
+        self.focus_metric_var = tk.StringVar(value="gradient")
+        ttk.Combobox(self, textvariable=self.focus_metric_var, values=FOCUS_METRICS, state="readonly", width=9).grid(
+            row=len(self.axis_names)+10, column=4, columnspan=2, sticky="w")
+        # Frames are cropped to x, y, w, h ('track': w, h around the beam) and binned right after capture
+        tk.Label(self, text="ROI:").grid(row=len(self.axis_names)+11, column=0, sticky="e")
+        self.roi_mode_var = tk.StringVar(value="full")
+        ttk.Combobox(self, textvariable=self.roi_mode_var, values=ROI_MODES, state="readonly", width=9).grid(
+            row=len(self.axis_names)+11, column=1, columnspan=2, sticky="w")
+        self.roi_var = tk.StringVar(value="")
+        tk.Entry(self, textvariable=self.roi_var, width=14).grid(row=len(self.axis_names)+11, column=3, columnspan=2, sticky="w")
+        tk.Label(self, text="Bin:").grid(row=len(self.axis_names)+11, column=5, sticky="w")
+        self.binning_var = tk.IntVar(value=1)
+        tk.Spinbox(self, from_=1, to=8, textvariable=self.binning_var, width=3).grid(row=len(self.axis_names)+11, column=5, sticky="e")
 
         # --- Progress and image display widgets ---
         self.progress_label = tk.Label(self, text="", font=('Arial', 12, 'bold'), fg="blue")
@@ -180,89 +179,19 @@ class ScanGUI(tk.Tk):
         # Large image preview at true BMP size (632x504)
         self.image_panel = tk.Label(self, text="Scan image preview here", width=632, height=504, bg="#EEE", anchor='center', relief="sunken")
         self.image_panel.place(x=650, y=20, width=632, height=504)
+        self.metrics_label = tk.Label(self, text="", font=('Arial', 10), anchor='w')
+        self.metrics_label.place(x=650, y=530, width=632, height=24)
+        self.timing_label = tk.Label(self, text="", font=('Arial', 9), anchor='w', justify='left', wraplength=630)
+        self.timing_label.place(x=650, y=556, width=632, height=36)
+        self.refresh_origins()
+
+    def stage_groups(self):
+        # (stage, port, axes, origin, axis-name prefix in joint scans)
+        return [('DUT', SERIAL_PORT, self.axis_names, self.origin_vals, '')]
 
     def open_unitset(self):
         UnitSetDialog(self)
 
-    def show_scan_image(self, image_path):
-        try:
-            im = Image.open(image_path)
-            # Do not resize, show at native size (632x504)
-            photo = ImageTk.PhotoImage(im)
-            self.image_panel.configure(image=photo, text="")
-            self.image_panel.image = photo
-        except Exception as e:
-            self.image_panel.configure(text="(Image failed to load)")
-
-    def start_scan(self):
-        enabled_axes = [ax for ax in self.axis_names if self.check_vars[ax].get()]
-        if not enabled_axes:
-            messagebox.showwarning("No Axis Selected", "Please enable at least one axis for scanning.")
-            return
-
-        # Read scan parameters
-        scan_params = {}
-        for ax in self.axis_names:
-            if self.check_vars[ax].get():
-                try:
-                    start = float(self.entries[ax]['start'].get())
-                    stop = float(self.entries[ax]['stop'].get())
-                    step = int(float(self.entries[ax]['step'].get()))
-                    if step < 2:
-                        messagebox.showerror("Input Error", f"Step (count) for {ax} must be integer ≥2.")
-                        return
-                    scan_params[ax] = np.linspace(start, stop, step)
-                except Exception:
-                    messagebox.showerror("Input Error", f"Invalid range/step for {ax}")
-                    return
-            else:
-                # Non-selected axis: fixed at origin
-                origin_val = self.origin_vals[ax]
-                if origin_val == 'NA':
-                    messagebox.showerror("Axis Error", f"Origin value not available for {ax}")
-                    return
-                scan_params[ax] = np.array([float(origin_val)])
-
-        # Cartesian product of all scan positions
-        axes = self.axis_names
-        grids = [scan_params[ax] for ax in axes]
-        positions = np.array(np.meshgrid(*grids, indexing='ij')).reshape(len(axes), -1).T
-
-        # Prepare log folder
-        log_root = os.path.join(os.getcwd(), "log")
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
-        log_dir = os.path.join(log_root, timestamp)
-        os.makedirs(log_dir, exist_ok=True)
-
-        rayci = get_rayci_proxy()
-
-        try:
-            ser = serial.Serial(SERIAL_PORT, baudrate=BAUDRATE, timeout=0.5)
-            origin_pulses = {ax: float(self.origin_vals[ax]) if self.origin_vals[ax] != 'NA' else 0.0 for ax in axes}
-            total = len(positions)
-
-            for idx, pos in enumerate(positions):
-                # Move all axes
-                for ax, val in zip(axes, pos):
-                    move_axis_to(ser, ax, val)
-                # Take a picture, build filename
-                pos_strs = [f"{ax.lower()}_{int(round(val))}" for ax, val in zip(axes, pos)]
-                filename = os.path.join(log_dir, '_'.join(pos_strs) + '.bmp')
-                if rayci:
-                    capture_bmp(rayci, filename)
-                # Show progress and preview
-                self.progress_label.config(text=f"Iteration {idx+1} of {total}")
-                self.show_scan_image(filename)
-                self.update()
-
-            # Return all axes to original positions (BEFORE serial close)
-            for ax in axes:
-                move_axis_to(ser, ax, origin_pulses[ax])
-            ser.close()
-            messagebox.showinfo("Scan Completed", "Scan complete and all axes returned to origin.")
-        except Exception as e:
-            messagebox.showerror("Serial Error", str(e))
-
 if __name__ == "__main__":
     app = ScanGUI()
     app.mainloop()
@@ -0,0 +1,254 @@
+import collections
+import json
+import os
+import threading
+import time
+import numpy as np
+
+from scan_path import DEFAULT_AXIS_SETTLE, DEFAULT_AXIS_SPEED, AxisCost
+from scan_trace import NULL_TRACE
+
+POLL_MIN = 0.005        # densest MOTION? polling, near the expected arrival
+POLL_MAX = 0.25         # sparsest polling, early in long moves or when the duration is unknown
+QUERY_RETRIES = 3       # MOTION? replies lost in a row before an axis is simply polled again
+MOVE_TIMEOUT_FACTOR = 3.0
+MOVE_TIMEOUT_MARGIN = 2.0
+MODEL_SAMPLES = 200     # recent moves per axis used for calibration
+MIN_FIT_SAMPLES = 5
+MOTION_MODEL_FILE = 'motion_model.json'
+
+
+class MotionTimeout(TimeoutError):
+    pass
+
+
+class MotionError(RuntimeError):
+    # A move command or its completion query failed; where the axes ended up is unknown
+    pass
+
+
+def is_moving(ctrl, axis):
+    for _ in range(QUERY_RETRIES):
+        try:
+            return ctrl.motion(axis) != '0'
+        except TimeoutError:
+            continue
+    # No answer at all; treat as still moving and let the move deadline decide
+    return True
+
+
+class MoveModel:
+    """
+    Expected DS102 move duration per axis: overhead + distance / speed. Every timed
+    move is recorded, and once an axis has enough moves of different lengths both
+    terms are refitted from the most recent MODEL_SAMPLES moves, so the model follows
+    the controller's real speed settings.
+    """
+    def __init__(self, speed=DEFAULT_AXIS_SPEED, overhead=DEFAULT_AXIS_SETTLE):
+        self.default = (float(speed), float(overhead))
+        self.params = {}
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=MODEL_SAMPLES))
+        self.lock = threading.Lock()
+
+    def axis_params(self, axis):
+        with self.lock:
+            return self.params.get(axis, self.default)
+
+    def expected(self, axis, distance):
+        speed, overhead = self.axis_params(axis)
+        return overhead + abs(float(distance)) / speed
+
+    def axis_cost(self, axis):
+        speed, overhead = self.axis_params(axis)
+        return AxisCost(speed, overhead)
+
+    def record(self, axis, distance, seconds):
+        with self.lock:
+            samples = self.samples[axis]
+            samples.append((abs(float(distance)), float(seconds)))
+            if len(samples) < MIN_FIT_SAMPLES:
+                return
+            d, t = np.array(samples).T
+            if np.ptp(d) <= 0:
+                return
+            slope, intercept = np.polyfit(d, t, 1)
+            if slope > 0:
+                self.params[axis] = (1.0 / slope, max(float(intercept), 0.0))
+
+    def stats(self, axis):
+        # Timing statistics of the recorded moves: count, mean/p95 seconds and the p95 of
+        # |measured - expected| under the current fit
+        with self.lock:
+            samples = list(self.samples.get(axis, ()))
+        if not samples:
+            return None
+        d, t = np.array(samples).T
+        resid = np.abs(t - np.array([self.expected(axis, x) for x in d]))
+        speed, overhead = self.axis_params(axis)
+        return {'moves': len(t), 'mean': float(t.mean()), 'p95': float(np.percentile(t, 95)),
+                'p95_error': float(np.percentile(resid, 95)), 'speed': speed, 'overhead': overhead}
+
+    def summary(self):
+        lines = []
+        for axis in sorted(self.samples):
+            s = self.stats(axis)
+            if s:
+                lines.append(f"{axis}: {s['moves']} moves, mean {s['mean']:.3f} s, p95 {s['p95']:.3f} s, "
+                             f"{s['speed']:.0f} pulse/s + {s['overhead']:.3f} s (p95 error {s['p95_error']:.3f} s)")
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        with self.lock:
+            return {'params': {ax: list(p) for ax, p in self.params.items()},
+                    'samples': {ax: list(map(list, s)) for ax, s in self.samples.items()}}
+
+    def update_from(self, data):
+        with self.lock:
+            self.params.update({ax: tuple(p) for ax, p in data.get('params', {}).items()})
+            for ax, samples in data.get('samples', {}).items():
+                self.samples[ax].extend(tuple(s) for s in samples)
+
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_move_model(port):
+    with _models_lock:
+        if port not in _models:
+            _models[port] = MoveModel()
+        return _models[port]
+
+
+def load_move_models(path):
+    # Calibration from earlier sessions: {port: MoveModel.to_dict()}
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring motion calibration {path}: {e}")
+        return
+    for port, model in data.items():
+        get_move_model(port).update_from(model)
+
+
+def save_move_models(path):
+    with _models_lock:
+        data = {port: model.to_dict() for port, model in _models.items()}
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+_UNSEEN = object()
+
+
+def _positions_of(ctrl, axes):
+    try:
+        return ctrl.get_positions(axes)
+    except Exception:
+        return None
+
+
+def wait_for_axes(ctrl, axes, distances=None, model=None):
+    """
+    Poll MOTION? until every axis has stopped. With known distances each wait halves
+    the time left to the expected arrival (sparse early, POLL_MIN near arrival), then
+    backs off again if the move is overdue; each finished move is recorded in the
+    model. Past the deadline the axes' positions are read: if they still change the
+    deadline is extended, otherwise MotionTimeout is raised.
+    """
+    distances = distances or {}
+    model = model or get_move_model(getattr(ctrl, 'port', None))
+    start = time.monotonic()
+    expected = {ax: model.expected(ax, distances[ax]) for ax in axes if ax in distances}
+    arrival = {ax: start + t for ax, t in expected.items()}
+    longest = max(expected.values(), default=None)
+    budget = MOVE_TIMEOUT_FACTOR * (longest or 0.0) + MOVE_TIMEOUT_MARGIN
+    deadline = start + budget
+    last_seen = _UNSEEN
+    pending = list(axes)
+    interval = POLL_MIN
+    while pending:
+        now = time.monotonic()
+        # Each axis is timed on its own, so a short move is not polled on the long one's schedule
+        ahead = [arrival[ax] - now for ax in pending if arrival.get(ax, now) > now]
+        if ahead:
+            time.sleep(min(max(min(ahead) / 2, POLL_MIN), POLL_MAX))
+        else:
+            time.sleep(interval)
+            # Overdue or unknown duration: back off towards POLL_MAX
+            interval = min(interval * 1.5, POLL_MAX)
+        still = [ax for ax in pending if is_moving(ctrl, ax)]
+        done_at = time.monotonic()
+        for ax in pending:
+            if ax not in still and ax in distances:
+                model.record(ax, distances[ax], done_at - start)
+        pending = still
+        if pending and done_at > deadline:
+            seen = _positions_of(ctrl, pending)
+            # Unreadable positions count as unchanged, so a dead link also ends the wait
+            if seen == last_seen:
+                raise MotionTimeout(f"Axes {', '.join(pending)} on {getattr(ctrl, 'port', '?')} "
+                                    f"did not stop within {done_at - start:.1f} s")
+            last_seen = seen
+            deadline = done_at + max(budget, MOVE_TIMEOUT_MARGIN)
+
+
+class StageMotion:
+    """
+    Moves the axes of one DS102 controller together and remembers the last
+    commanded position of each axis, so unchanged targets cost no serial traffic.
+    Known start positions also give the move distances the completion wait is
+    timed with. Set `trace` to a ScanTrace to time the 'move' and 'motion_wait' phases.
+    """
+    def __init__(self, ctrl, positions=None, model=None):
+        self.ctrl = ctrl
+        self.model = model or get_move_model(getattr(ctrl, 'port', None))
+        self.trace = NULL_TRACE
+        self.commanded = {}
+        for ax, pos in (positions or {}).items():
+            self.set_known(ax, pos)
+
+    def set_known(self, axis, pos):
+        try:
+            self.commanded[axis] = int(round(float(pos)))
+        except (TypeError, ValueError):
+            self.commanded.pop(axis, None)
+
+    def forget(self, axis=None):
+        if axis is None:
+            self.commanded.clear()
+        else:
+            self.commanded.pop(axis, None)
+
+    def move_to(self, targets):
+        moving = []
+        distances = {}
+        try:
+            with self.trace.span('move'):
+                for ax, pos in targets.items():
+                    pulse = int(round(float(pos)))
+                    if self.commanded.get(ax) == pulse:
+                        continue
+                    if ax in self.commanded:
+                        distances[ax] = pulse - self.commanded[ax]
+                    # Drop the cached value first; it is only trusted again once the command went out
+                    self.commanded.pop(ax, None)
+                    self.ctrl.goabs(ax, pulse)
+                    self.commanded[ax] = pulse
+                    moving.append(ax)
+            if moving:
+                with self.trace.span('motion_wait'):
+                    wait_for_axes(self.ctrl, moving, distances, self.model)
+        except Exception as e:
+            # A stuck axis or a failed command must stop the scan rather than image at the wrong position
+            for ax in moving:
+                self.commanded.pop(ax, None)
+            if isinstance(e, MotionTimeout):
+                raise
+            raise MotionError(f"Error moving axes {', '.join(targets)} on {getattr(self.ctrl, 'port', '?')}: {e}") from e
+        return moving
@@ -0,0 +1,91 @@
+import json
+import os
+import queue
+import threading
+import time
+
+from ds102 import get_controller
+
+ORIGIN_CACHE_FILE = 'origins.json'
+ORIGIN_POLL_MS = 100
+
+
+def load_origin_cache(path):
+    # port -> {'positions': {axis: pulse string}, 'time': seconds since the epoch}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_origin_cache(path, cache):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp, path)
+
+
+def cached_origin(cache, port, axes):
+    # ({axis: pulse string or 'NA'}, timestamp or None) from the cache
+    entry = cache.get(port) or {}
+    positions = entry.get('positions') or {}
+    return {ax: positions.get(ax, 'NA') for ax in axes}, entry.get('time')
+
+
+class OriginFetcher:
+    """
+    Reads stage origins off the Tk thread, one thread per controller, so a slow or
+    unplugged port only holds up its own axes. Finished reads come back through
+    poll() as (port, {axis: pulse string or 'NA'}) and are written to the on-disk
+    cache with a timestamp (axes that read 'NA' keep their last known value there).
+    """
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.cache = load_origin_cache(cache_path)
+        self.results = queue.Queue()
+        self.pending = set()
+
+    def cached(self, port, axes):
+        return cached_origin(self.cache, port, axes)
+
+    def fetch(self, port, axes):
+        if port in self.pending:
+            return
+        self.pending.add(port)
+        threading.Thread(target=self._read, args=(port, list(axes)), name=f"origin-{port}", daemon=True).start()
+
+    def _read(self, port, axes):
+        try:
+            positions = get_controller(port).get_positions(axes)
+        except Exception:
+            positions = {ax: 'NA' for ax in axes}
+        self.results.put((port, positions))
+
+    def poll(self):
+        results = []
+        changed = False
+        while True:
+            try:
+                port, positions = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending.discard(port)
+            results.append((port, positions))
+            known = {ax: val for ax, val in positions.items() if val != 'NA'}
+            if known:
+                entry = self.cache.setdefault(port, {'positions': {}})
+                entry['positions'].update(known)
+                entry['time'] = time.time()
+                changed = True
+        if changed:
+            try:
+                save_origin_cache(self.cache_path, self.cache)
+            except OSError as e:
+                print(f"Saving origin cache failed: {e}")
+        return results
+
+    @property
+    def busy(self):
+        return bool(self.pending)
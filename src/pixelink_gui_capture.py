@@ -1,8 +1,26 @@
 import os
+import re
+import subprocess
+import threading
+import time
 from datetime import datetime
+import numpy as np
+
+DEFAULT_FFMPEG_PATH = r"C:\\Program Files\\PixeLINK\\bin\\x64\\ffmpegPxL.exe"
+
+# ffmpeg rawvideo pixel formats -> (numpy dtype, channels)
+PIXEL_FORMATS = {
+    "gray": (np.uint8, 1),
+    "gray16le": (np.uint16, 1),
+    "rgb24": (np.uint8, 3),
+}
+PROBE_TIMEOUT = 10.0        # seconds for the one-frame session that reads the stream geometry
+FRAME_TIMEOUT = 2.0         # seconds grab_after() waits for a fresh frame
+_STREAM_SIZE = re.compile(r"Output #0.*?Video: rawvideo\b.*?, (\d+)x(\d+)", re.S)
+
 
 class PixelinkCamera:
-    def __init__(self, camera_sn: str, ffmpeg_path: str = r"C:\\Program Files\\PixeLINK\\bin\\x64\\ffmpegPxL.exe"):
+    def __init__(self, camera_sn: str, ffmpeg_path: str = DEFAULT_FFMPEG_PATH):
         self.camera_sn = camera_sn.strip()
         self.ffmpeg_path = ffmpeg_path
         self.output_base = os.path.join(os.getcwd(), "captures")
@@ -19,8 +37,6 @@ class PixelinkCamera:
         This method is intended to run in a local environment where subprocess execution is supported.
         In restricted environments (e.g., browser sandboxes), this will not work.
         """
-        import subprocess
-
         folder = self._create_timestamp_folder()
         bmp_path = os.path.join(folder, "capture.bmp")
 
@@ -46,6 +62,201 @@ class PixelinkCamera:
                                "Please run this script on a local machine with access to the Pixelink camera.")
 
 
+class PixelinkStream:
+    """
+    Keeps one ffmpeg/camera session open and reads raw frames from its stdout pipe
+    straight into preallocated NumPy buffers.
+
+    grab() returns a view into a ring of `buffers` frames, valid until the ring wraps
+    (pass copy=True to keep it longer). grab() reads whatever ffmpeg has buffered in
+    the pipe, which may be older than the call; after follow(), a reader thread keeps
+    only the newest frame and grab_after() waits for one that started arriving after a
+    given time (e.g. the end of a stage move). width and height default to the
+    geometry ffmpeg reports for the stream (see probe()), so camera-side ROI or
+    binning settings are picked up. ffmpeg_path and popen are pluggable, e.g. a
+    local fake frame source that writes raw frames to stdout.
+    """
+    def __init__(self, camera_sn: str, width: int = None, height: int = None, pix_fmt: str = "gray",
+                 ffmpeg_path: str = DEFAULT_FFMPEG_PATH, buffers: int = 4, popen=subprocess.Popen,
+                 extra_args=()):
+        self.camera_sn = camera_sn.strip()
+        self.ffmpeg_path = ffmpeg_path
+        self.popen = popen
+        self.extra_args = list(extra_args)
+        self.pix_fmt = pix_fmt
+        self.buffers = buffers
+        self.frame_shape = None
+        self.frames_read = 0
+        self.proc = None
+        self.reader = None
+        self.latest = None          # (sequence number, time the first byte arrived, frame)
+        self.reader_error = None
+        self._cond = threading.Condition()
+        if width and height:
+            self._allocate(width, height)
+
+    def _allocate(self, width, height):
+        dtype, channels = PIXEL_FORMATS[self.pix_fmt]
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        self.frame_shape = shape
+        self.dtype = np.dtype(dtype)
+        self.frame_bytes = int(np.prod(shape)) * self.dtype.itemsize
+        self._ring = np.empty((self.buffers,) + shape, dtype=self.dtype)
+        self._next = 0
+
+    def command(self, loglevel="error", frames=None):
+        return [
+            self.ffmpeg_path,
+            "-loglevel", loglevel,
+            "-f", "dshow",
+            *self.extra_args,
+            "-i", f"video={self.camera_sn}",
+            *(["-frames:v", str(frames)] if frames else []),
+            "-f", "rawvideo",
+            "-pix_fmt", self.pix_fmt,
+            "-",
+        ]
+
+    def probe(self):
+        # (width, height) of the raw output stream, from a one-frame session with the same options
+        try:
+            proc = self.popen(self.command("info", frames=1), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              stdin=subprocess.DEVNULL)
+        except FileNotFoundError:
+            raise RuntimeError(f"ffmpeg executable not found at: {self.ffmpeg_path}")
+        try:
+            _, err = proc.communicate(timeout=PROBE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            raise RuntimeError("Pixelink stream probe timed out")
+        match = _STREAM_SIZE.search(err.decode(errors="replace"))
+        if match is None:
+            raise RuntimeError("Could not read the Pixelink frame size from ffmpeg")
+        return int(match.group(1)), int(match.group(2))
+
+    def start(self):
+        if self.proc is None:
+            if self.frame_shape is None:
+                self._allocate(*self.probe())
+            try:
+                self.proc = self.popen(self.command(), stdout=subprocess.PIPE, stdin=subprocess.DEVNULL,
+                                       bufsize=self.frame_bytes)
+            except FileNotFoundError:
+                raise RuntimeError(f"ffmpeg executable not found at: {self.ffmpeg_path}")
+        return self
+
+    def stop(self):
+        if self.proc is not None:
+            proc, self.proc = self.proc, None
+            proc.terminate()
+            try:
+                proc.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if self.reader is not None:
+            self.reader.join(timeout=2)
+            self.reader = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _read_into(self, out, proc=None):
+        # Returns the time the first bytes of the frame arrived
+        stdout = (proc or self.proc).stdout
+        view = memoryview(out.reshape(-1).view(np.uint8))
+        filled = 0
+        t_first = None
+        while filled < self.frame_bytes:
+            n = stdout.readinto(view[filled:])
+            if not n:
+                raise RuntimeError(f"Pixelink stream ended after {self.frames_read} frames")
+            if t_first is None:
+                t_first = time.perf_counter()
+            filled += n
+        self.frames_read += 1
+        return t_first
+
+    def follow(self):
+        # Start the reader thread that drains the pipe and keeps only the newest frame
+        self.start()
+        if self.reader is None:
+            self.reader = threading.Thread(target=self._follow, args=(self.proc,), name="pixelink-reader", daemon=True)
+            self.reader.start()
+        return self
+
+    def _follow(self, proc):
+        # Two buffers: one being filled, the other published as `latest`
+        spare = [np.empty(self.frame_shape, dtype=self.dtype) for _ in range(2)]
+        seq = 0
+        try:
+            while self.proc is proc:
+                out = spare[seq % 2]
+                t_first = self._read_into(out, proc)
+                seq += 1
+                with self._cond:
+                    self.latest = (seq, t_first, out)
+                    self._cond.notify_all()
+        except Exception as e:
+            with self._cond:
+                if self.proc is proc:
+                    self.reader_error = e
+                self._cond.notify_all()
+
+    def _wait_frame(self, after_seq, after_time, out, timeout):
+        with self._cond:
+            deadline = time.perf_counter() + timeout
+            while self.latest is None or self.latest[0] <= after_seq or self.latest[1] < after_time:
+                if self.reader_error is not None:
+                    raise RuntimeError(f"Pixelink stream failed: {self.reader_error}")
+                left = deadline - time.perf_counter()
+                if left <= 0:
+                    raise RuntimeError(f"No Pixelink frame within {timeout:.1f} s")
+                self._cond.wait(left)
+            seq, _, frame = self.latest
+            # Copied under the lock: the reader only swaps buffers while holding it
+            out[...] = frame
+        return seq
+
+    def grab_after(self, t, n=None, timeout=FRAME_TIMEOUT):
+        """
+        Next frame (or n consecutive frames as one (n, *frame_shape) array) whose first
+        bytes arrived at or after perf_counter time t. Needs follow(); always a copy.
+        """
+        self.follow()
+        out = np.empty(((n,) if n else ()) + self.frame_shape, dtype=self.dtype)
+        seq = 0
+        for frame in (out if n else [out]):
+            seq = self._wait_frame(seq, t, frame, timeout)
+        return out
+
+    def grab(self, copy=False):
+        self.start()
+        if self.reader is not None:
+            raise RuntimeError("grab() reads the pipe directly; use grab_after() after follow()")
+        out = self._ring[self._next]
+        self._next = (self._next + 1) % len(self._ring)
+        self._read_into(out)
+        return out.copy() if copy else out
+
+    def grab_n(self, n, out=None):
+        # n consecutive frames into one (n, *frame_shape) array, allocated once if not given
+        self.start()
+        if self.reader is not None:
+            raise RuntimeError("grab_n() reads the pipe directly; use grab_after() after follow()")
+        if out is None:
+            out = np.empty((n,) + self.frame_shape, dtype=self.dtype)
+        for i in range(n):
+            self._read_into(out[i])
+        return out
+
+    def __iter__(self):
+        while True:
+            yield self.grab()
+
+
 # Example usage:
 if __name__ == "__main__":
     cam = PixelinkCamera("PixelLINK USB3 Camera Release 4")
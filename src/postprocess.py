@@ -0,0 +1,335 @@
+"""
+Batch post-processing of finished scans: beam metrics for every frame of a log
+directory, reduced into N-D maps shaped like the scan grid, plus optional
+downsampled image cubes, all in one compressed file (log_dir/postprocess.npz).
+Frames are read from the BMP files, or from scan.h5 for scans stored as HDF5 only.
+
+    python postprocess.py log/DUT/2024-05-01_101500 [more dirs ...] [-j 8] [--cube 64x48]
+
+Frames are fanned out over a process pool in chunks. Reruns only process frames
+that are new or changed (by size and modification time) since the last run.
+Frames cropped or binned at capture (see frame_roi) get their metrics in sensor pixels.
+"""
+import argparse
+import concurrent.futures
+import os
+import sys
+import json
+import time
+import numpy as np
+
+from beam_metrics import METRIC_COLUMNS, BeamAnalyzer
+from preview import downsample, to_intensity
+from scan_dataset import ScanDataset, open_scan
+from frame_roi import ROI_FILE, FrameROI
+from scan_journal import load_plan, read_journal
+from scan_store import H5_FILENAME
+
+POSTPROCESS_FILE = 'postprocess.npz'
+CHUNK_FRAMES = 64           # frames per work unit sent to a pool process
+PROGRESS_INTERVAL = 2.0     # seconds between progress lines
+
+_worker = {}
+
+
+def scan_grids(log_dir, ds):
+    """
+    (axes, grids) of the map layout: the planned grid from plan.json (as built by
+    start_scan) when there is one, else the distinct values found in the file names.
+    Bursts stored one file per exposure get a trailing 'exposure' axis.
+    """
+    coords = ds.coords
+    try:
+        planned = load_plan(log_dir).get('scan_params') or {}
+    except (OSError, ValueError):
+        planned = {}
+    axes = list(ds.axes)
+    grids = [np.asarray(planned.get(ax, coords[ax]), dtype=float) for ax in axes]
+    exposures = np.unique(ds.exposure)
+    if len(exposures) and exposures.max() >= 0:
+        axes.append('exposure')
+        grids.append(exposures.astype(float))
+    return axes, grids
+
+
+def grid_indices(ds, grids):
+    # Nearest grid index of every frame, (n_frames, n_grid_axes)
+    columns = [ds.positions[:, k] for k in range(len(ds.axes))]
+    if len(grids) > len(columns):
+        columns.append(ds.exposure)
+    return np.column_stack([np.abs(g[:, None] - col[None, :]).argmin(axis=0) for g, col in zip(grids, columns)])
+
+
+def frame_windows(log_dir):
+    # (FrameROI, {frame file: sensor window}) of a scan cut at capture, (None, {}) otherwise
+    try:
+        with open(os.path.join(log_dir, ROI_FILE)) as f:
+            roi = FrameROI.from_dict(json.load(f))
+    except (OSError, ValueError, TypeError):
+        return None, {}
+    windows = {}
+    for entry in read_journal(log_dir).values():
+        if entry.get('roi'):
+            windows.update((name, entry['roi']) for name in entry['files'])
+    return roi, windows
+
+
+def _frame_stats(ds):
+    sizes = np.empty(len(ds), dtype=np.int64)
+    mtimes = np.empty(len(ds), dtype=np.int64)
+    for i, path in enumerate(ds.files):
+        st = os.stat(path)
+        sizes[i], mtimes[i] = st.st_size, st.st_mtime_ns
+    return sizes, mtimes
+
+
+class _H5Frames:
+    """
+    Frame access of a pool worker to scan.h5: `cells` is the grid cell of every frame
+    in /frames. Bursts (exposures > 1) are averaged, as the scan does for its metrics.
+    """
+    def __init__(self, log_dir, cells, exposures):
+        from scan_store import open_h5_scan
+        self.file = open_h5_scan(log_dir)
+        self.frames = self.file['frames']
+        self.cells = cells
+        self.exposures = exposures
+
+    def frame(self, i):
+        frame = self.frames[tuple(self.cells[i])]
+        return frame if self.exposures == 1 else frame.mean(axis=0)
+
+    def close(self):
+        self.file.close()
+
+
+def _init_worker(log_dir, source, cube_size):
+    kind, *args = source
+    _worker['ds'] = _H5Frames(log_dir, *args) if kind == 'h5' else ScanDataset(log_dir, *args)
+    _worker['analyzer'] = BeamAnalyzer()
+    _worker['cube_size'] = cube_size
+
+
+def _process_chunk(rows):
+    # Runs in a pool process: (rows, metrics (n, n_metrics), thumbnails or None)
+    ds, analyzer, cube_size = _worker['ds'], _worker['analyzer'], _worker['cube_size']
+    metrics = np.empty((len(rows), len(METRIC_COLUMNS)))
+    thumbs = [] if cube_size else None
+    for k, row in enumerate(rows):
+        frame = ds.frame(row)
+        m = analyzer.analyze(frame)
+        metrics[k] = [m[name] for name in METRIC_COLUMNS]
+        if cube_size:
+            thumbs.append(np.asarray(downsample(to_intensity(frame), cube_size), dtype=np.float32))
+    return rows, metrics, thumbs
+
+
+def _bmp_frames(log_dir):
+    ds = open_scan(log_dir)
+    if not len(ds):
+        return None
+    axes, grids = scan_grids(log_dir, ds)
+    sizes, mtimes = _frame_stats(ds)
+    roi, windows = frame_windows(log_dir)
+    return {'source': ('bmp', ds.index), 'axes': axes, 'grids': grids,
+            'names': np.array([os.path.basename(f) for f in ds.files], dtype=str), 'sizes': sizes, 'mtimes': mtimes,
+            'grid_index': grid_indices(ds, grids), 'roi': roi, 'windows': windows}
+
+
+def _h5_frames(log_dir):
+    # One frame per grid cell, from the last row that wrote it (a resumed scan may write a cell again)
+    from scan_store import open_h5_scan
+    with open_h5_scan(log_dir) as f:
+        if 'frames' not in f or not len(f['grid_index']):
+            return None
+        axes = json.loads(f.attrs['axes'])
+        grids = [np.asarray(f['axes'][ax], dtype=float) for ax in axes]
+        cells = f['grid_index'][:].astype(np.int64)
+        stamps = f['timestamps'][:]
+        windows = f['roi'][:] if 'roi' in f else None
+        roi = FrameROI.from_dict(json.loads(f.attrs['roi'])) if 'roi' in f.attrs else None
+        exposures = int(f.attrs.get('exposures', 1))
+    linear = np.ravel_multi_index(tuple(cells.T), tuple(len(g) for g in grids))
+    _, last = np.unique(linear[::-1], return_index=True)
+    rows = np.sort(len(linear) - 1 - last)
+    names = np.array([f"{H5_FILENAME}:{r}" for r in rows], dtype=str)
+    return {'source': ('h5', cells[rows], exposures), 'axes': axes, 'grids': grids,
+            # Frames are named by their row in the store; cell and timestamp stand in for size and mtime
+            'names': names, 'sizes': linear[rows], 'mtimes': np.round(stamps[rows] * 1e9).astype(np.int64),
+            'grid_index': cells[rows], 'roi': roi,
+            'windows': {} if roi is None or windows is None else
+            {str(name): windows[r].tolist() for name, r in zip(names, rows)}}
+
+
+def scan_frames(log_dir):
+    """
+    The frames of a scan log directory: its BMP files, or when there are none the
+    frames in scan.h5 (bursts averaged). A dict of
+        source                 how pool workers open the frames
+        axes, grids            map layout (see scan_grids; the store's grid for HDF5)
+        names, sizes, mtimes   per frame; a frame with all three unchanged is reused
+        grid_index             cell of every frame in the maps
+        roi, windows           FrameROI and {name: sensor window} of frames cut at capture
+    or None when the directory holds neither.
+    """
+    found = _bmp_frames(log_dir)
+    if found is None and os.path.exists(os.path.join(log_dir, H5_FILENAME)):
+        found = _h5_frames(log_dir)
+    return found
+
+
+def _previous(path, axes, grids, cube_size):
+    # Last results if they were made with the same grid layout and cube size, else None
+    try:
+        with np.load(path) as data:
+            prev = {k: data[k] for k in data.files}
+    except (OSError, ValueError):
+        return None
+    same = (list(prev['axes']) == axes and all(np.array_equal(prev[f'grid_{ax}'], g) for ax, g in zip(axes, grids))
+            and tuple(prev['cube_size']) == tuple(cube_size or ()))
+    return prev if same else None
+
+
+def postprocess(log_dir, jobs=None, cube_size=None, chunk=CHUNK_FRAMES, force=False, log=print):
+    """
+    Metrics maps (and with cube_size=(w, h), a downsampled image cube) for one scan
+    log directory, written to log_dir/postprocess.npz:
+
+        axes, grid_<axis>        map layout (see scan_grids)
+        names, grid_index        frame file (scan.h5:<row> for HDF5) per row and its cell in the maps
+        metrics, metric_columns  per-frame beam metrics
+        map_<metric>             grid-shaped metric maps, NaN where no frame was taken
+        cube                     grid shape + thumbnail shape, float32 intensity
+
+    jobs: pool processes (default: all cores); 1 processes in this process.
+    Returns the number of frames processed this run.
+    """
+    t0 = time.monotonic()
+    scan = scan_frames(log_dir)
+    if scan is None:
+        log(f"{log_dir}: no frames")
+        return 0
+    axes, grids = scan['axes'], scan['grids']
+    names, sizes, mtimes = scan['names'], scan['sizes'], scan['mtimes']
+    shape = tuple(len(g) for g in grids)
+    path = os.path.join(log_dir, POSTPROCESS_FILE)
+
+    metrics = np.full((len(names), len(METRIC_COLUMNS)), np.nan)
+    cube = None
+    todo = np.arange(len(names))
+    prev = None if force else _previous(path, axes, grids, cube_size)
+    if prev is not None:
+        # Reuse rows of frames that are unchanged since the last run
+        known = {name: i for i, name in enumerate(prev['names'])}
+        old = np.array([known.get(name, -1) for name in names], dtype=np.int64)
+        hit = old >= 0
+        hit[hit] = (prev['sizes'][old[hit]] == sizes[hit]) & (prev['mtimes'][old[hit]] == mtimes[hit])
+        metrics[hit] = prev['metrics'][old[hit]]
+        if cube_size and 'cube' in prev:
+            cube = prev['cube']
+            # Cells whose frame went away or changed are cleared and filled again below
+            stale = np.ones(len(prev['names']), dtype=bool)
+            stale[old[hit]] = False
+            cube[tuple(prev['grid_index'][stale].T)] = np.nan
+        todo = np.flatnonzero(~hit)
+    index = scan['grid_index']
+
+    if len(todo):
+        chunks = [todo[i:i + chunk] for i in range(0, len(todo), chunk)]
+        jobs = jobs or os.cpu_count() or 1
+        log(f"{log_dir}: {len(todo)} of {len(names)} frames to process, {len(chunks)} chunks on {min(jobs, len(chunks))} processes")
+        next_report = time.monotonic() + PROGRESS_INTERVAL
+        done = 0
+        roi, windows = scan['roi'], scan['windows']
+        for rows, chunk_metrics, thumbs in _run_chunks(log_dir, scan['source'], cube_size, chunks, jobs):
+            if roi is not None:
+                for k, row in enumerate(rows):
+                    window = windows.get(str(names[row]))
+                    if window is not None:
+                        m = roi.to_sensor(dict(zip(METRIC_COLUMNS, chunk_metrics[k])), window)
+                        chunk_metrics[k] = [m[name] for name in METRIC_COLUMNS]
+            metrics[rows] = chunk_metrics
+            if thumbs:
+                if cube is None or cube.shape[len(shape):] != thumbs[0].shape:
+                    cube = np.full(shape + thumbs[0].shape, np.nan, dtype=np.float32)
+                for row, thumb in zip(rows, thumbs):
+                    if thumb.shape == cube.shape[len(shape):]:
+                        cube[tuple(index[row])] = thumb
+            done += len(rows)
+            if time.monotonic() >= next_report:
+                next_report = time.monotonic() + PROGRESS_INTERVAL
+                log(f"{log_dir}: {done}/{len(todo)}")
+
+    maps = {}
+    for k, name in enumerate(METRIC_COLUMNS):
+        maps[f'map_{name}'] = np.full(shape, np.nan)
+        maps[f'map_{name}'][tuple(index.T)] = metrics[:, k]
+    out = {
+        'axes': np.array(axes, dtype=str), 'names': names, 'sizes': sizes, 'mtimes': mtimes,
+        'grid_index': index, 'metrics': metrics, 'metric_columns': np.array(METRIC_COLUMNS, dtype=str),
+        'cube_size': np.array(cube_size or (), dtype=np.int64),
+        **{f'grid_{ax}': g for ax, g in zip(axes, grids)}, **maps,
+    }
+    if cube_size and cube is not None:
+        out['cube'] = cube
+    tmp = path + '.tmp.npz'
+    np.savez_compressed(tmp, **out)
+    os.replace(tmp, path)
+    log(f"{log_dir}: {len(todo)} frames processed, {len(names) - len(todo)} reused, "
+        f"maps {'x'.join(str(n) for n in shape)} in {time.monotonic() - t0:.1f} s -> {path}")
+    return len(todo)
+
+
+def _run_chunks(log_dir, source, cube_size, chunks, jobs):
+    if jobs == 1 or len(chunks) == 1:
+        _init_worker(log_dir, source, cube_size)
+        try:
+            for rows in chunks:
+                yield _process_chunk(rows)
+        finally:
+            frames = _worker.pop('ds')
+            if hasattr(frames, 'close'):
+                frames.close()
+        return
+    with concurrent.futures.ProcessPoolExecutor(min(jobs, len(chunks)), initializer=_init_worker,
+                                                initargs=(log_dir, source, cube_size)) as pool:
+        for future in concurrent.futures.as_completed([pool.submit(_process_chunk, rows) for rows in chunks]):
+            yield future.result()
+
+
+def load_results(log_dir):
+    # Contents of log_dir/postprocess.npz as a dict of arrays
+    path = log_dir if log_dir.endswith('.npz') else os.path.join(log_dir, POSTPROCESS_FILE)
+    with np.load(path) as data:
+        return {k: data[k] for k in data.files}
+
+
+def _cube_size(text):
+    w, _, h = text.lower().partition('x')
+    try:
+        return int(w), int(h or w)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected WIDTHxHEIGHT, e.g. 64x48")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Beam metric maps and image cubes from scan log directories")
+    parser.add_argument('log_dirs', nargs='+', help="scan log directories (log/<group>/<timestamp>)")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument('--cube', type=_cube_size, default=None, metavar='WxH',
+                        help="also store frames binned to fit WxH pixels as a cube shaped like the grid")
+    parser.add_argument('--chunk', type=int, default=CHUNK_FRAMES, help="frames per work unit")
+    parser.add_argument('--force', action='store_true', help="reprocess every frame")
+    args = parser.parse_args(argv)
+    failed = False
+    for log_dir in args.log_dirs:
+        try:
+            postprocess(log_dir, args.jobs, args.cube, args.chunk, args.force)
+        except Exception as e:
+            print(f"{log_dir}: failed: {e}", file=sys.stderr)
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
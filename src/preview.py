@@ -0,0 +1,89 @@
+import time
+import numpy as np
+
+PREVIEW_SIZE = (632, 504)   # preview panel (width, height)
+PREVIEW_FPS = 5.0
+COLORBAR_WIDTH = 14
+
+
+class PreviewThrottle:
+    # Accepts at most max_fps frames per second; everything in between is dropped
+    def __init__(self, max_fps=PREVIEW_FPS):
+        self.interval = 1.0 / max_fps if max_fps else 0.0
+        self._last = None
+
+    def due(self, force=False):
+        now = time.monotonic()
+        if force or self._last is None or now - self._last >= self.interval:
+            self._last = now
+            return True
+        return False
+
+
+def load_frame(path):
+    from PIL import Image
+    with Image.open(path) as im:
+        return np.asarray(im)
+
+
+def to_intensity(frame):
+    frame = np.asarray(frame)
+    if frame.ndim == 3:
+        return frame[..., :3].mean(axis=2)
+    return frame
+
+
+def downsample(frame, size=PREVIEW_SIZE, method='bin'):
+    """
+    Shrink a frame by an integer factor so it fits `size` (width, height).
+    'bin' averages factor x factor blocks, 'decimate' keeps every factor-th pixel (no copy).
+    """
+    h, w = frame.shape[:2]
+    factor = int(np.ceil(max(w / size[0], h / size[1], 1)))
+    if factor == 1:
+        return frame
+    if method == 'decimate':
+        return frame[::factor, ::factor]
+    h2, w2 = h // factor, w // factor
+    blocks = frame[:h2 * factor, :w2 * factor].reshape(h2, factor, w2, factor, *frame.shape[2:])
+    return blocks.mean(axis=(1, 3))
+
+
+def _colormap_lut():
+    # Blue -> cyan -> green -> yellow -> red, 256 entries
+    stops = np.array([0.0, 0.25, 0.5, 0.75, 1.0])
+    colors = np.array([[0, 0, 128], [0, 200, 255], [0, 220, 0], [255, 230, 0], [200, 0, 0]], dtype=float)
+    x = np.linspace(0, 1, 256)
+    return np.column_stack([np.interp(x, stops, colors[:, c]) for c in range(3)]).astype(np.uint8)
+
+
+COLORMAP_LUT = _colormap_lut()
+
+
+def render_preview(frame, size=PREVIEW_SIZE, label=None, colormap=False, method='bin'):
+    """
+    Build a small PIL image for the preview panel from an in-memory frame.
+    With colormap=True intensity is colour-mapped and a scale bar is drawn on the right.
+    """
+    # PIL is only needed once previews are drawn; headless runs never import it
+    from PIL import Image, ImageDraw
+    small = downsample(np.asarray(frame), size, method)
+    if not colormap:
+        image = Image.fromarray(np.clip(small, 0, 255).astype(np.uint8))
+    else:
+        intensity = to_intensity(small)
+        lo, hi = float(intensity.min()), float(intensity.max())
+        scaled = ((intensity - lo) * (255.0 / (hi - lo)) if hi > lo else np.zeros_like(intensity)).astype(np.uint8)
+        rgb = COLORMAP_LUT[scaled]
+        bar = COLORMAP_LUT[np.linspace(255, 0, rgb.shape[0]).astype(np.uint8)]
+        rgb = np.hstack([rgb, np.repeat(bar[:, None, :], COLORBAR_WIDTH, axis=1)])
+        image = Image.fromarray(rgb)
+        draw = ImageDraw.Draw(image)
+        x_bar = image.width - COLORBAR_WIDTH
+        draw.text((x_bar - 4, 2), f"{hi:.0f}", fill="white", anchor="ra")
+        draw.text((x_bar - 4, image.height - 2), f"{lo:.0f}", fill="white", anchor="rd")
+    if label:
+        draw = ImageDraw.Draw(image)
+        draw.rectangle((0, 0, 8 + 6 * len(label), 16), fill="black")
+        draw.text((4, 3), label, fill="white")
+    return image
@@ -0,0 +1,89 @@
+import socketserver
+import threading
+import time
+import xmlrpc.client
+from xmlrpc.server import SimpleXMLRPCRequestHandler, SimpleXMLRPCServer
+
+from cameras import SimulatedCamera
+from scan_store import save_bmp
+
+MOCK_NEW_SINGLE_TIME = 0.02     # seconds a newSingle measurement takes
+MOCK_EXPORT_TIME = 0.005        # seconds of RayCi-side overhead per exportView
+
+
+class _Node:
+    # Attribute path RayCi.LiveMode.Measurement / RayCi.LiveMode.TwoD.View for dotted method names
+    def __init__(self, **children):
+        self.__dict__.update(children)
+
+
+class _QuietHandler(SimpleXMLRPCRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingXMLRPCServer(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class MockRayCi:
+    """
+    Local XML-RPC stand-in for RayCi's LiveMode API. newSingle() renders a synthetic
+    beam frame into the current view (taking `new_single_time`), exportView(i, path)
+    writes that view to a BMP file. The beam comes from a SimulatedCamera, so its
+    `scene` callable can tie the beam to a simulated stage.
+    Serves on localhost; port=0 picks a free port, see `url`.
+    """
+    def __init__(self, port=0, camera=None, new_single_time=MOCK_NEW_SINGLE_TIME, export_time=MOCK_EXPORT_TIME):
+        self.camera = camera or SimulatedCamera()
+        self.new_single_time = new_single_time
+        self.export_time = export_time
+        self.lock = threading.Lock()
+        self.view = None
+        self.calls = {'newSingle': 0, 'exportView': 0}
+        self.server = _ThreadingXMLRPCServer(('127.0.0.1', port), requestHandler=_QuietHandler,
+                                             logRequests=False, allow_none=True)
+        # Dotted names are only ever resolved against this object tree
+        self.server.register_instance(_Node(RayCi=_Node(LiveMode=_Node(
+            Measurement=_Node(newSingle=self.new_single),
+            TwoD=_Node(View=_Node(exportView=self.export_view))))), allow_dotted_names=True)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self.thread = None
+
+    def new_single(self):
+        if self.new_single_time:
+            time.sleep(self.new_single_time)
+        frame = self.camera.frame()
+        with self.lock:
+            self.view = frame
+            self.calls['newSingle'] += 1
+        return True
+
+    def export_view(self, index, filename):
+        if self.export_time:
+            time.sleep(self.export_time)
+        with self.lock:
+            frame = self.view
+            self.calls['exportView'] += 1
+        if frame is None:
+            raise ValueError("No measurement in view")
+        save_bmp(frame, filename)
+        return True
+
+    def proxy(self):
+        return xmlrpc.client.ServerProxy(self.url)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='rayci-mock', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
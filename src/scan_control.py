@@ -0,0 +1,421 @@
+import tkinter as tk
+from tkinter import messagebox, filedialog
+import numpy as np
+import os
+import datetime
+import queue
+from PIL import ImageTk
+from scan_path import CostModel, plan_grid_scan
+from motion import MOTION_MODEL_FILE, StageMotion, get_move_model, load_move_models, save_move_models
+from ds102 import get_controller
+from cameras import make_camera
+from scan_worker import ScanWorker
+from adaptive_scan import AdaptiveScan
+from fly_scan import plan_fly_scan
+from autofocus import FOCUS_AXIS, Autofocus
+from frame_roi import FrameROI, parse_roi
+from scan_journal import ScanJournal, resume_state
+from frame_average import make_averager
+from origins import ORIGIN_CACHE_FILE, ORIGIN_POLL_MS, OriginFetcher
+
+SCAN_POLL_MS = 50
+# Stage that carries the autofocus axis
+FOCUS_STAGE = 'DUT'
+
+class ScanControlMixin:
+    """Scan control shared by the scan GUIs.
+
+    The GUI builds the widgets and supplies stage_groups(), a list of
+    (stage, port, axes, origin dict, axis-name prefix in joint scans), with
+    entries[stage][axis] and check_vars[stage][axis] for every axis listed.
+    Closing the window during a scan aborts it and only destroys the window once
+    the worker has returned the stages to origin.
+    """
+
+    def init_scan_control(self):
+        # Move-time calibration carried over from earlier sessions
+        self.motion_model_path = os.path.join(os.getcwd(), "log", MOTION_MODEL_FILE)
+        load_move_models(self.motion_model_path)
+        self.origin_fetcher = OriginFetcher(os.path.join(os.getcwd(), "log", ORIGIN_CACHE_FILE))
+        self.origin_live = {}
+        self.cameras = {}
+        self.scan_worker = None
+        self.best_result = None
+        self.closing = False
+        # Closing mid-scan must not kill the daemon worker before the stages are back home
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    def scan_log_group(self, enabled):
+        # Subfolder of log/ for a scan over the enabled stage groups
+        return ""
+
+    def set_origin_entry(self, stage, axis, val, live):
+        ent = self.entries[stage][axis]['origin']
+        ent.config(state="normal", fg="black" if live else "gray")
+        ent.delete(0, tk.END)
+        ent.insert(0, str(val))
+        ent.config(state="readonly")
+
+    def refresh_origins(self):
+        for stage, port, axes, origin, _ in self.stage_groups():
+            self.origin_live[port] = False
+            for ax in axes:
+                self.set_origin_entry(stage, ax, origin[ax], False)
+            self.origin_fetcher.fetch(port, axes)
+        self.refresh_origins_btn.config(state="disabled")
+        self.show_origin_status()
+        self.after(ORIGIN_POLL_MS, self.poll_origins)
+
+    def poll_origins(self):
+        groups = {port: (stage, axes, origin) for stage, port, axes, origin, _ in self.stage_groups()}
+        for port, positions in self.origin_fetcher.poll():
+            stage, axes, origin = groups[port]
+            origin.update(positions)
+            self.origin_live[port] = True
+            for ax in axes:
+                self.set_origin_entry(stage, ax, origin[ax], True)
+        self.show_origin_status()
+        if self.origin_fetcher.busy:
+            self.after(ORIGIN_POLL_MS, self.poll_origins)
+        elif self.scan_worker is None:
+            self.refresh_origins_btn.config(state="normal")
+
+    def show_origin_status(self):
+        lines = []
+        for _, port, axes, origin, _ in self.stage_groups():
+            if self.origin_live.get(port):
+                state = "no reply" if all(origin[ax] == 'NA' for ax in axes) else "read"
+            else:
+                _, stamp = self.origin_fetcher.cached(port, axes)
+                cached = f", showing {datetime.datetime.fromtimestamp(stamp):%Y-%m-%d %H:%M}" if stamp else ""
+                state = f"reading...{cached}"
+            lines.append(f"Origins {port}: {state}")
+        self.origin_label.config(text="\n".join(lines))
+
+    def show_preview(self, image):
+        # image is already downsampled to the panel size by the scan worker
+        try:
+            photo = ImageTk.PhotoImage(image)
+            self.image_panel.configure(image=photo, text="")
+            self.image_panel.image = photo
+        except Exception as e:
+            self.image_panel.configure(text="(Image failed to load)")
+
+    def get_camera(self, name):
+        # Cameras stay open between scans (e.g. one Pixelink stream per session)
+        if name not in self.cameras:
+            self.cameras[name] = make_camera(name)
+        return self.cameras[name]
+
+    def start_scan(self):
+        groups = self.stage_groups()
+        autofocus = self.autofocus_var.get()
+        enabled = [g for g in groups if any(self.check_vars[g[0]][ax].get() for ax in g[2]) or (autofocus and g[0] == FOCUS_STAGE)]
+        if not enabled:
+            messagebox.showwarning("No Axis Selected", "Please enable at least one axis for scanning.")
+            return
+        # Cached origins are only for display; homes and start positions need live reads
+        waiting = [port for _, port, _, _, _ in groups if not self.origin_live.get(port)]
+        if waiting:
+            messagebox.showwarning("Origins Pending", f"Still reading origins from {', '.join(waiting)}; try again in a moment.")
+            return
+        focus = None
+        if autofocus:
+            if self.scan_mode_var.get() != 'grid':
+                messagebox.showerror("Input Error", "Autofocus runs with grid scans only.")
+                return
+            try:
+                focus = Autofocus(float(self.entries[FOCUS_STAGE][FOCUS_AXIS]['start'].get()),
+                                  float(self.entries[FOCUS_STAGE][FOCUS_AXIS]['stop'].get()),
+                                  FOCUS_AXIS, self.focus_metric_var.get())
+            except ValueError:
+                messagebox.showerror("Input Error", f"Autofocus needs a {FOCUS_AXIS} start/stop range.")
+                return
+        try:
+            roi = parse_roi(self.roi_mode_var.get(), self.roi_var.get(), self.binning_var.get())
+        except (ValueError, tk.TclError) as e:
+            messagebox.showerror("Input Error", f"ROI: {e}")
+            return
+        # Scans over several stages run on the combined axis set, each stage's axes carrying its prefix
+        joint = len(enabled) > 1
+
+        axes = []
+        columns = {}
+        scan_params = {}
+        axis_costs = {}
+        start_pos = []
+        for stage, port, stage_axes, origin, prefix in enabled:
+            move_model = get_move_model(port)
+            columns[stage] = {}
+            for ax in stage_axes:
+                name = prefix + ax if joint else ax
+                columns[stage][ax] = len(axes)
+                axes.append(name)
+                axis_costs[name] = move_model.axis_cost(ax)
+                start_pos.append(float(origin[ax]) if origin[ax] != 'NA' else 0.0)
+                if focus is not None and stage == FOCUS_STAGE and ax == focus.axis:
+                    # Searched at every point instead of stepped through
+                    scan_params[name] = np.array([focus.center])
+                elif self.check_vars[stage][ax].get():
+                    try:
+                        start = float(self.entries[stage][ax]['start'].get())
+                        stop = float(self.entries[stage][ax]['stop'].get())
+                        step = int(float(self.entries[stage][ax]['step'].get()))
+                        if step < 2:
+                            messagebox.showerror("Input Error", f"Step (count) for {name} must be integer ≥2.")
+                            return
+                        scan_params[name] = np.linspace(start, stop, step)
+                    except Exception:
+                        messagebox.showerror("Input Error", f"Invalid range/step for {name}")
+                        return
+                else:
+                    # Non-selected axis: fixed at origin
+                    origin_val = origin[ax]
+                    if origin_val == 'NA':
+                        messagebox.showerror("Axis Error", f"Origin value not available for {name}")
+                        return
+                    scan_params[name] = np.array([float(origin_val)])
+
+        try:
+            exposures = int(self.exposures_var.get())
+            if exposures < 1:
+                raise ValueError
+        except (ValueError, tk.TclError):
+            messagebox.showerror("Input Error", "Exposures per point must be an integer ≥1.")
+            return
+
+        # Plan visiting order (serpentine etc.) from current position to avoid fly-back.
+        # All controllers move at the same time, so the slowest axis of all sets the step time.
+        cost_model = CostModel(axes, axis_costs, concurrent=True)
+        adaptive = fly = None
+        if self.scan_mode_var.get() == 'fly':
+            # The axis with the most points sweeps without stopping; frames are tagged from its readback
+            try:
+                fly = plan_fly_scan(axes, scan_params, cost_model=cost_model, start=start_pos)
+            except ValueError as e:
+                messagebox.showerror("Input Error", str(e))
+                return
+            positions = None
+            print(f"Fly scan: {fly.summary()}")
+            self.progress_label.config(text=f"Fly scan: {fly.summary()}")
+        elif self.scan_mode_var.get() == 'adaptive':
+            if self.storage_var.get() != 'bmp':
+                messagebox.showerror("Input Error", "Adaptive scans visit an irregular point set; use BMP storage.")
+                return
+            try:
+                tolerance = float(self.tolerance_var.get())
+            except (ValueError, tk.TclError):
+                messagebox.showerror("Input Error", "Invalid adaptive tolerance.")
+                return
+            # Points are generated level by level from the frame scores
+            adaptive = AdaptiveScan(axes, scan_params, self.metric_var.get(), tolerance)
+            positions = None
+            self.progress_label.config(text=f"Adaptive scan on {self.metric_var.get()}, tolerance {tolerance:g} pulse")
+        else:
+            plan = plan_grid_scan(axes, scan_params, cost_model, start=start_pos)
+            positions = plan.positions
+            print(f"Scan plan: {plan.summary()}")
+            self.progress_label.config(text=f"Planned {plan.summary()}")
+        self.update()
+
+        # Every stage gets a controller; stages without scanned columns are held at their origin.
+        # Axes already at their read-back origin are never re-sent.
+        stages = []
+        stage_plan = []
+        try:
+            for stage, port, stage_axes, origin, _ in groups:
+                ctrl = get_controller(port)
+                ctrl.open()
+                home = {ax: float(origin[ax]) if origin[ax] != 'NA' else 0.0 for ax in stage_axes}
+                stages.append((StageMotion(ctrl, origin), columns.get(stage, {}), home))
+                stage_plan.append({'port': port, 'columns': columns.get(stage, {}), 'home': home})
+        except Exception as e:
+            messagebox.showerror("Serial Error", str(e))
+            return
+
+        try:
+            camera = self.get_camera(self.camera_var.get())
+        except Exception as e:
+            messagebox.showerror("Camera Error", str(e))
+            return
+
+        # Created only once every input checked out, so failed starts leave no empty scan folders
+        log_root = os.path.join(os.getcwd(), "log", self.scan_log_group(enabled))
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        log_dir = os.path.join(log_root, timestamp)
+        os.makedirs(log_dir, exist_ok=True)
+        journal = ScanJournal(log_dir)
+        if positions is not None:
+            # Written before the first move so an interrupted scan can be resumed
+            journal.write_plan({
+                'axes': list(axes), 'grid': positions.to_dict(),
+                'scan_params': {ax: [float(v) for v in vals] for ax, vals in scan_params.items()},
+                'stages': stage_plan,
+                'storage': self.storage_var.get(), 'exposures': exposures, 'burst': self.burst_var.get(),
+                'camera': self.camera_var.get(), 'preview_overlay': self.preview_overlay_var.get(),
+                'autofocus': focus.to_dict() if focus is not None else None,
+                'roi': roi.to_dict(),
+            })
+        # Scan runs on a worker thread; progress comes back through poll_scan
+        self.launch_scan(ScanWorker(axes, positions, log_dir, stages, camera, exposures,
+                                    preview_overlay=self.preview_overlay_var.get(),
+                                    storage=self.storage_var.get(), scan_params=scan_params,
+                                    adaptive=adaptive, cost_model=cost_model, journal=journal,
+                                    averager=make_averager(self.burst_var.get()), fly=fly, autofocus=focus,
+                                    roi=roi))
+
+    def launch_scan(self, worker):
+        self.scan_worker = worker
+        self.best_result = None
+        self.scan_worker.start()
+        self.set_scan_running(True)
+        self.after(SCAN_POLL_MS, self.poll_scan)
+
+    def resume_scan(self):
+        log_dir = filedialog.askdirectory(title="Select interrupted scan", initialdir=os.path.join(os.getcwd(), "log"))
+        if not log_dir:
+            return
+        try:
+            plan, remaining, todo = resume_state(log_dir)
+        except (OSError, ValueError, KeyError) as e:
+            messagebox.showerror("Resume Error", f"No resumable scan plan in {log_dir}: {e}")
+            return
+        if not len(todo):
+            messagebox.showinfo("Resume Scan", "All points of this scan are already complete.")
+            return
+
+        try:
+            stages = []
+            for s in plan['stages']:
+                ctrl = get_controller(s['port'])
+                ctrl.open()
+                # Positions after a crash are unknown, so every axis is re-sent once
+                stages.append((StageMotion(ctrl), s['columns'], s['home']))
+        except Exception as e:
+            messagebox.showerror("Serial Error", str(e))
+            return
+        try:
+            camera = self.get_camera(plan['camera'])
+        except Exception as e:
+            messagebox.showerror("Camera Error", str(e))
+            return
+
+        scan_params = {ax: np.asarray(vals) for ax, vals in plan['scan_params'].items()}
+        self.progress_label.config(text=f"Resuming: {len(todo)} points left")
+        self.update()
+        self.launch_scan(ScanWorker(plan['axes'], remaining, log_dir, stages, camera, plan['exposures'],
+                                    preview_overlay=plan['preview_overlay'], storage=plan['storage'],
+                                    scan_params=scan_params, journal=ScanJournal(log_dir), indices=todo,
+                                    averager=make_averager(plan.get('burst', 'frames')),
+                                    autofocus=Autofocus.from_dict(plan['autofocus']) if plan.get('autofocus') else None,
+                                    roi=FrameROI.from_dict(plan['roi']) if plan.get('roi') else None))
+
+    def set_scan_running(self, running):
+        self.start_btn.config(state="disabled" if running else "normal")
+        # Manual moves share the scan's controller and would leave its position bookkeeping stale
+        self.unitset_btn.config(state="disabled" if running else "normal")
+        self.resume_scan_btn.config(state="disabled" if running else "normal")
+        self.refresh_origins_btn.config(state="disabled" if running or self.origin_fetcher.busy else "normal")
+        self.pause_btn.config(state="normal" if running else "disabled", text="Pause")
+        self.abort_btn.config(state="normal" if running else "disabled")
+
+    def toggle_pause(self):
+        worker = self.scan_worker
+        if worker is None:
+            return
+        if worker.paused:
+            worker.resume()
+            self.pause_btn.config(text="Pause")
+        else:
+            worker.pause()
+            self.pause_btn.config(text="Resume")
+
+    def abort_scan(self):
+        if self.scan_worker is not None:
+            self.scan_worker.abort()
+            self.abort_btn.config(state="disabled")
+
+    def on_close(self):
+        if self.scan_worker is None:
+            self.close_window()
+            return
+        if self.closing:
+            return
+        self.closing = True
+        self.abort_scan()
+        self.progress_label.config(text="Aborting scan; closing once all axes are back at origin...")
+
+    def close_window(self):
+        for camera in self.cameras.values():
+            try:
+                camera.close()
+            except Exception as e:
+                print(f"Closing camera failed: {e}")
+        self.destroy()
+
+    def poll_scan(self):
+        worker = self.scan_worker
+        latest_preview = None
+        latest_metrics = None
+        finished = None
+        while True:
+            try:
+                kind, *payload = worker.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'progress':
+                self.progress_label.config(text=f"Iteration {payload[0]} of {payload[1]}")
+            elif kind == 'preview':
+                latest_preview = payload[0]
+            elif kind == 'state' and payload[0] != 'running':
+                self.progress_label.config(text=f"Scan {payload[0]}...")
+            elif kind == 'metrics':
+                latest_metrics = payload[1]
+            elif kind == 'timing':
+                self.timing_label.config(text=payload[0])
+            elif kind == 'best':
+                self.best_result = payload
+            elif kind == 'warning':
+                messagebox.showwarning("Scan Warning", payload[0])
+            elif kind == 'error':
+                messagebox.showerror("Scan Error", payload[0])
+            elif kind == 'done':
+                finished = payload
+        # Only the newest preview of this poll is shown
+        if latest_preview is not None:
+            self.show_preview(latest_preview)
+        if latest_metrics is not None:
+            m = latest_metrics
+            self.metrics_label.config(
+                text=f"Centroid ({m['centroid_x']:.1f}, {m['centroid_y']:.1f}) px   "
+                     f"D4σ {m['d4s_x']:.1f} × {m['d4s_y']:.1f} px   ellipticity {m['ellipticity']:.2f}   "
+                     f"peak {m['peak']:.0f}   power {m['total_power']:.3g}")
+        if finished is None:
+            self.after(SCAN_POLL_MS, self.poll_scan)
+            return
+        self.scan_worker = None
+        self.set_scan_running(False)
+        self.save_motion_model()
+        if self.closing:
+            self.close_window()
+            return
+        done, aborted = finished
+        if aborted:
+            messagebox.showinfo("Scan Aborted", f"Scan aborted after {done} points; all axes returned to origin.")
+        else:
+            msg = "Scan complete and all axes returned to origin."
+            if self.best_result:
+                best, score = self.best_result
+                msg += "\nBest point: " + ', '.join(f"{ax}={int(v)}" for ax, v in best.items()) + f" (score {score:.4g})"
+            messagebox.showinfo("Scan Completed", msg)
+
+    def save_motion_model(self):
+        try:
+            os.makedirs(os.path.dirname(self.motion_model_path), exist_ok=True)
+            save_move_models(self.motion_model_path)
+        except OSError as e:
+            print(f"Could not save motion calibration: {e}")
+        for _, port, _, _, _ in self.stage_groups():
+            summary = get_move_model(port).summary()
+            if summary:
+                print(f"Move timing on {port}:\n{summary}")
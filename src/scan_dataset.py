@@ -0,0 +1,278 @@
+import json
+import os
+import struct
+import numpy as np
+
+from scan_journal import PLAN_FILE
+
+DATASET_INDEX_FILE = 'frames_index.npz'
+INDEX_VERSION = 1
+_BMP_HEADER = 54        # BITMAPFILEHEADER + BITMAPINFOHEADER
+_BMP_DIRECT = (8, 24, 32)
+
+
+def parse_frame_name(name):
+    # 'x_100_y_-20[_e3].bmp' (see scan_worker.frame_filename) -> (axes, values, exposure or -1); None otherwise
+    stem, ext = os.path.splitext(name)
+    if ext.lower() != '.bmp':
+        return None
+    parts = stem.split('_')
+    exposure = -1
+    if len(parts) % 2 and parts[-1][:1] == 'e' and parts[-1][1:].isdigit():
+        exposure = int(parts.pop()[1:])
+    if not parts or len(parts) % 2:
+        return None
+    try:
+        values = [int(v) for v in parts[1::2]]
+    except ValueError:
+        return None
+    return parts[::2], values, exposure
+
+
+def read_bmp_layout(path):
+    """
+    (pixel data offset, height, width, bits per pixel, top-down, direct) from a BMP
+    header. direct: the pixel rows can be mapped as they are (uncompressed 8-bit
+    grayscale, 24- or 32-bit); anything else is decoded with PIL on access.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(_BMP_HEADER)
+        if len(header) < _BMP_HEADER or header[:2] != b'BM':
+            raise ValueError(f"{path}: not a BMP file")
+        offset, dib_size = struct.unpack_from('<II', header, 10)
+        width, height, _, bpp, compression = struct.unpack_from('<iiHHI', header, 18)
+        direct = compression == 0 and bpp in _BMP_DIRECT
+        if direct and bpp == 8:
+            # PIL writes 8-bit frames with an identity gray palette; other palettes need a lookup
+            colors = struct.unpack_from('<I', header, 46)[0] or 256
+            f.seek(14 + dib_size)
+            palette = np.frombuffer(f.read(4 * colors), dtype=np.uint8).reshape(-1, 4)[:, :3]
+            direct = np.array_equal(palette, np.repeat(np.arange(len(palette), dtype=np.uint8)[:, None], 3, axis=1))
+        f.seek(0, os.SEEK_END)
+        if f.tell() < offset + (width * bpp + 31) // 32 * 4 * abs(height):
+            raise ValueError(f"{path}: truncated")
+    return offset, abs(height), width, bpp, height < 0, direct
+
+
+def _bmp_names(log_dir):
+    with os.scandir(log_dir) as it:
+        return sorted(e.name for e in it if e.name.lower().endswith('.bmp') and e.is_file())
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return -1
+
+
+def _index_current(log_dir, index):
+    # Same BMP files as when the index was built, and skipped frames not rewritten since
+    listed = sorted(list(index['names']) + list(index['skipped']))
+    if listed != _bmp_names(log_dir):
+        return False
+    return all(size < 0 or _size(os.path.join(log_dir, name)) == size
+               for name, size in zip(index['skipped'], index['skipped_size']))
+
+
+def _plan_axes(log_dir):
+    try:
+        with open(os.path.join(log_dir, PLAN_FILE)) as f:
+            return json.load(f).get('axes')
+    except (OSError, ValueError):
+        return None
+
+
+def build_index(log_dir, previous=None):
+    """
+    Positions index of the BMP frames in a scan log directory: one row per file with
+    its axis values (from the file name), burst exposure and BMP layout. Rows of
+    `previous` (an earlier index) are reused for files that are still there, so only
+    new frames have their headers read. Other BMPs and unreadable (e.g. torn) frames
+    are listed under 'skipped', the latter with their size so a rewrite is noticed.
+    """
+    names = _bmp_names(log_dir)
+    known = {}
+    if previous is not None:
+        known = {name: i for i, name in enumerate(previous['names'])}
+    axes = list(previous['axes']) if previous is not None and len(previous['names']) else None
+    rows, layouts, kept, skipped = [], [], [], []
+    for name in names:
+        parsed = parse_frame_name(name)
+        if parsed is None:
+            skipped.append((name, -1))
+            continue
+        keys, values, exposure = parsed
+        if axes is None:
+            # Axis order and case from plan.json when there is one, else from the first file name
+            plan_axes = _plan_axes(log_dir) or []
+            by_key = {ax.lower(): ax for ax in plan_axes}
+            axes = [by_key.get(k, k.upper()) for k in keys]
+        if keys != [ax.lower() for ax in axes]:
+            skipped.append((name, -1))
+            continue
+        if name in known:
+            i = known[name]
+            layout = tuple(previous[k][i] for k in ('offset', 'height', 'width', 'bpp', 'top_down', 'direct'))
+        else:
+            path = os.path.join(log_dir, name)
+            try:
+                layout = read_bmp_layout(path)
+            except (OSError, ValueError, struct.error):
+                skipped.append((name, _size(path)))
+                continue
+        kept.append(name)
+        rows.append(values + [exposure])
+        layouts.append(layout)
+    axes = axes or []
+    rows = np.array(rows, dtype=np.int64).reshape(-1, len(axes) + 1)
+    layouts = list(zip(*layouts)) or [()] * 6
+    skipped = list(zip(*skipped)) or [(), ()]
+    return {
+        'version': INDEX_VERSION, 'axes': np.array(axes, dtype=str), 'names': np.array(kept, dtype=str),
+        'positions': rows[:, :-1].astype(float), 'exposure': rows[:, -1],
+        'offset': np.array(layouts[0], dtype=np.int64), 'height': np.array(layouts[1], dtype=np.int32),
+        'width': np.array(layouts[2], dtype=np.int32), 'bpp': np.array(layouts[3], dtype=np.int16),
+        'top_down': np.array(layouts[4], dtype=bool), 'direct': np.array(layouts[5], dtype=bool),
+        'skipped': np.array(skipped[0], dtype=str), 'skipped_size': np.array(skipped[1], dtype=np.int64),
+    }
+
+
+def load_index(log_dir):
+    try:
+        with np.load(os.path.join(log_dir, DATASET_INDEX_FILE)) as data:
+            index = {k: data[k] for k in data.files}
+    except (OSError, ValueError, KeyError):
+        return None
+    return index if int(index.get('version', 0)) == INDEX_VERSION else None
+
+
+def save_index(log_dir, index):
+    path = os.path.join(log_dir, DATASET_INDEX_FILE)
+    tmp = path + '.tmp.npz'
+    np.savez(tmp, **index)
+    os.replace(tmp, path)
+
+
+def open_scan(log_dir, rebuild=False):
+    """
+    ScanDataset for a scan log directory. The index is cached in
+    log_dir/frames_index.npz; opening again only lists the directory and reads the
+    headers of frames added since (e.g. a resumed scan).
+    """
+    cached = None if rebuild else load_index(log_dir)
+    index = cached
+    if cached is None or not _index_current(log_dir, cached):
+        index = build_index(log_dir, cached)
+        try:
+            save_index(log_dir, index)
+        except OSError as e:
+            # Read-only archive: the index is simply rebuilt next time
+            print(f"Saving frame index failed: {e}")
+    return ScanDataset(log_dir, index)
+
+
+class ScanDataset:
+    """
+    Frames of one scan log directory, addressed by axis value.
+
+        ds = open_scan('log/DUT/2024-05-01_101500')
+        sub = ds.sel(x=1200, z=slice(0, 500))
+        frame = sub[0]          # read-only uint8 view on the mapped file, (h, w) or (h, w, 3) RGB
+
+    Frames are memory-mapped: nothing is read until a pixel is touched, and only the
+    pages touched are. stack() copies a selection into one array. Axis names are
+    case-insensitive; 'exposure' selects frames of a burst stored as one file per
+    exposure (-1 for single frames).
+    """
+    def __init__(self, log_dir, index, rows=None):
+        self.log_dir = log_dir
+        self.index = index
+        self.axes = [str(ax) for ax in index['axes']]
+        self.rows = np.arange(len(index['names'])) if rows is None else rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def positions(self):
+        return self.index['positions'][self.rows]
+
+    @property
+    def exposure(self):
+        return self.index['exposure'][self.rows]
+
+    @property
+    def files(self):
+        return [os.path.join(self.log_dir, name) for name in self.index['names'][self.rows]]
+
+    @property
+    def coords(self):
+        # axis -> sorted distinct values in this selection
+        positions = self.positions
+        return {ax: np.unique(positions[:, k]) for k, ax in enumerate(self.axes)}
+
+    def _column(self, key):
+        if key.lower() == 'exposure':
+            return self.exposure
+        for k, ax in enumerate(self.axes):
+            if ax.lower() == key.lower():
+                return self.positions[:, k]
+        raise ValueError(f"No axis {key} in this scan (axes: {', '.join(self.axes)})")
+
+    def sel(self, **selection):
+        # Label-based: a value, a list of values, or slice(lo, hi) with both ends included
+        mask = np.ones(len(self.rows), dtype=bool)
+        for key, want in selection.items():
+            col = self._column(key)
+            if isinstance(want, slice):
+                if want.step is not None:
+                    raise ValueError(f"{key}: slice steps are not supported")
+                if want.start is not None:
+                    mask &= col >= want.start
+                if want.stop is not None:
+                    mask &= col <= want.stop
+            elif np.ndim(want):
+                mask &= np.isin(col, np.rint(np.asarray(want, dtype=float)))
+            else:
+                mask &= col == np.rint(float(want))
+        return ScanDataset(self.log_dir, self.index, self.rows[mask])
+
+    def frame(self, i):
+        row = self.rows[i]
+        index = self.index
+        path = os.path.join(self.log_dir, str(index['names'][row]))
+        if not index['direct'][row]:
+            from PIL import Image
+            with Image.open(path) as img:
+                return np.asarray(img.convert('L') if img.mode == 'P' else img)
+        height, width, bpp = int(index['height'][row]), int(index['width'][row]), int(index['bpp'][row])
+        channels = bpp // 8
+        stride = (width * bpp + 31) // 32 * 4
+        raw = np.memmap(path, dtype=np.uint8, mode='r', offset=int(index['offset'][row]), shape=(height, stride))
+        frame = raw[:, :width * channels]
+        if channels > 1:
+            # Stored BGR(A); the reversed channel view is RGB
+            frame = frame.reshape(height, width, channels)[..., 2::-1]
+        return frame if index['top_down'][row] else frame[::-1]
+
+    def __getitem__(self, i):
+        return self.frame(i)
+
+    def __iter__(self):
+        return (self.frame(i) for i in range(len(self)))
+
+    def stack(self):
+        # All selected frames in one (n, h, w[, 3]) array; frames must share a shape
+        if not len(self):
+            raise ValueError("Empty selection")
+        first = self.frame(0)
+        out = np.empty((len(self),) + first.shape, dtype=first.dtype)
+        for i, frame in enumerate(self):
+            out[i] = frame
+        return out
+
+    def summary(self):
+        coords = self.coords
+        return f"{len(self)} frames, " + ', '.join(
+            f"{ax} {len(vals)} values {vals[0]:g}..{vals[-1]:g}" if len(vals) else f"{ax} -" for ax, vals in coords.items())
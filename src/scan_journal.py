@@ -0,0 +1,133 @@
+import json
+import os
+import struct
+import threading
+
+PLAN_FILE = 'plan.json'
+JOURNAL_FILE = 'journal.jsonl'
+
+
+class ScanJournal:
+    """
+    Write-ahead record of a scan in its log directory: plan.json holds the planned
+    points (a GridPoints description under 'grid', or an explicit 'positions' list) and
+    settings, written once, atomically; journal.jsonl gets one fsync'ed line per point
+    whose frame is safely on disk.
+    """
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.plan_path = os.path.join(log_dir, PLAN_FILE)
+        self.journal_path = os.path.join(log_dir, JOURNAL_FILE)
+        self.lock = threading.Lock()
+        self.file = None
+
+    def write_plan(self, plan):
+        tmp = self.plan_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(plan, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.plan_path)
+
+    def open(self):
+        self.file = open(self.journal_path, 'a')
+        if self.file.tell() and not _ends_with_newline(self.journal_path):
+            # Terminate a torn last line so the next entry starts cleanly
+            self.file.write('\n')
+        return self
+
+    def record(self, index, pos, readback=None, files=None, h5_row=None, timestamp=None, roi=None):
+        entry = {'index': int(index), 'pos': [float(v) for v in pos], 'readback': readback or {},
+                 'files': [os.path.basename(f) for f in files or []], 'h5_row': h5_row, 'time': timestamp}
+        if roi is not None:
+            # Sensor window (x0, y0, x1, y1) the stored frames were cut from
+            entry['roi'] = [int(v) for v in roi]
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def _ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
+def load_plan(log_dir):
+    with open(os.path.join(log_dir, PLAN_FILE)) as f:
+        return json.load(f)
+
+
+def plan_points(plan):
+    if 'grid' in plan:
+        from scan_path import GridPoints
+        return GridPoints.from_dict(plan['grid'])
+    import numpy as np
+    return np.asarray(plan['positions'], dtype=float)
+
+
+def read_journal(log_dir):
+    entries = {}
+    path = os.path.join(log_dir, JOURNAL_FILE)
+    if not os.path.exists(path):
+        return entries
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A torn last line from a crash; that point is simply redone
+                continue
+            entries[entry['index']] = entry
+    return entries
+
+
+def bmp_complete(path):
+    # The BMP header stores the total file size; a truncated write will not match it
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(6)
+        return len(header) == 6 and header[:2] == b'BM' and struct.unpack('<I', header[2:])[0] == os.path.getsize(path)
+    except OSError:
+        return False
+
+
+def _h5_rows(log_dir):
+    from scan_store import H5_FILENAME, open_h5_scan
+    if not os.path.exists(os.path.join(log_dir, H5_FILENAME)):
+        return 0
+    try:
+        with open_h5_scan(log_dir) as f:
+            return len(f['positions'])
+    except Exception:
+        return 0
+
+
+def verify_entry(log_dir, entry, h5_rows=0):
+    if entry.get('h5_row') is not None and entry['h5_row'] >= h5_rows:
+        return False
+    return all(bmp_complete(os.path.join(log_dir, name)) for name in entry.get('files', []))
+
+
+def resume_state(log_dir):
+    """
+    (plan, remaining points, their indices in the plan) for an interrupted scan.
+    Journal entries count as done only if their frames verify on disk. The indices
+    are IndexRanges built from the gaps between the done points, so for grid plans
+    neither they nor the remaining points (a lazy GridPoints subset) grow with the grid.
+    """
+    import numpy as np
+    from scan_path import IndexRanges
+    plan = load_plan(log_dir)
+    points = plan_points(plan)
+    entries = read_journal(log_dir)
+    h5_rows = _h5_rows(log_dir) if any(e.get('h5_row') is not None for e in entries.values()) else 0
+    done = np.fromiter((i for i, e in entries.items() if verify_entry(log_dir, e, h5_rows)), dtype=np.int64)
+    todo = IndexRanges.complement(len(points), done)
+    return plan, points.take(todo) if 'grid' in plan else points[np.asarray(todo)], todo
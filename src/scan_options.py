@@ -0,0 +1,13 @@
+"""
+Allowed values of the scan settings, kept free of heavy imports (numpy, h5py, the
+camera stack) so recipes and GUI fields can be checked without loading them. The
+modules that implement the options re-export their tuple from here.
+"""
+
+CAMERA_BACKENDS = ('rayci', 'pixelink', 'simulated')
+STORAGE_MODES = ('bmp', 'hdf5', 'both')
+# How the exposures of a burst are stored: every frame, or one averaged frame
+# ('mean+std' adds the per-pixel standard deviation, 'clipped' also rejects outliers)
+BURST_MODES = ('frames', 'mean', 'mean+std', 'clipped')
+SCAN_MODES = ('grid', 'adaptive', 'fly')
+FLY_TRIGGERS = ('position', 'time')
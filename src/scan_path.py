@@ -0,0 +1,338 @@
+import itertools
+import numpy as np
+
+# Rough DS102 defaults; override per axis with AxisCost when known.
+DEFAULT_AXIS_SPEED = 2000.0    # pulses per second
+DEFAULT_AXIS_SETTLE = 0.05     # seconds spent settling / polling after each move
+
+# Above this many points nearest-neighbour ordering (O(N^2)) is not attempted.
+MAX_GREEDY_POINTS = 5000
+# Points materialised at a time when iterating a lazy grid
+POINT_CHUNK = 4096
+
+
+class AxisCost:
+    def __init__(self, speed=DEFAULT_AXIS_SPEED, settle=DEFAULT_AXIS_SETTLE):
+        self.speed = float(speed)
+        self.settle = float(settle)
+
+    def move_times(self, distances):
+        distances = np.abs(np.asarray(distances, dtype=float))
+        return np.where(distances > 0, distances / self.speed + self.settle, 0.0)
+
+
+class CostModel:
+    """
+    Time model for moving a stage between scan points.
+    With concurrent=False axes are moved one after another (time is the sum per axis),
+    otherwise they move together and the slowest axis sets the time.
+    """
+    def __init__(self, axes, axis_costs=None, concurrent=False):
+        self.axes = list(axes)
+        axis_costs = axis_costs or {}
+        self.axis_costs = [axis_costs.get(ax, AxisCost()) for ax in self.axes]
+        self.concurrent = concurrent
+
+    def step_times(self, positions, start=None):
+        positions = np.asarray(positions, dtype=float)
+        if start is not None:
+            positions = np.vstack([np.asarray(start, dtype=float)[None, :], positions])
+        deltas = np.diff(positions, axis=0)
+        per_axis = np.column_stack([c.move_times(deltas[:, i]) for i, c in enumerate(self.axis_costs)]) \
+            if len(deltas) else np.zeros((0, len(self.axes)))
+        return per_axis.max(axis=1) if self.concurrent else per_axis.sum(axis=1)
+
+    def total_time(self, positions, start=None):
+        if isinstance(positions, GridPoints):
+            return positions.motion_time(self, start)
+        return float(self.step_times(positions, start).sum())
+
+    def travel(self, positions, start=None):
+        if isinstance(positions, GridPoints):
+            return positions.travel(self.axes, start)
+        positions = np.asarray(positions, dtype=float)
+        if start is not None:
+            positions = np.vstack([np.asarray(start, dtype=float)[None, :], positions])
+        dist = np.abs(np.diff(positions, axis=0)).sum(axis=0)
+        return {ax: float(d) for ax, d in zip(self.axes, dist)}
+
+
+class ScanPlan:
+    def __init__(self, axes, positions, strategy, cost_model, start=None):
+        self.axes = list(axes)
+        self.positions = positions
+        self.strategy = strategy
+        self.predicted_time = cost_model.total_time(positions, start)
+        self.predicted_travel = cost_model.travel(positions, start)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def summary(self):
+        travel = ', '.join(f"{ax}={d:.0f}" for ax, d in self.predicted_travel.items() if d)
+        return (f"{len(self)} points, {self.strategy} order, "
+                f"travel [{travel or 'none'}] pulses, est. motion {format_duration(self.predicted_time)}")
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return f"{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class IndexRanges:
+    """
+    Sorted, disjoint half-open index ranges (starts, stops) behaving like the int
+    array of all indices in them, without materialising it: len(), item and
+    array lookups, iteration. Used for the points left over when resuming a scan.
+    """
+    def __init__(self, starts, stops):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.stops = np.asarray(stops, dtype=np.int64)
+        # Position in the whole sequence at which each range begins
+        self.offsets = np.concatenate([[0], np.cumsum(self.stops - self.starts)]).astype(np.int64)
+
+    @classmethod
+    def complement(cls, n, done):
+        # The indices 0..n-1 not in `done`: the gaps between the sorted done indices plus the tail
+        done = np.unique(np.asarray(done, dtype=np.int64))
+        done = done[(done >= 0) & (done < n)]
+        starts = np.concatenate([[0], done + 1])
+        stops = np.concatenate([done, [n]])
+        keep = stops > starts
+        return cls(starts[keep], stops[keep])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def lookup(self, lin):
+        lin = np.asarray(lin, dtype=np.int64)
+        k = np.searchsorted(self.offsets, lin, side='right') - 1
+        return self.starts[k] + (lin - self.offsets[k])
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            n = len(self)
+            if not -n <= key < n:
+                raise IndexError("index out of range")
+            return int(self.lookup(key % n))
+        if isinstance(key, slice):
+            return self.lookup(np.arange(*key.indices(len(self)), dtype=np.int64))
+        return self.lookup(key)
+
+    def __iter__(self):
+        for start, stop in zip(self.starts.tolist(), self.stops.tolist()):
+            yield from range(start, stop)
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:]
+        return out if dtype is None else out.astype(dtype)
+
+
+class GridPoints:
+    """
+    Lazy point list of a grid scan, in visiting order, without materialising the
+    Cartesian product. `nest` lists the axis columns from the outermost to the
+    innermost loop; strategy is 'raster' (row-major, like meshgrid(indexing='ij'))
+    or 'serpentine' (N-D boustrophedon: every other sweep of each inner block is
+    reversed, so consecutive points differ by one step on exactly one axis).
+
+    points[k] is one point (columns in axis order), points[a:b] or points[index_array]
+    a dense (n, n_axes) block, iteration goes chunk by chunk (POINT_CHUNK points), and
+    take() / shard() give lazy subsets by linear index, for resuming or splitting a scan.
+    """
+    def __init__(self, grids, nest=None, strategy='raster', indices=None):
+        self.grids = [np.asarray(g, dtype=float) for g in grids]
+        self.nest = list(range(len(self.grids))) if nest is None else list(nest)
+        self.strategy = strategy
+        self.shape = tuple(len(self.grids[i]) for i in self.nest)
+        self.size = int(np.prod(self.shape, dtype=np.int64))
+        # None (whole grid), a range, IndexRanges or an int array of linear indices into the full order
+        self.indices = indices
+
+    def __len__(self):
+        return self.size if self.indices is None else len(self.indices)
+
+    def _linear(self, key):
+        n = len(self)
+        if isinstance(key, slice):
+            lin = np.arange(*key.indices(n), dtype=np.int64)
+        else:
+            lin = np.asarray(key)
+            if lin.dtype == bool:
+                lin = np.flatnonzero(lin)
+            lin = np.where(lin < 0, lin + n, lin).astype(np.int64)
+            if lin.size and (lin.min() < 0 or lin.max() >= n):
+                raise IndexError("point index out of range")
+        if self.indices is None:
+            return lin
+        if isinstance(self.indices, range):
+            return self.indices.start + lin * self.indices.step
+        if isinstance(self.indices, IndexRanges):
+            return self.indices.lookup(lin)
+        return np.asarray(self.indices)[lin]
+
+    def _points(self, lin):
+        # Grid index per nesting level for linear positions in the visiting order
+        idx = []
+        k = lin
+        for j, n in enumerate(self.shape):
+            inner = int(np.prod(self.shape[j + 1:], dtype=np.int64))
+            i, k = np.divmod(k, inner)
+            if self.strategy == 'serpentine':
+                # Every odd block of this level runs the inner sweep backwards
+                k = np.where(i % 2 == 1, inner - 1 - k, k)
+            idx.append(i)
+        out = np.empty((len(lin), len(self.grids)))
+        for col, i in zip(self.nest, idx):
+            out[:, col] = self.grids[col][i]
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self._points(self._linear([key]))[0]
+        return self._points(self._linear(key))
+
+    def chunks(self, size=POINT_CHUNK):
+        for start in range(0, len(self), size):
+            yield self[start:start + size]
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            yield from chunk
+
+    def __array__(self, dtype=None, copy=None):
+        points = self[:]
+        return points if dtype is None else points.astype(dtype)
+
+    def take(self, indices):
+        # Lazy subset; indices are positions in this list (a range or IndexRanges stays compact)
+        if isinstance(indices, (range, IndexRanges)) and self.indices is None:
+            return GridPoints(self.grids, self.nest, self.strategy, indices)
+        return GridPoints(self.grids, self.nest, self.strategy, self._linear(np.asarray(indices)))
+
+    def shard(self, k, n):
+        # k-th of n contiguous parts
+        total = len(self)
+        return self.take(range(total * k // n, total * (k + 1) // n))
+
+    def to_dict(self):
+        return {'grids': [g.tolist() for g in self.grids], 'nest': self.nest, 'strategy': self.strategy}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['grids'], data['nest'], data['strategy'])
+
+    def _level_outer(self, j):
+        return int(np.prod(self.shape[:j], dtype=np.int64))
+
+    def motion_time(self, cost_model, start=None):
+        # Closed form for a whole grid: every step between neighbouring grid values of a
+        # level is taken once per outer block, raster additionally flies all inner axes back
+        if self.indices is not None:
+            return _chunked_time(self, cost_model, start)
+        costs = [cost_model.axis_costs[col] for col in self.nest]
+        flyback = [float(c.move_times([self.grids[col][-1] - self.grids[col][0]])[0])
+                   for c, col in zip(costs, self.nest)]
+        total = float(cost_model.step_times(self[:1], start).sum()) if start is not None else 0.0
+        for j, col in enumerate(self.nest):
+            steps = costs[j].move_times(np.diff(self.grids[col]))
+            if self.strategy == 'raster' and j + 1 < len(self.nest):
+                inner = flyback[j + 1:]
+                steps = np.maximum(steps, max(inner)) if cost_model.concurrent else steps + sum(inner)
+            total += self._level_outer(j) * float(steps.sum())
+        return total
+
+    def travel(self, axes, start=None):
+        if self.indices is not None:
+            return _chunked_travel(self, axes, start)
+        dist = np.zeros(len(self.grids))
+        if start is not None:
+            dist += np.abs(self[0] - np.asarray(start, dtype=float))
+        for j, col in enumerate(self.nest):
+            g = self.grids[col]
+            outer = self._level_outer(j)
+            dist[col] += outer * float(np.abs(np.diff(g)).sum())
+            if self.strategy == 'raster':
+                dist[col] += (outer - 1) * abs(g[-1] - g[0])
+        return {ax: float(d) for ax, d in zip(axes, dist)}
+
+
+def _chunked_time(points, cost_model, start=None):
+    total, prev = 0.0, start
+    for chunk in points.chunks():
+        total += float(cost_model.step_times(chunk, prev).sum())
+        prev = chunk[-1]
+    return total
+
+
+def _chunked_travel(points, axes, start=None):
+    dist, prev = np.zeros(len(axes)), start
+    for chunk in points.chunks():
+        if prev is not None:
+            chunk = np.vstack([np.asarray(prev, dtype=float)[None, :], chunk])
+        dist += np.abs(np.diff(chunk, axis=0)).sum(axis=0)
+        prev = chunk[-1]
+    return {ax: float(d) for ax, d in zip(axes, dist)}
+
+
+def nearest_neighbour_order(points, cost_model, start=None):
+    points = np.asarray(points, dtype=float)
+    n = len(points)
+    if n == 0:
+        return np.zeros(0, dtype=int)
+    remaining = np.ones(n, dtype=bool)
+    order = np.empty(n, dtype=int)
+    current = np.asarray(start, dtype=float) if start is not None else points[0]
+    speeds = np.array([c.speed for c in cost_model.axis_costs])
+    settles = np.array([c.settle for c in cost_model.axis_costs])
+    for k in range(n):
+        delta = np.abs(points - current)
+        per_axis = np.where(delta > 0, delta / speeds + settles, 0.0)
+        cost = per_axis.max(axis=1) if cost_model.concurrent else per_axis.sum(axis=1)
+        cost[~remaining] = np.inf
+        nxt = int(np.argmin(cost))
+        order[k] = nxt
+        remaining[nxt] = False
+        current = points[nxt]
+    return order
+
+
+def plan_grid_scan(axes, scan_params, cost_model=None, start=None, strategies=('raster', 'serpentine')):
+    """
+    Choose the cheapest visiting order for the Cartesian grid given by scan_params
+    (axis -> 1-D array of positions). Candidates are every requested strategy over
+    every nesting order of the scanned axes; the result keeps the columns in `axes` order.
+    Positions are a lazy GridPoints and candidates are costed in closed form, so
+    planning time and memory do not grow with the number of points.
+    """
+    axes = list(axes)
+    cost_model = cost_model or CostModel(axes)
+    grids = [np.asarray(scan_params[ax], dtype=float) for ax in axes]
+    scanned = [i for i, g in enumerate(grids) if len(g) > 1]
+    fixed = [i for i in range(len(axes)) if i not in scanned]
+
+    best = None
+    for perm in itertools.permutations(scanned) if scanned else [()]:
+        nest = list(fixed) + list(perm)
+        for strategy in strategies:
+            positions = GridPoints(grids, nest, strategy)
+            t = cost_model.total_time(positions, start)
+            if best is None or t < best[0]:
+                name = strategy
+                if len(perm) > 1:
+                    name += f" (inner axis {axes[perm[-1]]})"
+                best = (t, positions, name)
+    return ScanPlan(axes, best[1], best[2], cost_model, start)
+
+
+def plan_point_scan(axes, points, cost_model=None, start=None):
+    # Sparse / irregular point lists: greedy nearest-neighbour, unless it is too
+    # large or does not beat the given order.
+    cost_model = cost_model or CostModel(axes)
+    points = np.asarray(points, dtype=float)
+    if len(points) > MAX_GREEDY_POINTS:
+        return ScanPlan(axes, points, 'as given', cost_model, start)
+    greedy = points[nearest_neighbour_order(points, cost_model, start)]
+    if cost_model.total_time(greedy, start) < cost_model.total_time(points, start):
+        return ScanPlan(axes, greedy, 'nearest-neighbour', cost_model, start)
+    return ScanPlan(axes, points, 'as given', cost_model, start)
@@ -0,0 +1,366 @@
+"""
+Headless scan runner: runs scan recipes (JSON) without Tk, one after another,
+keeping serial ports and cameras open between recipes.
+
+    python scan_runner.py recipe.json [more.json ...] [--dry-run]
+
+A recipe file holds one recipe or a list of them:
+
+    {"name": "dut_xy", "stage": "DUT",
+     "axes": {"X": [0, 1000, 11], "Y": {"start": 0, "stop": 500, "count": 6}, "Z": 1200},
+     "camera": "rayci", "storage": "bmp", "exposures": 1, "burst": "frames",
+     "mode": "grid", "metric": "peak", "tolerance": 1}
+
+mode "fly" sweeps the fast axis ("fly_axis", default: the one with the most
+points) without stopping and images it on "position" or "time" triggers. Its
+run-up stays inside the scanned range unless "fly_limits": [lo, hi] gives the
+axis travel that may be used beyond it.
+"autofocus": {"range": [lo, hi], "metric": "gradient"} searches Z for best focus
+at every point of a grid scan; Z is then not listed under "axes". With no scanned
+axis at all the recipe is a single standalone focus search.
+"roi": {"mode": "manual", "size": [w, h], "offset": [x, y], "binning": 2} crops
+and bins frames right after capture; mode "track" keeps a w x h window on the beam.
+
+Axes given as [start, stop, count] are scanned, a number fixes the axis, and axes
+not listed stay where they are. camera may be null to only move. Heavy modules
+(numpy, pyserial, PIL, h5py, the camera backends) are imported only once a scan
+actually needs them, so loading and checking recipes is fast; the allowed option
+values come from scan_options. Only "autofocus" and "roi" settings load numpy to be
+checked.
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+from scan_options import BURST_MODES, CAMERA_BACKENDS, FLY_TRIGGERS, SCAN_MODES, STORAGE_MODES
+
+# stage name -> (serial port, axes, log group)
+RUNNER_STAGES = {
+    'DUT': ('COM3', ('X', 'Y', 'Z', 'U', 'V', 'W'), 'DUT'),
+    'CAMERA': ('COM5', ('X', 'Y'), 'camera'),
+}
+RECIPE_DEFAULTS = {'name': None, 'camera': 'rayci', 'storage': 'bmp', 'exposures': 1, 'burst': 'frames',
+                   'mode': 'grid', 'metric': 'peak', 'tolerance': 1.0, 'fly_axis': None, 'fly_limits': None,
+                   'trigger': 'position', 'autofocus': None, 'roi': None,
+                   'log_root': None}
+PROGRESS_INTERVAL = 2.0     # seconds between progress lines
+
+
+def load_recipes(path):
+    with open(path) as f:
+        data = json.load(f)
+    recipes = data if isinstance(data, list) else [data]
+    return [validate_recipe(r, f"{path}[{i}]") for i, r in enumerate(recipes)]
+
+
+def _is_number(value):
+    # JSON numbers only: null, strings, lists and booleans are rejected
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value == value
+
+
+def _axis_spec(ax, spec):
+    # (start, stop, count) for a scanned axis, or a float for a fixed one
+    if isinstance(spec, (int, float)):
+        return float(spec)
+    if isinstance(spec, dict):
+        spec = [spec.get('start'), spec.get('stop'), spec.get('count')]
+    if not isinstance(spec, (list, tuple)) or len(spec) != 3:
+        raise ValueError(f"axis {ax}: expected [start, stop, count] or a position")
+    start, stop, count = spec
+    if int(count) != count or count < 2:
+        raise ValueError(f"axis {ax}: count must be an integer >= 2")
+    return float(start), float(stop), int(count)
+
+
+def validate_recipe(recipe, where='recipe'):
+    if not isinstance(recipe, dict):
+        raise ValueError(f"{where}: a recipe is a JSON object")
+    unknown = set(recipe) - set(RECIPE_DEFAULTS) - {'stage', 'axes'}
+    if unknown:
+        raise ValueError(f"{where}: unknown keys {', '.join(sorted(unknown))}")
+    r = {**RECIPE_DEFAULTS, **recipe}
+    if r.get('stage') not in RUNNER_STAGES:
+        raise ValueError(f"{where}: stage must be one of {', '.join(RUNNER_STAGES)}")
+    stage_axes = RUNNER_STAGES[r['stage']][1]
+    axes = r.get('axes') or {}
+    bad = set(axes) - set(stage_axes)
+    if bad:
+        raise ValueError(f"{where}: {r['stage']} has no axes {', '.join(sorted(bad))}")
+    try:
+        r['axes'] = {ax: _axis_spec(ax, spec) for ax, spec in axes.items()}
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"{where}: {e}")
+    if not any(isinstance(spec, tuple) for spec in r['axes'].values()) and r['autofocus'] is None:
+        raise ValueError(f"{where}: no scanned axis")
+    if r['camera'] is not None and r['camera'] not in CAMERA_BACKENDS:
+        raise ValueError(f"{where}: camera must be one of {', '.join(CAMERA_BACKENDS)} or null")
+    if r['storage'] not in STORAGE_MODES:
+        raise ValueError(f"{where}: storage must be one of {', '.join(STORAGE_MODES)}")
+    if not _is_number(r['exposures']) or not float(r['exposures']).is_integer() or r['exposures'] < 1:
+        raise ValueError(f"{where}: exposures must be an integer >= 1")
+    r['exposures'] = int(r['exposures'])
+    if not _is_number(r['tolerance']) or not r['tolerance'] > 0:
+        raise ValueError(f"{where}: tolerance must be a number > 0")
+    if r['burst'] not in BURST_MODES:
+        raise ValueError(f"{where}: burst must be one of {', '.join(BURST_MODES)}")
+    if r['mode'] not in SCAN_MODES:
+        raise ValueError(f"{where}: mode must be one of {', '.join(SCAN_MODES)}")
+    if r['mode'] == 'fly':
+        scanned = [ax for ax, spec in r['axes'].items() if isinstance(spec, tuple)]
+        if r['fly_axis'] is not None and r['fly_axis'] not in scanned:
+            raise ValueError(f"{where}: fly_axis must be one of the scanned axes ({', '.join(scanned)})")
+        if r['trigger'] not in FLY_TRIGGERS:
+            raise ValueError(f"{where}: trigger must be one of {', '.join(FLY_TRIGGERS)}")
+        if r['fly_limits'] is not None:
+            try:
+                lo, hi = sorted(float(v) for v in r['fly_limits'])
+            except (TypeError, ValueError):
+                raise ValueError(f"{where}: fly_limits must be [lo, hi]")
+            fast = r['fly_axis'] or max((ax for ax in stage_axes if ax in scanned), key=lambda ax: r['axes'][ax][2])
+            start, stop, _ = r['axes'][fast]
+            if min(start, stop) < lo or max(start, stop) > hi:
+                raise ValueError(f"{where}: {fast} range {start:g}..{stop:g} is outside fly_limits {lo:g}..{hi:g}")
+            r['fly_limits'] = [lo, hi]
+    if r['autofocus'] is not None:
+        from autofocus import Autofocus
+        try:
+            focus = Autofocus.from_dict(r['autofocus'])
+        except (TypeError, KeyError, ValueError) as e:
+            raise ValueError(f"{where}: autofocus: {e}")
+        if focus.axis not in stage_axes or isinstance(r['axes'].get(focus.axis), tuple):
+            raise ValueError(f"{where}: autofocus axis {focus.axis} must be a {r['stage']} axis that is not scanned")
+        if r['mode'] != 'grid' or r['camera'] is None:
+            raise ValueError(f"{where}: autofocus needs a grid scan with a camera")
+        r['autofocus'] = focus.to_dict()
+    if r['roi'] is not None:
+        from frame_roi import FrameROI
+        try:
+            r['roi'] = FrameROI.from_dict(r['roi']).to_dict()
+        except (TypeError, AttributeError, ValueError) as e:
+            raise ValueError(f"{where}: roi: {e}")
+    if r['mode'] == 'adaptive' and r['storage'] != 'bmp':
+        raise ValueError(f"{where}: adaptive scans visit an irregular point set; use BMP storage")
+    if r['mode'] == 'adaptive' and r['camera'] is None:
+        raise ValueError(f"{where}: adaptive scans are steered by frame scores and need a camera")
+    return r
+
+
+class ScanRunner:
+    """
+    Runs validated recipes through ScanWorker without a GUI. Controllers come from the
+    shared per-port registry and cameras are cached by backend name, so a batch opens
+    each port and camera once. Progress goes to `log` (print by default).
+    """
+    def __init__(self, log=print):
+        self.log = log
+        self.cameras = {}
+        self.worker = None
+
+    def get_camera(self, name):
+        if name is None:
+            return None
+        if name not in self.cameras:
+            from cameras import make_camera
+            self.cameras[name] = make_camera(name)
+        return self.cameras[name]
+
+    def scan_params(self, recipe, origin):
+        import numpy as np
+        params = {}
+        for ax in RUNNER_STAGES[recipe['stage']][1]:
+            spec = recipe['axes'].get(ax)
+            focus = recipe['autofocus']
+            if focus is not None and ax == focus['axis']:
+                params[ax] = np.array([sum(focus['range']) / 2])
+            elif isinstance(spec, tuple):
+                params[ax] = np.linspace(*spec)
+            elif spec is not None:
+                params[ax] = np.array([spec])
+            elif origin[ax] == 'NA':
+                raise RuntimeError(f"Position of {recipe['stage']} axis {ax} not available")
+            else:
+                params[ax] = np.array([float(origin[ax])])
+        return params
+
+    def plan(self, recipe, origin):
+        from scan_path import CostModel, plan_grid_scan
+        from motion import get_move_model
+        port, axes, _ = RUNNER_STAGES[recipe['stage']]
+        scan_params = self.scan_params(recipe, origin)
+        start = [float(scan_params[ax][0]) if origin[ax] == 'NA' else float(origin[ax]) for ax in axes]
+        move_model = get_move_model(port)
+        cost_model = CostModel(axes, {ax: move_model.axis_cost(ax) for ax in axes}, concurrent=True)
+        if recipe['mode'] == 'fly':
+            from fly_scan import plan_fly_scan
+            return scan_params, cost_model, plan_fly_scan(axes, scan_params, recipe['fly_axis'], cost_model,
+                                                          start=start, trigger=recipe['trigger'],
+                                                          limits=recipe['fly_limits'])
+        return scan_params, cost_model, plan_grid_scan(axes, scan_params, cost_model, start=start)
+
+    def log_dir(self, recipe):
+        group = RUNNER_STAGES[recipe['stage']][2]
+        root = recipe['log_root'] or os.path.join(os.getcwd(), "log")
+        name = datetime.datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        if recipe['name']:
+            name += f"_{recipe['name']}"
+        path = base = os.path.join(root, group, name)
+        n = 1
+        while os.path.exists(path):
+            n += 1
+            path = f"{base}_{n}"
+        os.makedirs(path)
+        return path
+
+    def dry_run(self, recipe):
+        # Plan only, with unlisted axes assumed at 0; no hardware is touched
+        axes = RUNNER_STAGES[recipe['stage']][1]
+        _, _, plan = self.plan(recipe, {ax: '0' for ax in axes})
+        return plan.summary()
+
+    def run(self, recipe):
+        from ds102 import get_controller
+        from motion import StageMotion
+        from scan_worker import ScanWorker
+        from scan_journal import ScanJournal
+        from frame_average import make_averager
+        from autofocus import Autofocus
+        from frame_roi import FrameROI
+        port, axes, _ = RUNNER_STAGES[recipe['stage']]
+        label = recipe['name'] or recipe['stage']
+        ctrl = get_controller(port)
+        ctrl.open()
+        origin = ctrl.get_positions(axes)
+        scan_params, cost_model, plan = self.plan(recipe, origin)
+        camera = self.get_camera(recipe['camera'])
+        log_dir = self.log_dir(recipe)
+        home = {ax: float(origin[ax]) if origin[ax] != 'NA' else 0.0 for ax in axes}
+        stages = [(StageMotion(ctrl, origin), {ax: i for i, ax in enumerate(axes)}, home)]
+
+        journal = ScanJournal(log_dir)
+        adaptive = fly = None
+        if recipe['mode'] == 'fly':
+            # Frame positions are only known once taken, so fly scans have no plan.json to resume from
+            fly, positions = plan, None
+            self.log(f"[{label}] fly scan: {plan.summary()} -> {log_dir}")
+        elif recipe['mode'] == 'adaptive':
+            positions = None
+            from adaptive_scan import AdaptiveScan
+            adaptive = AdaptiveScan(axes, scan_params, recipe['metric'], recipe['tolerance'])
+            self.log(f"[{label}] adaptive scan on {recipe['metric']} -> {log_dir}")
+        else:
+            positions = plan.positions
+            journal.write_plan({
+                'axes': list(axes), 'grid': positions.to_dict(),
+                'scan_params': {ax: [float(v) for v in vals] for ax, vals in scan_params.items()},
+                'stages': [{'port': port, 'columns': stages[0][1], 'home': home}],
+                'storage': recipe['storage'], 'exposures': recipe['exposures'], 'burst': recipe['burst'],
+                'camera': recipe['camera'], 'preview_overlay': False, 'autofocus': recipe['autofocus'],
+                'roi': recipe['roi'],
+            })
+            self.log(f"[{label}] {plan.summary()} -> {log_dir}")
+
+        self.worker = ScanWorker(axes, positions, log_dir, stages, camera, recipe['exposures'],
+                                 preview_size=None, storage=recipe['storage'], scan_params=scan_params,
+                                 adaptive=adaptive, cost_model=cost_model, journal=journal,
+                                 averager=make_averager(recipe['burst']), fly=fly,
+                                 autofocus=Autofocus.from_dict(recipe['autofocus']) if recipe['autofocus'] else None,
+                                 roi=FrameROI.from_dict(recipe['roi']) if recipe['roi'] else None)
+        return self.follow(self.worker, label, log_dir)
+
+    def follow(self, worker, label, log_dir):
+        import queue
+        result = {'name': label, 'log_dir': log_dir, 'errors': [], 'done': 0, 'aborted': False, 'best': None}
+        start = time.monotonic()
+        next_report = start + PROGRESS_INTERVAL
+        progress = timing = None
+        worker.start()
+        while True:
+            try:
+                kind, *payload = worker.events.get(timeout=0.2)
+            except queue.Empty:
+                kind = None
+            except KeyboardInterrupt:
+                # Ctrl-C aborts the scan; the worker still returns the stage home
+                self.log(f"[{label}] aborting...")
+                worker.abort()
+                continue
+            if kind == 'progress':
+                progress = payload
+            elif kind == 'timing':
+                timing = payload[0]
+            elif kind == 'warning':
+                self.log(f"[{label}] WARNING: {payload[0]}")
+            elif kind == 'error':
+                result['errors'].append(payload[0])
+                self.log(f"[{label}] ERROR: {payload[0]}")
+            elif kind == 'best':
+                result['best'] = payload
+            elif kind == 'done':
+                result['done'], result['aborted'] = payload
+                break
+            if progress and time.monotonic() >= next_report:
+                next_report = time.monotonic() + PROGRESS_INTERVAL
+                self.log(f"[{label}] {progress[0]}/{progress[1]}  {timing or ''}")
+        worker.join()
+        self.worker = None
+        result['seconds'] = time.monotonic() - start
+        state = 'aborted' if result['aborted'] else 'done'
+        self.log(f"[{label}] {state}: {result['done']} points in {result['seconds']:.1f} s")
+        if result['best']:
+            best, score = result['best']
+            self.log(f"[{label}] best point: " + ', '.join(f"{ax}={int(v)}" for ax, v in best.items()) + f" (score {score:.4g})")
+        return result
+
+    def run_all(self, recipes, stop_on_error=False):
+        results = []
+        for recipe in recipes:
+            try:
+                result = self.run(recipe)
+            except Exception as e:
+                self.log(f"[{recipe['name'] or recipe['stage']}] failed to start: {e}")
+                result = {'name': recipe['name'], 'errors': [str(e)], 'done': 0, 'aborted': False}
+            results.append(result)
+            if result['aborted'] or (stop_on_error and result['errors']):
+                break
+        return results
+
+    def close(self):
+        for camera in self.cameras.values():
+            try:
+                camera.close()
+            except Exception as e:
+                self.log(f"Closing camera failed: {e}")
+        self.cameras.clear()
+        from ds102 import close_all
+        close_all()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run scan recipes without the GUI")
+    parser.add_argument('recipes', nargs='+', help="recipe JSON files, run in order")
+    parser.add_argument('--dry-run', action='store_true', help="validate and plan only, no hardware")
+    parser.add_argument('--stop-on-error', action='store_true', help="skip the remaining recipes after an error")
+    args = parser.parse_args(argv)
+
+    try:
+        recipes = [r for path in args.recipes for r in load_recipes(path)]
+    except (OSError, ValueError) as e:
+        print(f"Recipe error: {e}", file=sys.stderr)
+        return 2
+    runner = ScanRunner()
+    if args.dry_run:
+        for r in recipes:
+            print(f"[{r['name'] or r['stage']}] {runner.dry_run(r)}")
+        return 0
+    try:
+        results = runner.run_all(recipes, args.stop_on_error)
+    finally:
+        runner.close()
+    return 1 if any(r['errors'] or r['aborted'] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+import json
+import os
+import time
+import numpy as np
+
+from scan_options import STORAGE_MODES
+
+H5_FILENAME = 'scan.h5'
+H5_COMPRESSION = 'gzip'
+H5_COMPRESSION_LEVEL = 4
+
+
+def save_bmp(frame, filename):
+    from PIL import Image
+    frame = np.asarray(frame)
+    if frame.dtype != np.uint8:
+        # BMP holds 8 bits per channel; keep the top byte of 16-bit data
+        frame = (frame >> 8).astype(np.uint8) if frame.dtype == np.uint16 else np.clip(frame, 0, 255).astype(np.uint8)
+    Image.fromarray(frame).save(filename)
+
+
+def _require_h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise RuntimeError("HDF5 storage needs the h5py package (pip install h5py).")
+    return h5py
+
+
+class H5ScanStore:
+    """
+    All frames of a grid scan in one chunked, compressed HDF5 file.
+
+    /frames      grid_shape + frame_shape, one chunk per frame, so any slice over the
+                 scan axes only decodes the frames it touches
+    /positions   (N, n_axes) commanded positions, in acquisition order
+    /grid_index  (N, n_axes) index of each acquired frame in /frames
+    /timestamps  (N,) seconds since the epoch
+    /metrics     (N, n_metrics) beam metrics per frame, column names in its 'columns' attribute
+    /frame_std, /frame_kept  per-pixel statistics of averaged bursts, laid out like /frames
+    /roi         (N, 4) sensor window (x0, y0, x1, y1) of each frame when frames are cropped;
+                 settings and sensor shape in the root attribute 'roi'
+    /axes/<ax>   grid values per axis
+    Scan parameters are stored as JSON in the root attribute 'scan_params'. The root
+    attribute 'exposures' is the number of frames per cell: above 1 the frame shape
+    starts with the burst axis, (count, h, w[, 3]).
+    """
+    def __init__(self, path, axes, grids, scan_params=None, exposures=1):
+        h5py = _require_h5py()
+        self.path = path
+        self.axes = list(axes)
+        self.grids = [np.asarray(g, dtype=float) for g in grids]
+        self.shape = tuple(len(g) for g in self.grids)
+        self.file = h5py.File(path, 'a')
+        self.file.attrs['axes'] = json.dumps(self.axes)
+        self.file.attrs['scan_params'] = json.dumps(scan_params or {})
+        self.file.attrs['exposures'] = int(exposures)
+        self.file.attrs.setdefault('created', time.strftime("%Y-%m-%dT%H:%M:%S"))
+        grp = self.file.require_group('axes')
+        for ax, g in zip(self.axes, self.grids):
+            if ax not in grp:
+                grp.create_dataset(ax, data=g)
+        n = len(self.axes)
+        for name, shape, dtype in (('positions', (0, n), 'f8'), ('grid_index', (0, n), 'i4'), ('timestamps', (0,), 'f8')):
+            if name not in self.file:
+                self.file.create_dataset(name, shape=shape, maxshape=(None,) + shape[1:], dtype=dtype, chunks=True)
+
+    def grid_index(self, pos):
+        return tuple(int(np.argmin(np.abs(g - v))) for g, v in zip(self.grids, pos))
+
+    def _frames(self, frame, name='frames'):
+        if name not in self.file:
+            self.file.create_dataset(
+                name, shape=self.shape + frame.shape, dtype=frame.dtype,
+                chunks=(1,) * len(self.shape) + frame.shape,
+                compression=H5_COMPRESSION, compression_opts=H5_COMPRESSION_LEVEL, shuffle=True)
+        return self.file[name]
+
+    def _append(self, name, row):
+        ds = self.file[name]
+        ds.resize(ds.shape[0] + 1, axis=0)
+        ds[-1] = row
+
+    def write(self, pos, frame, timestamp=None, metrics=None, stats=None, roi=None):
+        frame = np.asarray(frame)
+        idx = self.grid_index(pos)
+        self._frames(frame)[idx] = frame
+        for name, data in (stats or {}).items():
+            self._frames(data, f'frame_{name}')[idx] = data
+        self._append('positions', np.asarray(pos, dtype=float))
+        self._append('grid_index', idx)
+        self._append('timestamps', time.time() if timestamp is None else timestamp)
+        if roi is not None:
+            if 'roi' not in self.file:
+                self.file.create_dataset('roi', shape=(0, 4), maxshape=(None, 4), dtype='i4', chunks=True)
+            self._append('roi', roi)
+        if metrics is not None:
+            if 'metrics' not in self.file:
+                ds = self.file.create_dataset('metrics', shape=(0, len(metrics)), maxshape=(None, len(metrics)),
+                                              dtype='f8', chunks=True)
+                ds.attrs['columns'] = json.dumps(list(metrics))
+            self._append('metrics', [metrics[name] for name in json.loads(self.file['metrics'].attrs['columns'])])
+        # Keep the file readable if the scan is interrupted
+        self.file.flush()
+        # Row of this frame in /positions, /grid_index, ...
+        return self.file['positions'].shape[0] - 1
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def open_h5_scan(path):
+    # Read-only handle; slice f['frames'][i, :, k] to decode only the selected frames
+    h5py = _require_h5py()
+    if os.path.isdir(path):
+        path = os.path.join(path, H5_FILENAME)
+    return h5py.File(path, 'r')
@@ -0,0 +1,129 @@
+import collections
+import contextlib
+import csv
+import json
+import os
+import threading
+import time
+import numpy as np
+
+from scan_path import format_duration
+
+TRACE_CSV = 'trace.csv'
+TRACE_JSON = 'trace.json'
+# Phases of one scan point, in the order they happen
+PHASES = ('point', 'move', 'motion_wait', 'sweep', 'focus', 'capture', 'queue', 'export', 'average', 'roi', 'write', 'analysis', 'preview')
+TRACE_WINDOW = 500      # recent spans per phase used for mean / p95
+TIMING_INTERVAL = 1.0   # seconds between live timing summaries
+
+
+class ScanTrace:
+    """
+    Timing spans for every phase of a scan point. Spans are streamed to
+    log_dir/trace.csv and, on close(), this run's rows are converted to Chrome trace
+    JSON (trace.json, open in chrome://tracing or Perfetto), one row per thread, so
+    the scan loop and the pipeline workers can be compared side by side. Only the
+    recent durations for the live statistics are kept in memory.
+    """
+    def __init__(self, log_dir=None):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.durations = collections.defaultdict(lambda: collections.deque(maxlen=TRACE_WINDOW))
+        self.counts = collections.Counter()
+        self.log_dir = log_dir
+        self.file = None
+        if log_dir:
+            path = os.path.join(log_dir, TRACE_CSV)
+            self.file = open(path, 'a', newline='')
+            self.writer = csv.writer(self.file)
+            if self.file.tell() == 0:
+                self.writer.writerow(['phase', 'point', 'thread', 'start_s', 'duration_s'])
+                self.file.flush()
+            # A resumed scan appends; its trace.json covers only the rows from here on
+            self.offset = self.file.tell()
+
+    @contextlib.contextmanager
+    def span(self, phase, point=None):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(phase, t, time.perf_counter() - t, point)
+
+    def add(self, phase, start, duration, point=None):
+        thread = threading.current_thread().name
+        with self.lock:
+            self.durations[phase].append(duration)
+            self.counts[phase] += 1
+            if self.file is not None:
+                self.writer.writerow([phase, '' if point is None else point, thread,
+                                      f"{start - self.start:.6f}", f"{duration:.6f}"])
+
+    def stats(self):
+        # phase -> {'count', 'mean', 'p95'} in seconds, over the last TRACE_WINDOW spans
+        with self.lock:
+            recent = {phase: np.array(d) for phase, d in self.durations.items() if d}
+            counts = dict(self.counts)
+        return {phase: {'count': counts[phase], 'mean': float(d.mean()), 'p95': float(np.percentile(d, 95))}
+                for phase, d in recent.items()}
+
+    def eta(self, remaining):
+        # Seconds left at the recent mean time per point, or None before the first point
+        with self.lock:
+            points = self.durations.get('point')
+            mean = sum(points) / len(points) if points else None
+        return None if mean is None else mean * remaining
+
+    def summary(self, remaining=None):
+        stats = self.stats()
+        parts = [f"{phase} {s['mean'] * 1e3:.0f}/{s['p95'] * 1e3:.0f}"
+                 for phase, s in ((p, stats.get(p)) for p in PHASES) if s]
+        text = "mean/p95 ms: " + ', '.join(parts) if parts else ""
+        eta = self.eta(remaining) if remaining is not None else None
+        if eta is not None:
+            text += f"   ETA {format_duration(eta)}"
+        return text
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def write_chrome_trace(self, path):
+        # Streams this run's rows of trace.csv into a Chrome trace, one event at a time
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+        threads = {}
+        with open(os.path.join(self.log_dir, TRACE_CSV), newline='') as src, open(path, 'w') as f:
+            src.seek(self.offset)
+            f.write('{"displayTimeUnit": "ms", "traceEvents": [')
+            sep = ''
+            for phase, point, thread, start, duration in csv.reader(src):
+                tid = threads.setdefault(thread, len(threads))
+                event = {'name': phase, 'ph': 'X', 'pid': 0, 'tid': tid,
+                         'ts': round(float(start) * 1e6, 1), 'dur': round(float(duration) * 1e6, 1),
+                         'args': {} if point == '' else {'point': int(point)}}
+                f.write(sep + json.dumps(event))
+                sep = ', '
+            for name, tid in threads.items():
+                f.write(sep + json.dumps({'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': tid, 'args': {'name': name}}))
+                sep = ', '
+            f.write(']}')
+
+    def close(self):
+        if self.log_dir and self.file is not None:
+            self.write_chrome_trace(os.path.join(self.log_dir, TRACE_JSON))
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class NullTrace:
+    # Stand-in when nothing is being traced
+    def span(self, phase, point=None):
+        return contextlib.nullcontext()
+
+
+NULL_TRACE = NullTrace()
@@ -0,0 +1,523 @@
+import json
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor, wait
+import threading
+import time
+import numpy as np
+
+from acquisition import AcquisitionPipeline
+from preview import PREVIEW_FPS, PREVIEW_SIZE, PreviewThrottle, render_preview
+from scan_store import H5_FILENAME, H5ScanStore, save_bmp
+from frame_average import save_stats
+from scan_path import plan_grid_scan, plan_point_scan
+from beam_metrics import BeamAnalyzer, MetricsTable, score_metrics
+from adaptive_scan import ADAPTIVE_LOG
+from scan_trace import NULL_TRACE, TIMING_INTERVAL, ScanTrace
+from fly_scan import sweep
+from motion import wait_for_axes
+from autofocus import FocusLog
+
+
+def frame_filename(log_dir, axes, pos):
+    pos_strs = [f"{ax.lower()}_{int(round(val))}" for ax, val in zip(axes, pos)]
+    return os.path.join(log_dir, '_'.join(pos_strs) + '.bmp')
+
+
+class ScanWorker(threading.Thread):
+    """
+    Runs a planned scan off the Tk thread.
+
+    stages: list of (StageMotion, {axis: column in positions}, home targets). A stage
+    with no columns is held at its home targets for the whole scan. With several
+    stages each controller is driven from its own thread, so a point costs the
+    slowest stage's move rather than the sum.
+    camera: CameraBackend (or None to only move); `exposures` frames are taken per point
+    in one latch. averager: optional FrameAverager; bursts are then reduced to one
+    float mean frame (plus per-pixel statistics) and only that is stored: float frames
+    in the HDF5 store, or an 8-bit BMP with the float data in <frame>_stats.npz.
+    storage: 'bmp' (one file per point), 'hdf5' (frames in log_dir/scan.h5, needs
+    scan_params) or 'both'.
+    analyze: compute beam metrics for every frame on the pipeline worker and append
+    them to log_dir/metrics.csv (and the HDF5 store).
+    adaptive: optional AdaptiveScan; positions are then generated level by level
+    (planned with cost_model) from the frame scores instead of taken from `positions`.
+    fly: optional FlyScanPlan; instead of stopping at every point the fast axis sweeps
+    each line and frames are latched on the fly, tagged with the interpolated fast-axis
+    position (pause and abort take effect between lines / frames).
+    autofocus: optional Autofocus run at every point before the capture (not in fly
+    scans); the frame is taken at the focus found, which replaces the planned value
+    of the focus axis in the file name, journal and metrics, and is logged to
+    log_dir/autofocus.csv.
+    roi: optional FrameROI; frames are cropped / binned right after they come off the
+    camera (or out of the averager), so storage, preview and analysis only see the
+    window. Metrics are converted back to sensor pixels; the window of every frame
+    goes to the journal and HDF5 store and the sensor geometry to log_dir/roi.json.
+    journal: optional ScanJournal; every point whose frames are on disk is recorded
+    with its index in the plan (`indices`, default 0..N-1) and the stage readback.
+    Every phase of every point is timed into log_dir/trace.csv and trace.json.
+
+    Progress is reported through `events`, a queue of tuples:
+    ('progress', done, total), ('frame', filename), ('preview', PIL image), ('metrics', pos, dict),
+    ('state', 'running'|'paused'|'returning'), ('best', {axis: pos}, score) for adaptive
+    scans, ('timing', summary text) about once a second, ('warning', message) for
+    results that are usable but not what was asked for (an adaptive scan that stopped
+    above its tolerance), ('error', message) and
+    finally ('done', completed, aborted). A frame that fails on the pipeline (export,
+    write, journal, ...) is reported as an error and aborts the scan, so it is never
+    reported as complete with frames missing. Previews are rate-limited and already shrunk
+    to the panel size, so the GUI only has to wrap them in a PhotoImage;
+    preview_size=None turns them off for headless runs.
+    """
+    def __init__(self, axes, positions, log_dir, stages, camera=None, exposures=1,
+                 preview_fps=PREVIEW_FPS, preview_size=PREVIEW_SIZE, preview_overlay=False,
+                 storage='bmp', scan_params=None, adaptive=None, cost_model=None, analyze=True,
+                 journal=None, indices=None, averager=None, fly=None, autofocus=None, roi=None):
+        super().__init__(name='scan', daemon=True)
+        self.axes = list(axes)
+        self.positions = positions
+        self.log_dir = log_dir
+        self.stages = stages
+        self.camera = camera
+        self.exposures = exposures
+        self.averager = averager
+        self.preview_throttle = PreviewThrottle(preview_fps)
+        self.preview_size = preview_size
+        self.preview_overlay = preview_overlay
+        self.storage = storage
+        self.scan_params = scan_params
+        self.store = None
+        self.adaptive = adaptive
+        self.fly = fly
+        self.fly_done = 0
+        self.autofocus = autofocus
+        self.focus_log = None
+        self.last_focus = None
+        self.roi = roi if roi is not None and roi.active else None
+        self.roi_geometry = None
+        self.analyzer = BeamAnalyzer() if analyze or adaptive is not None else None
+        self.metrics = None
+        self.cost_model = cost_model
+        self.journal = journal
+        self.indices = indices
+        self.readback = [None] * len(self.axes)
+        self.trace = NULL_TRACE
+        self.stage_workers = None
+        self.failed = False
+        self.errors_seen = 0
+        self.events = queue.Queue()
+        self._resume = threading.Event()
+        self._resume.set()
+        self._abort = threading.Event()
+
+    def post(self, kind, *payload):
+        self.events.put((kind, *payload))
+
+    def pause(self):
+        self._resume.clear()
+
+    def resume(self):
+        self._resume.set()
+
+    def abort(self):
+        self._abort.set()
+        self._resume.set()
+
+    @property
+    def paused(self):
+        return not self._resume.is_set()
+
+    def _checkpoint(self):
+        # Block while paused; False once an abort was requested
+        if not self._resume.is_set():
+            self.post('state', 'paused')
+            self._resume.wait()
+            if not self._abort.is_set():
+                self.post('state', 'running')
+        return not self._abort.is_set()
+
+    def _move_stage(self, i, targets, readback=False):
+        motion, columns, _ = self.stages[i]
+        moved = motion.move_to(targets)
+        if readback and moved:
+            # Journal where the stage actually ended up, not just the command
+            for ax, val in motion.ctrl.get_positions(moved).items():
+                self.readback[columns[ax]] = val
+        return moved
+
+    def move_stages(self, moves, readback=False):
+        # moves: [(stage index, targets)]; stages move concurrently, each on its own worker
+        if self.stage_workers is None or len(moves) < 2:
+            for i, targets in moves:
+                self._move_stage(i, targets, readback)
+            return
+        futures = [self.stage_workers[i].submit(self._move_stage, i, targets, readback) for i, targets in moves]
+        wait(futures)
+        for f in futures:
+            f.result()
+
+    def move_to_point(self, pos):
+        self.move_stages([(i, {ax: pos[col] for ax, col in columns.items()})
+                          for i, (_, columns, _) in enumerate(self.stages) if columns],
+                         readback=self.journal is not None)
+        return list(self.readback)
+
+    def focus(self, pos, index):
+        # Per-point pre-step: the other axes go to the point first, then only the focus axis searches
+        af = self.autofocus
+        i, motion, col = next((i, m, columns[af.axis]) for i, (m, columns, _) in enumerate(self.stages)
+                              if af.axis in columns)
+        pos = np.array(pos, dtype=float)
+        # The first search (and every one without tracking) covers the full range
+        around = self.last_focus if af.track else None
+        pos[col] = motion.commanded.get(af.axis, pos[col] if around is None else around)
+        self.move_to_point(pos)
+
+        def grab(z):
+            frame, _ = self.camera.acquire()
+            if af.save_frames:
+                at = pos.copy()
+                at[col] = z
+                save_bmp(frame, frame_filename(self.log_dir, self.axes, at)[:-4] + '_focus.bmp')
+            return frame
+
+        with self.trace.span('focus', index):
+            z, score, history = af.run(lambda z: self.move_stages([(i, {af.axis: z})]), grab, around)
+        self.last_focus = z
+        pos[col] = z
+        self.focus_log.append(index, pos, score, len(history))
+        return pos
+
+    def latch(self, index):
+        # None only for move-only scans; a configured camera that delivers nothing stops the scan
+        if not self.camera:
+            return None
+        with self.trace.span('capture', index):
+            exposure = self.camera.latch(self.exposures)
+        if exposure is None:
+            raise RuntimeError(f"{self.camera.name} capture failed at point {index}")
+        return exposure
+
+    def save_bmp(self, exposure, frames, filename):
+        if exposure.count == 1:
+            save_bmp(frames, filename)
+            return [filename]
+        root, ext = os.path.splitext(filename)
+        files = [f"{root}_e{i}{ext}" for i in range(exposure.count)]
+        for frame, name in zip(frames, files):
+            save_bmp(frame, name)
+        return files
+
+    def process_frame(self, item):
+        # Runs on the acquisition pipeline worker, while the stage moves on
+        filename, pos, last, exposure, index, readback = item
+        frames = stats = None
+        files, h5_row = [], None
+        trace = self.trace
+        try:
+            if self.averager is not None and exposure.count > 1:
+                frames, stats = self.average(exposure, index)
+            window = None
+            if self.roi is not None:
+                frames = self.read_frames(exposure, frames, index)
+                with trace.span('roi', index):
+                    frames, stats, window = self.roi.apply(frames, exposure.count, stats)
+                exposure.metadata['roi'] = window
+                if self.roi_geometry is None:
+                    self.roi_geometry = self.roi.geometry()
+                    self.roi.write_geometry(self.log_dir)
+                    if self.store is not None:
+                        self.store.file.attrs['roi'] = json.dumps(self.roi_geometry)
+            if self.storage in ('bmp', 'both'):
+                # Backends that write BMPs themselves (RayCi) skip the array round trip
+                t = time.perf_counter()
+                if exposure.metadata.get('averaged'):
+                    with trace.span('write', index):
+                        if stats is not None and self.store is None:
+                            # With HDF5 storage the float data goes into the store instead
+                            save_stats(filename, frames, stats, exposure.metadata['averaged'])
+                        save_bmp(self.averager.to_source_dtype(frames, exposure.metadata['dtype']), filename)
+                    files = [filename]
+                elif self.camera.save_native(exposure, filename):
+                    trace.add('export', t, time.perf_counter() - t, index)
+                    files = [filename]
+                else:
+                    frames = self.read_frames(exposure, frames, index)
+                    with trace.span('write', index):
+                        files = self.save_bmp(exposure, frames, filename)
+            else:
+                filename = None
+            metrics = None
+            if self.analyzer is not None:
+                frames = self.read_frames(exposure, frames, index)
+                with trace.span('analysis', index):
+                    metrics = self.analyzer.analyze_exposure(frames, exposure.count)
+                    if window is not None:
+                        metrics = self.roi.to_sensor(metrics, window)
+                    self.metrics.append(pos, metrics, exposure.metadata['timestamp'])
+                self.post('metrics', pos, metrics)
+                if self.adaptive is not None:
+                    self.adaptive.record(pos, score_metrics(metrics, self.adaptive.metric))
+            if self.store is not None:
+                frames = self.read_frames(exposure, frames, index)
+                with trace.span('write', index):
+                    h5_row = self.store.write(pos, frames, exposure.metadata['timestamp'], metrics, stats, window)
+            if self.journal is not None:
+                with trace.span('write', index):
+                    self.journal.record(index, pos, readback, files, h5_row, exposure.metadata['timestamp'], window)
+            if self.preview_size and self.preview_throttle.due(force=last):
+                label = None
+                if self.preview_overlay:
+                    label = ' '.join(f"{ax}={int(round(val))}" for ax, val in zip(self.axes, pos))
+                try:
+                    frames = self.read_frames(exposure, frames, index)
+                    frame = frames if exposure.count == 1 else frames[0]
+                    with trace.span('preview', index):
+                        self.post('preview', render_preview(frame, self.preview_size, label, self.preview_overlay))
+                except Exception as e:
+                    print(f"Preview failed at {label or pos}: {e}")
+        finally:
+            self.camera.release(exposure)
+        return filename
+
+    def average(self, exposure, index):
+        # The burst becomes a single float exposure; the raw frames are dropped
+        frames = self.read_frames(exposure, None, index)
+        with self.trace.span('average', index):
+            mean, stats = self.averager.reduce(frames)
+        exposure.metadata.update(averaged=exposure.count, dtype=str(frames.dtype))
+        exposure.frames = mean
+        exposure.count = 1
+        return mean, stats
+
+    def read_frames(self, exposure, frames, index):
+        # Frames come off the camera once per point; the export is timed on that first read
+        if frames is None:
+            with self.trace.span('export', index):
+                frames = self.camera.read(exposure)
+        return frames
+
+    def check_pipeline(self, pipeline):
+        # Frames that failed on the pipeline since the last check become scan errors and stop the scan
+        errors = pipeline.errors[self.errors_seen:] if pipeline else []
+        self.errors_seen += len(errors)
+        for item, e in errors:
+            filename, pos, _, _, index, _ = item
+            self.post('error', f"Point {index} ({os.path.basename(filename)}) failed: {e}")
+        if errors and not self.failed:
+            self.failed = True
+            self.abort()
+
+    def report(self, pipeline, done, total):
+        self.check_pipeline(pipeline)
+        self.post('progress', done, total)
+        if time.monotonic() >= self.next_timing or done == total:
+            self.next_timing = time.monotonic() + TIMING_INTERVAL
+            self.post('timing', self.trace.summary(total - done))
+            self.trace.flush()
+        for f in pipeline.completed() if pipeline else []:
+            if f:
+                self.post('frame', f)
+
+    def fly_scan(self, pipeline, total):
+        fly = self.fly
+        motion, axis = next((m, ax) for m, columns, _ in self.stages for ax, col in columns.items() if col == fly.fast_col)
+        trace = self.trace
+        self.fly_last = time.perf_counter()
+        for base, line, line_indices in fly.lines():
+            todo = np.arange(len(line))
+            while len(todo) and self._checkpoint():
+                at = motion.commanded.get(axis)
+                start, stop, order = fly.pass_ends(line[todo], at)
+                triggers, indices = line[todo][order], line_indices[todo][order]
+                if len(todo) < len(line) and fly.step_time(triggers, at) < fly.sweep_time(triggers):
+                    # Only a few frames were missed: stopping at each is cheaper than another pass
+                    for j, (trig, index) in enumerate(zip(triggers, indices)):
+                        if not self._checkpoint():
+                            break
+                        pos = base.copy()
+                        pos[fly.fast_col] = trig
+                        readback = self.move_to_point(pos)
+                        exposure = self.latch(int(index))
+                        self.fly_frame(pipeline, pos, int(index), exposure, readback, j + 1 == len(triggers), total)
+                    break
+                pos = base.copy()
+                pos[fly.fast_col] = start
+                readback = self.move_to_point(pos)
+                # The sweep leaves the fast axis at `stop`; until then its position is unknown
+                motion.forget(axis)
+
+                def capture(j):
+                    if self._abort.is_set():
+                        return None
+                    t0 = time.perf_counter()
+                    exposure = self.latch(int(indices[j]))
+                    return t0, time.perf_counter(), exposure
+
+                def deliver(j, fast_pos, exposure):
+                    point = base.copy()
+                    point[fly.fast_col] = fast_pos
+                    point_readback = list(readback)
+                    point_readback[fly.fast_col] = str(int(round(fast_pos)))
+                    self.fly_frame(pipeline, point, int(indices[j]), exposure, point_readback, j + 1 == len(triggers), total)
+
+                with trace.span('sweep', int(indices[0])):
+                    taken = sweep(motion.ctrl, axis, stop, triggers, capture, deliver, fly.sweep_time(triggers),
+                                  fly.tolerance, fly.trigger, motion.model)
+                with trace.span('motion_wait'):
+                    wait_for_axes(motion.ctrl, [axis], model=motion.model)
+                motion.set_known(axis, stop)
+                todo = np.delete(todo, order[taken])
+            if self._abort.is_set():
+                break
+
+    def fly_frame(self, pipeline, point, index, exposure, readback, last, total):
+        if exposure is not None:
+            with self.trace.span('queue', index):
+                pipeline.submit((frame_filename(self.log_dir, self.axes, point), point, last, exposure, index, readback))
+        elif self.journal is not None and not self.camera:
+            self.journal.record(index, point, readback)
+        now = time.perf_counter()
+        self.trace.add('point', self.fly_last, now - self.fly_last, index)
+        self.fly_last = now
+        self.fly_done += 1
+        self.report(pipeline, self.fly_done, total)
+
+    def return_home(self):
+        self.post('state', 'returning')
+        self.move_stages([(i, home) for i, (_, _, home) in enumerate(self.stages)])
+
+    def home_position(self):
+        pos = [0.0] * len(self.axes)
+        for _, columns, home in self.stages:
+            for ax, col in columns.items():
+                pos[col] = float(home[ax])
+        return pos
+
+    def adaptive_levels(self, pipeline):
+        # Each level is planned from where the previous one ended; the scores of a
+        # level must all be in before the next one is chosen
+        start = self.home_position()
+        while True:
+            grid = self.adaptive.next_level()
+            if grid is None:
+                return
+            # Refined levels skip the points already visited, which leaves an irregular set;
+            # the greedy order is kept where it beats the filtered grid order
+            plan = plan_grid_scan(self.axes, grid, self.cost_model, start=start)
+            points = self.adaptive.unvisited(plan.positions[:])
+            points = plan_point_scan(self.axes, points, self.cost_model, start=start).positions
+            if len(points):
+                start = points[-1]
+                yield points
+            pipeline.drain()
+            self.check_pipeline(pipeline)
+            if self._abort.is_set():
+                return
+
+    def run(self):
+        done = 0
+        total = 0
+        try:
+            self.post('state', 'running')
+            self.trace = ScanTrace(self.log_dir)
+            for motion, _, _ in self.stages:
+                motion.trace = self.trace
+            if len(self.stages) > 1:
+                self.stage_workers = [ThreadPoolExecutor(1, thread_name_prefix=f"stage-{getattr(m.ctrl, 'port', i)}")
+                                      for i, (m, _, _) in enumerate(self.stages)]
+            self.move_stages([(i, home) for i, (_, columns, home) in enumerate(self.stages) if not columns])
+
+            if self.storage in ('hdf5', 'both') and self.camera:
+                params = {ax: [float(v) for v in vals] for ax, vals in self.scan_params.items()}
+                # Averaged bursts are stored as one frame per point
+                self.store = H5ScanStore(os.path.join(self.log_dir, H5_FILENAME), self.axes,
+                                         [self.scan_params[ax] for ax in self.axes], params,
+                                         self.exposures if self.averager is None else 1)
+
+            if self.analyzer is not None and self.camera:
+                self.metrics = MetricsTable(self.log_dir, self.axes)
+            if self.autofocus is not None:
+                self.focus_log = FocusLog(self.log_dir, self.axes)
+
+            # Export runs on a worker while the stage moves to the next point
+            if self.journal is not None:
+                self.journal.open()
+            pipeline = AcquisitionPipeline(self.process_frame) if self.camera else None
+            if self.fly is not None:
+                levels = []
+            elif self.adaptive is not None:
+                levels = self.adaptive_levels(pipeline)
+            else:
+                levels = [self.positions]
+            self.next_timing = time.monotonic() + TIMING_INTERVAL
+            try:
+                if self.fly is not None:
+                    total = len(self.fly)
+                    try:
+                        self.fly_scan(pipeline, total)
+                    finally:
+                        done = self.fly_done
+                for points in levels:
+                    total += len(points)
+                    for i, pos in enumerate(points):
+                        if not self._checkpoint():
+                            break
+                        point_start = time.perf_counter()
+                        index = int(self.indices[done]) if self.indices is not None else done
+                        if self.autofocus is not None:
+                            pos = self.focus(pos, index)
+                        readback = self.move_to_point(pos)
+                        filename = frame_filename(self.log_dir, self.axes, pos)
+                        exposure = self.latch(index)
+                        if exposure is not None:
+                            # Blocks here when the pipeline is the bottleneck
+                            with self.trace.span('queue', index):
+                                pipeline.submit((filename, pos, i + 1 == len(points), exposure, index, readback))
+                        elif self.journal is not None and not self.camera:
+                            self.journal.record(index, pos, readback)
+                        self.trace.add('point', point_start, time.perf_counter() - point_start, index)
+                        done += 1
+                        self.report(pipeline, done, total)
+                    if self._abort.is_set():
+                        break
+            finally:
+                for f in pipeline.close() if pipeline else []:
+                    if f:
+                        self.post('frame', f)
+                self.check_pipeline(pipeline)
+                if self.store is not None:
+                    self.store.close()
+                if self.metrics is not None:
+                    self.metrics.close()
+                if self.focus_log is not None:
+                    self.focus_log.close()
+                if self.journal is not None:
+                    self.journal.close()
+                self.trace.close()
+                print(f"Scan timing: {self.trace.summary()}")
+            if self.adaptive is not None:
+                self.adaptive.write_log(os.path.join(self.log_dir, ADAPTIVE_LOG))
+                best, score = self.adaptive.best
+                if best is not None:
+                    self.post('best', dict(zip(self.axes, best.tolist())), score)
+                if not self.adaptive.converged and not self._abort.is_set():
+                    steps = ', '.join(f"{self.axes[i]}={self.adaptive.steps[i]:.3g}" for i in self.adaptive.scanned)
+                    message = (f"Adaptive scan stopped after {self.adaptive.level} levels with steps {steps} pulses, "
+                               f"above the tolerance of {self.adaptive.tolerance:g}")
+                    print(message)
+                    self.post('warning', message)
+        except Exception as e:
+            self.post('error', str(e))
+        finally:
+            # Always attempt a safe return to origin, also after abort or error
+            try:
+                self.return_home()
+            except Exception as e:
+                self.post('error', f"Return to origin failed: {e}")
+            for motion, _, _ in self.stages:
+                motion.trace = NULL_TRACE
+            for executor in self.stage_workers or []:
+                executor.shutdown()
+            self.stage_workers = None
+            self.post('done', done, self._abort.is_set())
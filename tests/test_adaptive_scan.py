@@ -0,0 +1,57 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from adaptive_scan import AdaptiveScan  # noqa: E402
+
+
+PEAK = np.array([1237.0, -412.0])
+
+
+def run(adaptive):
+    # Score every new point of every level with a smooth single peak
+    levels = []
+    while True:
+        grid = adaptive.next_level()
+        if grid is None:
+            return levels
+        points = np.stack(np.meshgrid(*grid.values(), indexing='ij'), axis=-1).reshape(-1, len(grid))
+        points = adaptive.unvisited(points)
+        levels.append(len(points))
+        for pos in points:
+            adaptive.record(pos, -float(np.sum((pos - PEAK) ** 2)))
+
+
+@pytest.mark.parametrize('count', [2, 3, 5, 11])
+def test_adaptive_converges_to_peak(count):
+    params = {'X': np.linspace(0, 2000, count), 'Y': np.linspace(-1000, 1000, count)}
+    adaptive = AdaptiveScan(['X', 'Y'], params, metric='peak', tolerance=1.0)
+    levels = run(adaptive)
+    assert adaptive.converged
+    best, _ = adaptive.best
+    assert np.abs(best - PEAK).max() <= 1
+    # Every refinement level still finds new points to visit
+    assert all(levels[:-1])
+
+
+def test_adaptive_step_shrinks_every_level():
+    params = {'X': np.linspace(0, 1000, 3), 'Y': np.linspace(0, 1000, 3)}
+    adaptive = AdaptiveScan(['X', 'Y'], params, tolerance=1.0)
+    adaptive.next_level()
+    adaptive.record(np.array([500.0, 500.0]), 1.0)
+    steps = [list(adaptive.steps)]
+    while adaptive.next_level() is not None:
+        steps.append(list(adaptive.steps))
+    assert all(b[0] <= a[0] / 2 and b[1] <= a[1] / 2 for a, b in zip(steps, steps[1:]))
+
+
+def test_adaptive_reports_unconverged_stop():
+    params = {'X': np.linspace(0, 2000, 5), 'Y': np.linspace(-1000, 1000, 5)}
+    adaptive = AdaptiveScan(['X', 'Y'], params, tolerance=1.0, max_levels=3)
+    run(adaptive)
+    assert adaptive.level == 3
+    assert not adaptive.converged
@@ -0,0 +1,48 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from frame_average import FrameAverager, make_averager  # noqa: E402
+
+
+def burst(n, spike=None, seed=0, shape=(8, 8)):
+    rng = np.random.default_rng(seed)
+    frames = np.clip(rng.normal(20.0, 2.0, (n,) + shape), 0, 255).astype(np.uint8)
+    if spike is not None:
+        frames[0, 3, 4] = spike
+    return frames
+
+
+@pytest.mark.parametrize('n', [3, 5, 8, 10])
+def test_clipped_mean_rejects_single_spike(n):
+    frames = burst(n, spike=250)
+    mean, stats = make_averager('clipped').reduce(frames)
+    assert stats['kept'][3, 4] == n - 1
+    assert mean[3, 4] == pytest.approx(frames[1:, 3, 4].mean(), abs=1e-4)
+
+
+def test_clipped_mean_keeps_noise():
+    frames = burst(5, seed=1, shape=(64, 64))
+    mean, stats = make_averager('clipped').reduce(frames)
+    # Gaussian noise only: the 4-frame std is rough, so a few frames are dropped, symmetrically
+    assert stats['kept'].mean() > 4.6
+    assert abs((mean - frames.mean(axis=0)).mean()) < 0.1
+
+
+def test_clipped_mean_keeps_quantization_steps():
+    frames = np.full((5, 4, 4), 5, dtype=np.uint8)
+    frames[2] = 6
+    mean, stats = make_averager('clipped').reduce(frames)
+    assert (stats['kept'] == 5).all()
+    assert np.allclose(mean, 5.2)
+
+
+def test_mean_and_std_match_numpy():
+    frames = burst(6, spike=200, shape=(16, 16))
+    mean, stats = FrameAverager(variance=True).reduce(frames)
+    assert np.allclose(mean, frames.mean(axis=0), atol=1e-4)
+    assert np.allclose(stats['std'], frames.std(axis=0, ddof=1), atol=1e-3)
@@ -0,0 +1,113 @@
+import itertools
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from scan_path import AxisCost, CostModel, GridPoints, IndexRanges, plan_grid_scan  # noqa: E402
+
+
+GRIDS = [np.array([0.0, 10.0, 30.0]), np.array([5.0, -5.0]), np.array([100.0, 150.0, 175.0, 300.0])]
+
+
+def brute_force(grids, nest, strategy):
+    # Grid indices per nesting level in visiting order, built recursively; serpentine
+    # reverses the whole inner block under every odd index of a level
+    def order(level):
+        n = len(grids[nest[level]])
+        if level + 1 == len(nest):
+            return [(i,) for i in range(n)]
+        inner = order(level + 1)
+        return [(i,) + t for i in range(n)
+                for t in (inner[::-1] if strategy == 'serpentine' and i % 2 else inner)]
+
+    rows = []
+    for idx in order(0):
+        point = [0.0] * len(grids)
+        for col, i in zip(nest, idx):
+            point[col] = grids[col][i]
+        rows.append(point)
+    return np.array(rows)
+
+
+def step_by_step(points, cost_model, start=None):
+    total, travel = 0.0, np.zeros(points.shape[1])
+    prev = None if start is None else np.asarray(start, dtype=float)
+    for p in points:
+        if prev is not None:
+            d = np.abs(p - prev)
+            per_axis = [c.move_times([x])[0] for c, x in zip(cost_model.axis_costs, d)]
+            total += max(per_axis) if cost_model.concurrent else sum(per_axis)
+            travel += d
+        prev = p
+    return total, travel
+
+
+NESTS = list(itertools.permutations(range(3)))
+
+
+@pytest.mark.parametrize('nest', NESTS)
+@pytest.mark.parametrize('strategy', ['raster', 'serpentine'])
+def test_grid_points_order(nest, strategy):
+    points = GridPoints(GRIDS, nest, strategy)
+    expected = brute_force(GRIDS, nest, strategy)
+    assert len(points) == len(expected)
+    assert np.array_equal(points[:], expected)
+    assert np.array_equal(np.array(list(points)), expected)
+    assert np.array_equal(points[5], expected[5])
+    assert np.array_equal(points[-1], expected[-1])
+    assert np.array_equal(points[[3, 0, 7]], expected[[3, 0, 7]])
+    if strategy == 'serpentine':
+        # Consecutive points differ on exactly one axis
+        assert ((np.diff(expected, axis=0) != 0).sum(axis=1) == 1).all()
+
+
+@pytest.mark.parametrize('nest', NESTS)
+@pytest.mark.parametrize('strategy', ['raster', 'serpentine'])
+@pytest.mark.parametrize('concurrent', [False, True])
+def test_closed_form_cost_matches_steps(nest, strategy, concurrent):
+    costs = {'X': AxisCost(1000, 0.05), 'Y': AxisCost(250, 0.1), 'Z': AxisCost(4000, 0.0)}
+    model = CostModel(['X', 'Y', 'Z'], costs, concurrent=concurrent)
+    start = [3.0, 0.0, 120.0]
+    points = GridPoints(GRIDS, nest, strategy)
+    expected_time, expected_travel = step_by_step(points[:], model, start)
+    assert points.motion_time(model, start) == pytest.approx(expected_time)
+    assert model.total_time(points, start) == pytest.approx(expected_time)
+    travel = model.travel(points, start)
+    assert [travel[ax] for ax in 'XYZ'] == pytest.approx(expected_travel.tolist())
+
+
+def test_plan_grid_scan_is_cheapest_candidate():
+    model = CostModel(['X', 'Y', 'Z'], {'Y': AxisCost(100, 0.2)})
+    params = dict(zip('XYZ', GRIDS))
+    plan = plan_grid_scan(['X', 'Y', 'Z'], params, model)
+    candidates = [step_by_step(GridPoints(GRIDS, nest, strategy)[:], model)[0]
+                  for nest in NESTS for strategy in ('raster', 'serpentine')]
+    assert plan.predicted_time == pytest.approx(min(candidates))
+
+
+def test_index_ranges_complement():
+    n = 50
+    done = [0, 1, 7, 8, 9, 23, 49, 49, 60]
+    rest = IndexRanges.complement(n, done)
+    expected = np.setdiff1d(np.arange(n), done)
+    assert len(rest) == len(expected)
+    assert np.array_equal(rest[:], expected)
+    assert list(rest) == expected.tolist()
+    assert rest[0] == expected[0] and rest[-1] == expected[-1]
+    assert np.array_equal(rest[[4, 0, 10]], expected[[4, 0, 10]])
+    assert np.array_equal(rest[3:30:4], expected[3:30:4])
+    with pytest.raises(IndexError):
+        rest[len(expected)]
+
+
+def test_take_index_ranges_matches_dense():
+    points = GridPoints(GRIDS, [2, 0, 1], 'serpentine')
+    rest = IndexRanges.complement(len(points), [2, 3, 11, 20])
+    lazy = points.take(rest)
+    assert np.array_equal(lazy[:], points[:][np.asarray(rest)])
+    assert lazy.motion_time(CostModel(['X', 'Y', 'Z'])) == pytest.approx(
+        step_by_step(points[:][np.asarray(rest)], CostModel(['X', 'Y', 'Z']))[0])